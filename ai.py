@@ -0,0 +1,341 @@
+import sys
+import time
+import random
+import argparse
+
+from combat import BattleEngine, default_policy
+
+# Enemy AI that looks ahead instead of flipping a coin between attacking and
+# its special. It runs an expectiminimax search over the actual combat rules:
+# the enemy picks the move that is best for the enemies, the player answers
+# with the move that is worst for them, and every random roll (damage
+# jitter, 2-4 frenzy hits, the stun chance) is a chance node weighted by its
+# probability. Orc defense shred, elf lifesteal, goblin multi-hit and the
+# player's stun all play out as in combat.py.
+#
+# The search deepens one round (enemy turn plus player turn) at a time until
+# its time budget runs out, and plays the best move of the deepest round it
+# finished. Values of positions at the start of an enemy turn go into a
+# transposition table, which is kept from one decision to the next for as
+# long as the same enemies are in the fight.
+#
+# A search position is a compact tuple:
+#   (health, defense, level, experience, potions,
+#    enemy position in the facing order, enemy health, enemy stunned)
+# The player's attack and max health follow from the level, and everything
+# about the enemies that the rules never change lives in the SearchRoot.
+
+# Difficulty levels: time budget per decision in seconds, the deepest search
+# in rounds, and the chance to play the searched move rather than the
+# regular 70/30 coin flip. Even one round of lookahead always finds the
+# strongest special, so the easier levels mostly play like the regular game.
+DIFFICULTIES = {
+    "easy": (0.001, 1, 0.2),
+    "normal": (0.005, 4, 0.6),
+    "hard": (0.050, 12, 1.0),
+}
+
+WIN = 2.0  # The player is dead
+LOSS = -2.0  # All enemies are dead
+MAX_TABLE_ENTRIES = 500000
+CHECK_INTERVAL = 16  # Searched positions between looks at the clock
+
+JITTERS = range(-2, 3)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+# Snapshot of a battle at the start of an enemy turn, taken on the game's
+# thread so the search never touches the live engine. Only the enemies the
+# player can get through within the deepest search are looked at, in the
+# order they will be faced.
+class SearchRoot:
+    def __init__(self, engine, max_depth):
+        player = engine.player
+        index = engine.acting_index()
+        enemy = engine.enemies[index]
+        following = sorted(engine.alive - {index})
+        self.order = [engine.enemies[i] for i in [index] + following[:max_depth]]
+        self.more_enemies = len(following) > max_depth
+
+        self.kinds = tuple(enemy.kind for enemy in self.order)
+        self.max_health = tuple(enemy.max_health for enemy in self.order)
+        self.health = tuple(enemy.health for enemy in self.order)
+        self.attack = tuple(enemy.attack for enemy in self.order)
+        self.defense = tuple(enemy.defense for enemy in self.order)
+        self.experience = tuple(enemy.level * 10 for enemy in self.order)
+        self.stunned = tuple(enemy.stunned for enemy in self.order)
+        # Enemy health still to get through from each position on
+        self.remaining = [sum(self.health[position:]) for position in range(len(self.order) + 1)]
+
+        rules = engine.rules
+        self.stun_chance = rules.stun_chance
+        self.crushing_multiplier = rules.crushing_multiplier
+        self.level_up_factor = rules.level_up_factor
+        self.base_health = player.max_health - 5 * player.level
+        self.base_attack = player.attack - 2 * player.level
+        self.potions = rules.potions
+        # Scales for the heuristic, which may only depend on the key
+        self.player_total = self.base_health + self.potions * (self.base_health // 2)
+        self.enemy_total = sum(self.max_health)
+
+        self.state = (player.health, player.defense, player.level, player.experience, player.potions,
+                      0, enemy.health, False)
+        # Positions mean the same thing under every root with the same key
+        self.key = (self.kinds, self.max_health, self.health[1:], self.attack, self.defense,
+                    self.experience, self.stunned[1:], self.more_enemies, self.base_health,
+                    self.base_attack, self.potions, self.stun_chance, self.crushing_multiplier,
+                    self.level_up_factor)
+
+
+class SearchAI:
+    # budget is the time per decision in seconds, or None to always search
+    # max_depth rounds deep. skill is the chance to search at all instead of
+    # flipping the regular coin with attack_chance.
+    def __init__(self, budget=0.005, max_depth=4, skill=1.0, seed=None, attack_chance=0.7):
+        self.budget = budget
+        self.max_depth = max_depth
+        self.skill = skill
+        self.rng = random.Random(seed)
+        self.attack_chance = attack_chance
+        self.table = {}
+        self.table_key = None
+        self.root = None
+        self.deadline = None
+        self.nodes = 0
+        self.decisions = 0
+        self.depth_total = 0
+        self.lookups = 0
+        self.hits = 0
+
+    # The enemy's move for a running battle, or None if the enemy about to
+    # act has no choice to make
+    def choose(self, engine):
+        root = self.snapshot(engine)
+        return self.best_action(root) if root is not None else None
+
+    def snapshot(self, engine):
+        if engine.state != "battle" or engine.player_turn:
+            return None
+        index = engine.acting_index()
+        if index is None or engine.enemies[index].stunned:
+            return None
+        return SearchRoot(engine, self.max_depth)
+
+    # Iterative deepening: the first round is always searched in full, deeper
+    # ones only while the budget lasts
+    def best_action(self, root):
+        if self.skill < 1 and self.rng.random() >= self.skill:
+            return "attack" if self.rng.random() < self.attack_chance else "special"
+        if root.key != self.table_key or len(self.table) > MAX_TABLE_ENTRIES:
+            self.table = {}
+            self.table_key = root.key
+        self.root = root
+        self.deadline = None
+        start = time.perf_counter()
+
+        best_action = None
+        depth = 0
+        for depth in range(1, self.max_depth + 1):
+            try:
+                action, value = self.search(root.state, depth)
+            except SearchTimeout:
+                depth -= 1
+                break
+            best_action = action
+            if self.budget is not None:
+                self.deadline = start + self.budget
+            # A forced win or loss will not change with more depth
+            if value >= WIN or value <= LOSS:
+                break
+
+        self.decisions += 1
+        self.depth_total += depth
+        return best_action
+
+    # Best enemy move at the root and its value
+    def search(self, state, depth):
+        values = {action: self.action_value(state, action, depth) for action in ("attack", "special")}
+        best = max(values, key=values.get)
+        return best, values[best]
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes % CHECK_INTERVAL == 0 and self.deadline is not None:
+            if time.perf_counter() > self.deadline:
+                raise SearchTimeout
+            # Let the game's thread have the interpreter between checks
+            time.sleep(0)
+
+    # Heuristic value of a position for the enemies: the share of their full
+    # health they have left, less the share of a fresh player's health and
+    # potions the player has left
+    def evaluate(self, state):
+        health, _, level, _, potions, position, enemy_health, _ = state
+        root = self.root
+        player = (health + potions * ((root.base_health + 5 * level) // 2)) / root.player_total
+        enemies = (enemy_health + root.remaining[position + 1]) / root.enemy_total
+        return enemies - player
+
+    # Value of a position at the start of an enemy turn
+    def enemy_value(self, state, depth):
+        if depth == 0:
+            return self.evaluate(state)
+        self.lookups += 1
+        entry = self.table.get(state)
+        if entry is not None and entry[0] >= depth:
+            self.hits += 1
+            return entry[1]
+        self.tick()
+
+        health, defense, level, experience, potions, position, enemy_health, stunned = state
+        if stunned:
+            value = self.player_value((health, defense, level, experience, potions,
+                                       position, enemy_health, False), depth - 1)
+        else:
+            value = max(self.action_value(state, "attack", depth), self.action_value(state, "special", depth))
+        self.table[state] = (depth, value)
+        return value
+
+    # Expected value of an enemy move over its random outcomes
+    def action_value(self, state, action, depth):
+        health, defense, level, experience, potions, position, enemy_health, _ = state
+        root = self.root
+        attack = root.attack[position]
+
+        if action == "attack":
+            base = max(1, attack - defense // 2)
+            total = 0.0
+            for jitter in JITTERS:
+                total += self.after_enemy(state, max(1, base + jitter), defense, enemy_health, depth)
+            return total / len(JITTERS)
+
+        kind = root.kinds[position]
+        if kind == "goblin":
+            damage = max(1, attack // 2 - defense // 4)
+            return sum(self.after_enemy(state, hits * damage, defense, enemy_health, depth)
+                       for hits in range(2, 5)) / 3
+        if kind == "orc":
+            damage = max(1, int(attack * root.crushing_multiplier - defense // 4))
+            return self.after_enemy(state, damage, max(0, defense - 2), enemy_health, depth)
+        if kind == "elf":
+            damage = max(1, attack - defense // 3)
+            healed = min(root.max_health[position], enemy_health + damage // 2)
+            return self.after_enemy(state, damage, defense, healed, depth)
+        # Enemies with no special of their own only attack
+        return self.action_value(state, "attack", depth)
+
+    def after_enemy(self, state, damage, defense, enemy_health, depth):
+        health, _, level, experience, potions, position, _, stunned = state
+        health -= damage
+        if health <= 0:
+            return WIN
+        return self.player_value((health, defense, level, experience, potions,
+                                  position, enemy_health, stunned), depth - 1)
+
+    # Value of a position at the start of the player's turn, who is assumed
+    # to answer with the move that is worst for the enemies
+    def player_value(self, state, depth):
+        health, defense, level, experience, potions, position, enemy_health, stunned = state
+        root = self.root
+        attack = root.base_attack + 2 * level
+        enemy_defense = root.defense[position]
+
+        base = max(1, attack - enemy_defense // 2)
+        total = 0.0
+        for jitter in JITTERS:
+            total += self.after_player(state, max(1, base + jitter), False, depth)
+        value = total / len(JITTERS)
+
+        damage = max(1, attack * 2 - enemy_defense // 3)
+        stun_chance = root.stun_chance
+        special = (stun_chance * self.after_player(state, damage, True, depth)
+                   + (1 - stun_chance) * self.after_player(state, damage, False, depth))
+        value = min(value, special)
+
+        if potions > 0:
+            max_health = root.base_health + 5 * level
+            value = min(value, self.enemy_value((min(max_health, health + max_health // 2), defense, level,
+                                                 experience, potions - 1, position, enemy_health, stunned),
+                                                depth))
+        return value
+
+    def after_player(self, state, damage, stun, depth):
+        health, defense, level, experience, potions, position, enemy_health, stunned = state
+        enemy_health -= damage
+        if enemy_health > 0:
+            return self.enemy_value((health, defense, level, experience, potions,
+                                     position, enemy_health, stunned or stun), depth)
+
+        # Kill: gain experience and possibly a level, then face the next enemy
+        root = self.root
+        experience += root.experience[position]
+        if experience >= level * root.level_up_factor:
+            level += 1
+            health = root.base_health + 5 * level
+            defense += 1
+        position += 1
+        if position == len(root.order):
+            if not root.more_enemies:
+                return LOSS
+            return self.evaluate((health, defense, level, experience, potions, position - 1, 0, False))
+        return self.enemy_value((health, defense, level, experience, potions,
+                                 position, root.health[position], root.stunned[position]), depth)
+
+
+# Battles of the default player policy against an enemy AI, or against the
+# coin flip with ai=None. Every search is timed on this thread.
+def play(battles, seed, ai, endless=False):
+    wins = 0
+    turns = 0
+    waves = 0
+    times = []
+    for battle in range(battles):
+        engine = BattleEngine(seed + battle, endless=endless)
+        while engine.state == "battle" and engine.turns < 1000:
+            if engine.player_turn:
+                engine.player_action(default_policy(engine))
+                continue
+            choice = None
+            if ai is not None:
+                start = time.perf_counter()
+                choice = ai.choose(engine)
+                times.append(time.perf_counter() - start)
+            engine.enemy_turn(choice)
+        wins += engine.state == "victory"
+        turns += engine.turns
+        waves += engine.wave
+    return wins, turns, waves, times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play the default player against the enemy AI")
+    parser.add_argument("-n", "--battles", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--endless", action="store_true", help="count the waves survived in endless mode")
+    parser.add_argument("difficulty", nargs="*", help="difficulty levels to play against (default: all)")
+    args = parser.parse_args(argv)
+    for name in args.difficulty:
+        if name not in DIFFICULTIES:
+            parser.error(f"unknown difficulty {name!r} (choose from {', '.join(DIFFICULTIES)})")
+
+    print(f"Default player policy, {args.battles} battles from seed {args.seed}")
+    for name in ["coin flip"] + (args.difficulty or list(DIFFICULTIES)):
+        ai = SearchAI(*DIFFICULTIES[name], seed=args.seed) if name in DIFFICULTIES else None
+        wins, turns, waves, times = play(args.battles, args.seed, ai, args.endless)
+        if args.endless:
+            line = f"  {name:<10} {waves / args.battles:5.2f} waves survived"
+        else:
+            line = f"  {name:<10} player wins {wins / args.battles * 100:5.1f}%, {turns / args.battles:5.1f} turns"
+        if times:
+            times.sort()
+            line += (f", search mean {sum(times) / len(times) * 1000:5.2f} ms, "
+                     f"max {times[-1] * 1000:5.2f} ms, depth {ai.depth_total / max(ai.decisions, 1):4.1f}, "
+                     f"table hits {ai.hits / max(ai.lookups, 1) * 100:4.1f}%")
+        print(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import pygame
+
+import pixel_cache
+
+# Build-time texture atlas for the sprites in the images folder. Every PNG
+# with per-pixel alpha (character frames and effects) is packed into one or a
+# few sheets, written next to the sources as atlas0.bmp, atlas1.bmp, ... with
+# an atlas.json index. At runtime the asset cache loads the sheets once and
+# hands out subsurfaces instead of opening and decoding a file per sprite.
+# Opaque images such as the backgrounds are left out; they are scaled to the
+# window and cached separately.
+#
+# Sheets are stored as uncompressed 32-bit BMPs. Decoding a PNG costs about
+# the same per pixel whether it holds one sprite or all of them, so a PNG
+# sheet would save file opens but not decode time; a BMP loads at memory
+# copy speed.
+#
+# The index records each source file's size and modification time, so a
+# sprite edited after the atlas was built is loaded from its own file until
+# the atlas is rebuilt with: python atlas.py
+
+INDEX_FILE = "atlas.json"
+SHEET_PREFIX = "atlas"
+SHEET_EXTENSION = ".bmp"
+INDEX_VERSION = 1
+MAX_SHEET_SIZE = 4096
+PADDING = 1
+
+
+def file_names(folder, extension):
+    return sorted(name for name, ext in map(os.path.splitext, os.listdir(folder)) if ext == extension)
+
+
+def sheet_path(folder, sheet_name):
+    return os.path.join(folder, f"{sheet_name}{SHEET_EXTENSION}")
+
+
+def source_stamp(folder, name):
+    stat = os.stat(os.path.join(folder, f"{name}.png"))
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Shelf packing: sprites sorted by height fill rows left to right, and a new
+# sheet is started when the next row would not fit. Returns one list of
+# (name, x, y) per sheet together with the size of each sheet.
+def shelf_pack(sizes, sheet_width, max_size, padding):
+    order = sorted(sizes, key=lambda name: (-sizes[name][1], -sizes[name][0], name))
+    sheets = []
+    sheet_sizes = []
+    placements = None
+    x = y = shelf_height = used_width = 0
+
+    for name in order:
+        width, height = sizes[name]
+        if placements is not None and x + width + padding > sheet_width:
+            x = 0
+            y += shelf_height
+            shelf_height = 0
+        if placements is None or y + height + padding > max_size:
+            if placements is not None:
+                sheet_sizes.append((used_width, y + shelf_height))
+            placements = []
+            sheets.append(placements)
+            x = y = shelf_height = used_width = 0
+
+        placements.append((name, x, y))
+        x += width + padding
+        shelf_height = max(shelf_height, height + padding)
+        used_width = max(used_width, x)
+
+    if placements is not None:
+        sheet_sizes.append((used_width, y + shelf_height))
+    return sheets, sheet_sizes
+
+
+# Shelf packing at the sheet width that wastes the fewest pixels
+def pack(sizes, max_size=MAX_SHEET_SIZE, padding=PADDING):
+    for name, (width, height) in sizes.items():
+        if width + padding > max_size or height + padding > max_size:
+            raise ValueError(f"{name} ({width}x{height}) does not fit in a {max_size}x{max_size} sheet")
+
+    narrowest = max((width + padding for width, _ in sizes.values()), default=1)
+    best = None
+    for sheet_width in range(narrowest, max_size + 1, 16):
+        sheets, sheet_sizes = shelf_pack(sizes, sheet_width, max_size, padding)
+        area = sum(width * height for width, height in sheet_sizes)
+        if best is None or (area, len(sheets)) < best[0]:
+            best = ((area, len(sheets)), sheets, sheet_sizes)
+    return best[1], best[2]
+
+
+def build(folder="images"):
+    images = {}
+    for name in file_names(folder, ".png"):
+        image = pygame.image.load(os.path.join(folder, f"{name}.png"))
+        if image.get_flags() & pygame.SRCALPHA:
+            images[name] = image
+
+    sheets, sheet_sizes = pack({name: image.get_size() for name, image in images.items()})
+
+    # Remove sheets left over from a larger previous build
+    for name in file_names(folder, SHEET_EXTENSION):
+        suffix = name[len(SHEET_PREFIX):]
+        if name.startswith(SHEET_PREFIX) and suffix.isdigit() and int(suffix) >= len(sheets):
+            os.remove(sheet_path(folder, name))
+
+    index = {"version": INDEX_VERSION, "sheets": [], "sprites": {}}
+    for sheet_index, (placements, size) in enumerate(zip(sheets, sheet_sizes)):
+        sheet_name = f"{SHEET_PREFIX}{sheet_index}"
+        sheet = pygame.Surface(size, pygame.SRCALPHA)
+        sheet.fill((0, 0, 0, 0))
+        for name, x, y in placements:
+            # Adding onto the cleared sheet copies the pixels, alpha included,
+            # where a normal blit would blend them
+            sheet.blit(images[name], (x, y), special_flags=pygame.BLEND_RGBA_ADD)
+            index["sprites"][name] = {
+                "sheet": sheet_index,
+                "rect": [x, y, *images[name].get_size()],
+                "source": source_stamp(folder, name),
+            }
+        pygame.image.save(sheet, sheet_path(folder, sheet_name))
+        index["sheets"].append({"name": sheet_name, "size": list(size)})
+
+    with open(os.path.join(folder, INDEX_FILE), "w") as index_file:
+        json.dump(index, index_file, indent=1)
+    return index
+
+
+# The atlas index for a folder, or None if there is none or it is outdated
+def read_index(folder="images"):
+    try:
+        with open(os.path.join(folder, INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != INDEX_VERSION:
+        return None
+    return index
+
+
+# True if the sprite's source file is unchanged since the atlas was built
+def is_current(folder, name, entry):
+    try:
+        return source_stamp(folder, name) == entry["source"]
+    except OSError:
+        return False
+
+
+# Unconverted sheets of an atlas; safe to call from a loader thread
+def read_sheets(folder, index):
+    return [pygame.image.load(sheet_path(folder, sheet["name"])) for sheet in index["sheets"]]
+
+
+# Subsurfaces for every up-to-date sprite in the atlas, cut from sheets that
+# are converted to the display format once each
+def load_sprites(folder, index, raw_sheets=None):
+    if raw_sheets is None:
+        raw_sheets = read_sheets(folder, index)
+    sheets = [sheet.convert_alpha() for sheet in raw_sheets]
+    sprites = {}
+    for name, entry in index["sprites"].items():
+        if is_current(folder, name, entry):
+            sprites[name] = sheets[entry["sheet"]].subsurface(entry["rect"])
+    return sprites
+
+
+# Startup cost of getting every atlas sprite ready to blit, loading the PNGs
+# one by one versus cutting them from the atlas sheets
+def benchmark(folder, repeats):
+    index = read_index(folder)
+    if index is None:
+        print("No atlas found, building it first")
+        index = build(folder)
+    names = list(index["sprites"])
+
+    def load_separately():
+        return {name: pygame.image.load(os.path.join(folder, f"{name}.png")).convert_alpha() for name in names}
+
+    def load_atlas():
+        return load_sprites(folder, read_index(folder))
+
+    separate_bytes = sum(os.path.getsize(os.path.join(folder, f"{name}.png")) for name in names)
+    sheet_bytes = sum(os.path.getsize(sheet_path(folder, sheet["name"])) for sheet in index["sheets"])
+
+    print(f"{len(names)} sprites, {len(index['sheets'])} sheet(s), {repeats} runs each")
+    for label, loader, files, size in (("separate PNGs", load_separately, len(names), separate_bytes),
+                                       ("atlas", load_atlas, len(index["sheets"]) + 1, sheet_bytes)):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            loader()
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"  {label:<14} median {statistics.median(timings):7.1f} ms, min {min(timings):7.1f} ms, "
+              f"{files:>3} files opened, {size / 1024:7.0f} KiB read")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack the sprites in the images folder into a texture atlas")
+    parser.add_argument("--folder", default="images")
+    parser.add_argument("--bench", action="store_true",
+                        help="compare the startup cost of separate PNGs and the atlas")
+    parser.add_argument("-r", "--repeats", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.bench:
+        pixel_cache.hidden_display((1, 1))
+        benchmark(args.folder, args.repeats)
+        return
+
+    start = time.perf_counter()
+    index = build(args.folder)
+    elapsed = time.perf_counter() - start
+    for sheet in index["sheets"]:
+        width, height = sheet["size"]
+        print(f"{sheet['name']}{SHEET_EXTENSION}: {width}x{height}")
+    print(f"Packed {len(index['sprites'])} sprites into {len(index['sheets'])} sheet(s) in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from combat import DEFAULT_RULES, ENEMY_ROSTER
+
+# Monte Carlo balancing: N independent battles advance in lockstep as NumPy
+# arrays, one lane per battle. The rules mirror combat.py (with the same
+# potion-when-low player policy as combat.default_policy), but draw from a
+# NumPy generator, so results agree with combat.simulate statistically
+# rather than battle by battle. Stats and tunables come from a combat.Rules,
+# so a balance change made there reaches the batch simulator too.
+
+ENEMY_KINDS = [kind for _, kind in ENEMY_ROSTER]
+
+
+class BatchBattle:
+    def __init__(self, lanes, rng, special_rate=0.0, rules=DEFAULT_RULES):
+        self.lanes = lanes
+        self.rng = rng
+        self.special_rate = special_rate
+        self.rules = rules
+        self.index = np.arange(lanes)
+
+        stats = rules.stats
+        self.enemy_max_health = np.array([stats[kind][0] for kind in ENEMY_KINDS])
+        self.enemy_attack = np.array([stats[kind][1] for kind in ENEMY_KINDS])
+        self.enemy_defense = np.array([stats[kind][2] for kind in ENEMY_KINDS])
+
+        health, attack, defense = stats["player"]
+        self.health = np.full(lanes, health)
+        self.max_health = np.full(lanes, health)
+        self.attack = np.full(lanes, attack)
+        self.defense = np.full(lanes, defense)
+        self.level = np.ones(lanes, dtype=np.int64)
+        self.experience = np.zeros(lanes, dtype=np.int64)
+        self.potions = np.full(lanes, rules.potions)
+
+        self.enemy = np.zeros(lanes, dtype=np.int64)
+        self.enemy_health = np.tile(self.enemy_max_health, (lanes, 1))
+        self.enemy_stunned = np.zeros((lanes, len(ENEMY_KINDS)), dtype=bool)
+
+        self.done = np.zeros(lanes, dtype=bool)
+        self.won = np.zeros(lanes, dtype=bool)
+        self.turns = np.zeros(lanes, dtype=np.int64)
+        self.damage_dealt = np.zeros(lanes, dtype=np.int64)
+        self.damage_taken = np.zeros(lanes, dtype=np.int64)
+
+    def player_phase(self):
+        lanes = np.flatnonzero(~self.done)
+        if lanes.size == 0:
+            return
+
+        # Drink a potion when low, otherwise attack or use the special
+        drink = (self.potions[lanes] > 0) & (self.health[lanes] <= self.max_health[lanes] // 3)
+        special = ~drink & (self.rng.random(lanes.size) < self.special_rate)
+        strike = ~drink & ~special
+
+        drinkers = lanes[drink]
+        self.potions[drinkers] -= 1
+        self.health[drinkers] = np.minimum(self.max_health[drinkers],
+                                           self.health[drinkers] + self.max_health[drinkers] // 2)
+
+        enemy = self.enemy[lanes]
+        enemy_defense = self.enemy_defense[enemy]
+        damage = np.zeros(lanes.size, dtype=np.int64)
+
+        jitter = self.rng.integers(-2, 3, lanes.size)
+        normal = np.maximum(1, self.attack[lanes] - enemy_defense // 2)
+        damage[strike] = np.maximum(1, normal + jitter)[strike]
+
+        critical = np.maximum(1, self.attack[lanes] * 2 - enemy_defense // 3)
+        damage[special] = critical[special]
+        stun = special & (self.rng.random(lanes.size) < self.rules.stun_chance)
+        self.enemy_stunned[lanes[stun], enemy[stun]] = True
+
+        self.enemy_health[lanes, enemy] -= damage
+        self.damage_dealt[lanes] += damage
+
+        # Kills give experience and may level the player up
+        killed = (damage > 0) & (self.enemy_health[lanes, enemy] <= 0)
+        killers = lanes[killed]
+        self.enemy_health[killers, enemy[killed]] = 0
+        self.experience[killers] += 10
+        levelled = killers[self.experience[killers] >= self.level[killers] * self.rules.level_up_factor]
+        self.level[levelled] += 1
+        self.max_health[levelled] += 5
+        self.health[levelled] = self.max_health[levelled]
+        self.attack[levelled] += 2
+        self.defense[levelled] += 1
+
+        victory = killers[(self.enemy_health[killers] <= 0).all(axis=1)]
+        self.won[victory] = True
+        self.done[victory] = True
+        self.turns[lanes] += 1
+
+    def enemy_phase(self):
+        lanes = np.flatnonzero(~self.done)
+        if lanes.size == 0:
+            return
+
+        # A dead current enemy is replaced by the first one still standing
+        alive = self.enemy_health[lanes] > 0
+        self.enemy[lanes] = np.argmax(alive, axis=1)
+        enemy = self.enemy[lanes]
+
+        stunned = self.enemy_stunned[lanes, enemy]
+        self.enemy_stunned[lanes[stunned], enemy[stunned]] = False
+
+        defense = self.defense[lanes]
+        roll = self.rng.random(lanes.size)
+        normal = ~stunned & (roll < self.rules.enemy_attack_chance)
+        special = ~stunned & ~normal
+        damage = np.zeros(lanes.size, dtype=np.int64)
+
+        jitter = self.rng.integers(-2, 3, lanes.size)
+        base = np.maximum(1, self.enemy_attack[enemy] - defense // 2)
+        damage[normal] = np.maximum(1, base + jitter)[normal]
+
+        hits = self.rng.integers(2, 5, lanes.size)
+        for kind_index, kind in enumerate(ENEMY_KINDS):
+            mask = special & (enemy == kind_index)
+            if not mask.any():
+                continue
+            attack = self.enemy_attack[kind_index]
+            if kind == "goblin":
+                damage[mask] = hits[mask] * np.maximum(1, attack // 2 - defense[mask] // 4)
+            elif kind == "orc":
+                crushing = attack * self.rules.crushing_multiplier - defense[mask] // 4
+                damage[mask] = np.maximum(1, crushing.astype(np.int64))
+                self.defense[lanes[mask]] = np.maximum(0, defense[mask] - 2)
+            elif kind == "elf":
+                damage[mask] = np.maximum(1, attack - defense[mask] // 3)
+                healers = lanes[mask]
+                self.enemy_health[healers, kind_index] = np.minimum(
+                    self.enemy_max_health[kind_index], self.enemy_health[healers, kind_index] + damage[mask] // 2)
+
+        self.health[lanes] -= damage
+        self.damage_taken[lanes] += damage
+
+        dead = lanes[self.health[lanes] <= 0]
+        self.health[dead] = 0
+        self.done[dead] = True
+        self.turns[lanes] += 1
+
+    def run(self, max_turns=1000):
+        while not self.done.all() and self.turns.max() < max_turns:
+            self.player_phase()
+            self.enemy_phase()
+        return self
+
+
+def simulate_batch(battles, seed=0, special_rate=0.0, chunk_size=250000, rules=DEFAULT_RULES):
+    rng = np.random.default_rng(seed)
+    results = {"won": [], "turns": [], "damage_dealt": [], "damage_taken": []}
+    remaining = battles
+    while remaining > 0:
+        lanes = min(chunk_size, remaining)
+        batch = BatchBattle(lanes, rng, special_rate, rules).run()
+        for key in results:
+            results[key].append(getattr(batch, key))
+        remaining -= lanes
+    return {key: np.concatenate(values) for key, values in results.items()}
+
+
+def print_histogram(title, values, bins=12, width=40):
+    counts, edges = np.histogram(values, bins=bins)
+    peak = counts.max() or 1
+    print(title)
+    for count, low, high in zip(counts, edges, edges[1:]):
+        bar = "#" * int(count / peak * width)
+        print(f"  {low:6.0f}-{high:<6.0f} {count:>9} {bar}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vectorized Monte Carlo battle simulator")
+    parser.add_argument("-n", "--battles", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--special-rate", type=float, default=0.0,
+                        help="chance that the player uses the special instead of attacking")
+    parser.add_argument("--chunk-size", type=int, default=250000)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = simulate_batch(args.battles, args.seed, args.special_rate, args.chunk_size)
+    elapsed = time.perf_counter() - start
+
+    won = results["won"]
+    turns = results["turns"]
+    print(f"Battles: {args.battles} in {elapsed:.2f}s ({elapsed / args.battles * 1e6:.2f} us per battle)")
+    print(f"Win rate: {won.mean() * 100:.2f}%")
+    print(f"Turns: mean {turns.mean():.1f}, p50 {np.percentile(turns, 50):.0f}, "
+          f"p95 {np.percentile(turns, 95):.0f}, max {turns.max()}")
+    print_histogram("Turn count distribution", turns)
+    print_histogram("Damage dealt per battle", results["damage_dealt"])
+    print_histogram("Damage taken per battle", results["damage_taken"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,393 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import statistics
+import tracemalloc
+
+# Headless benchmarks of the game's scenes. Each scenario sets up a Battle
+# under SDL's dummy video driver and replays a scripted input sequence
+# through Battle.frame, the same code path as the game loop, with a fixed
+# simulation step per frame and no frame cap or idle sleeping. Frame times
+# and per-frame allocations are measured in separate passes, since
+# tracemalloc slows every allocation down. Startup is timed in fresh
+# processes, and a long endless battle checks that waves of enemies are
+# recycled through the pools and memory stays flat.
+#
+# Results are written as JSON. Given a baseline (an earlier results file),
+# every metric is compared against it and the run fails if one got worse by
+# more than its threshold:
+#
+#   python bench.py -o baseline.json
+#   python bench.py --baseline baseline.json --threshold p95_ms=0.1
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+import lab
+from ai import DIFFICULTIES, SearchAI
+from combat import BASE_STATS, Event, Rules, arena_roster
+
+# Folder of the game, where the startup script imports it from and loads
+# the images, wherever bench.py is run from
+GAME_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import lab
+lab.init_display()
+lab.Battle(seed=0)
+print((time.perf_counter() - start) * 1000)
+"""
+
+# Allowed slowdown of each metric against the baseline, as a fraction
+THRESHOLDS = {
+    "mean_ms": 0.15,
+    "p50_ms": 0.15,
+    "p95_ms": 0.25,
+    "p99_ms": 0.50,
+    "alloc_mean_kib": 0.25,
+    "alloc_peak_kib": 0.50,
+    "alloc_growth_kib": 0.50,
+    "startup_ms": 0.30,
+    "ready_ms": 0.30,
+    "wave_growth_kib": 0.50,
+}
+
+ARENA_SIZE = 300
+
+# Differences below these are noise whatever the threshold says, e.g. on a
+# scene that takes a few microseconds per frame
+ABSOLUTE_SLACK = {"ms": 0.05, "kib": 4.0}
+
+# Memory an endless battle may gain past the warmup, checked with or without
+# a baseline: a one-off allowance (text cache entries, dict resizes) plus a
+# few bytes per wave, well below what keeping one object per wave would take
+WAVE_GROWTH_SLACK_KIB = 16.0
+MAX_WAVE_GROWTH_BYTES = 8
+
+
+# Scenarios: a setup run once on a fresh Battle and a script run before
+# every frame with the frame number
+
+def menu_idle_setup(game):
+    game.game_state = "main_menu"
+
+
+# The menu only redraws after window events, here about once a second
+def menu_idle_script(game, frame):
+    if frame % 60 == 0:
+        pygame.event.post(pygame.event.Event(pygame.WINDOWEXPOSED))
+
+
+def battle_setup(game):
+    game.game_state = "battle"
+
+
+# Attack as soon as the player may act, starting over when the battle ends
+def attack_spam_script(game, frame):
+    if game.game_state != "battle":
+        game.reset_game()
+        game.game_state = "battle"
+    if game.player_turn and not game.player.animating and not game.current_enemy.animating:
+        game.player_action("attack")
+
+
+def all_dead_setup(game):
+    game.game_state = "battle"
+    for fighter in game.engine.enemies:
+        fighter.health = 0
+        fighter.is_alive = False
+
+
+# Cycle through the dead enemies with a death burst on each
+def all_dead_script(game, frame):
+    if frame % 30 == 0:
+        enemies = game.engine.enemies
+        game.engine.current_enemy = enemies[frame // 30 % len(enemies)]
+        name = game.engine.current_enemy.name
+        game.play_events([Event("death", name, name)])
+
+
+def arena_setup(game):
+    game.arena = ARENA_SIZE
+    game.engine.roster = arena_roster(ARENA_SIZE)
+    game.engine.reset()
+    game.create_characters()
+    game.game_state = "battle"
+
+
+# The hardest enemy AI searching on its worker thread while frames are drawn
+def ai_setup(game):
+    battle_setup(game)
+    game.enemy_ai = SearchAI(*DIFFICULTIES["hard"], seed=0)
+
+
+def endless_setup(game):
+    game.endless = game.engine.endless = True
+    game.engine.reset()
+    game.create_characters()
+    game.game_state = "battle"
+
+
+def heal_bursts_script(game, frame):
+    if frame % 15 == 0:
+        name = game.engine.player.name
+        game.play_events([Event("heal", name, name, 30, game.engine.player.potions)])
+
+
+SCENARIOS = {
+    "menu_idle": (menu_idle_setup, menu_idle_script),
+    "attack_spam": (battle_setup, attack_spam_script),
+    "all_dead": (all_dead_setup, all_dead_script),
+    "heal_bursts": (battle_setup, heal_bursts_script),
+    "arena_spam": (arena_setup, attack_spam_script),
+    "endless_spam": (endless_setup, attack_spam_script),
+    "ai_hard_spam": (ai_setup, attack_spam_script),
+}
+
+
+def new_game(setup):
+    game = lab.Battle(seed=0)
+    setup(game)
+    pygame.event.clear()
+    return game
+
+
+def percentile(ordered, point):
+    last = len(ordered) - 1
+    return ordered[min(last, int(last * point / 100 + 0.5))]
+
+
+# Frame times of a scenario in milliseconds over all iterations
+def time_frames(setup, script, frames, warmup, iterations):
+    times = []
+    for _ in range(iterations):
+        game = new_game(setup)
+        for frame in range(warmup + frames):
+            script(game, frame)
+            start = time.perf_counter_ns()
+            game.frame(frame_time=lab.SIM_STEP, wait=False)
+            if frame >= warmup:
+                times.append((time.perf_counter_ns() - start) / 1e6)
+    times.sort()
+    return {
+        "mean_ms": statistics.fmean(times),
+        "p50_ms": percentile(times, 50),
+        "p95_ms": percentile(times, 95),
+        "p99_ms": percentile(times, 99),
+    }
+
+
+# Memory allocated within each frame (its tracemalloc peak above what was
+# allocated before it) and what the run kept allocated at the end, in KiB
+def trace_allocations(setup, script, frames, warmup):
+    game = new_game(setup)
+    for frame in range(warmup):
+        script(game, frame)
+        game.frame(frame_time=lab.SIM_STEP, wait=False)
+
+    per_frame = []
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        for frame in range(warmup, warmup + frames):
+            script(game, frame)
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            game.frame(frame_time=lab.SIM_STEP, wait=False)
+            _, peak = tracemalloc.get_traced_memory()
+            per_frame.append((peak - before) / 1024)
+        end_size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "alloc_mean_kib": statistics.fmean(per_frame),
+        "alloc_peak_kib": max(per_frame),
+        "alloc_growth_kib": (end_size - start_size) / 1024,
+    }
+
+
+# An endless battle that the player cannot lose, played through the game's
+# simulation without drawing. Reports how much more memory was allocated
+# after the last wave than after the warmup waves, and how many fighters and
+# characters were built after the warmup; those should all come from the
+# pools.
+def wave_memory(waves, warmup):
+    game = lab.Battle(seed=0, endless=True)
+    engine = game.engine
+    engine.rules = Rules(stats={**BASE_STATS, "player": (10 ** 9, 10 ** 100, 10 ** 100)})
+    engine.reset()
+    game.create_characters()
+    game.game_state = "battle"
+
+    def play_waves(count):
+        last = engine.wave + count
+        while engine.wave < last:
+            if game.player_turn and not game.player.animating and not game.current_enemy.animating:
+                game.player_action("attack")
+            game.advance(lab.MAX_FRAME_TIME)
+
+    play_waves(warmup)
+    fighters = engine.pool.created
+    characters = game.character_pool.created
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        play_waves(waves)
+        end_size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "waves": waves,
+        "wave_growth_kib": (end_size - start_size) / 1024,
+        "wave_peak_kib": (peak - start_size) / 1024,
+        "fighters_created": engine.pool.created - fighters,
+        "characters_created": game.character_pool.created - characters,
+    }
+
+
+# Median time from a fresh interpreter to a Battle ready to draw, with every
+# image loaded up front. One discarded run warms the asset caches first.
+def time_startup(runs):
+    timings = []
+    for run in range(runs + 1):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, GAME_FOLDER], env=os.environ,
+                                cwd=GAME_FOLDER, capture_output=True, text=True, check=True).stdout
+        elapsed = (time.perf_counter() - start) * 1000
+        if run:
+            timings.append({"startup_ms": elapsed, "ready_ms": float(output.split()[-1])})
+    return {name: statistics.median(timing[name] for timing in timings) for name in timings[0]}
+
+
+def run_benchmarks(names, frames, warmup, iterations, startup_runs, waves):
+    lab.init_display()
+    results = {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "frames": frames,
+        "iterations": iterations,
+        "scenarios": {},
+    }
+    for name in names:
+        setup, script = SCENARIOS[name]
+        metrics = time_frames(setup, script, frames, warmup, iterations)
+        metrics.update(trace_allocations(setup, script, frames, warmup))
+        results["scenarios"][name] = metrics
+        print(f"{name:<12} mean {metrics['mean_ms']:6.3f} ms  p95 {metrics['p95_ms']:6.3f} ms  "
+              f"p99 {metrics['p99_ms']:6.3f} ms  alloc {metrics['alloc_mean_kib']:7.1f} KiB/frame  "
+              f"peak {metrics['alloc_peak_kib']:7.1f} KiB  growth {metrics['alloc_growth_kib']:7.1f} KiB")
+    if waves:
+        results["endless"] = wave_memory(waves, warmup=50)
+        endless = results["endless"]
+        print(f"{'endless':<12} {waves} waves: memory {endless['wave_growth_kib']:+.1f} KiB "
+              f"(peak {endless['wave_peak_kib']:.1f} KiB), {endless['fighters_created']} fighters and "
+              f"{endless['characters_created']} characters built after the warmup")
+    if startup_runs:
+        results["startup"] = time_startup(startup_runs)
+        print(f"{'startup':<12} {results['startup']['startup_ms']:6.1f} ms to a ready Battle, "
+              f"{results['startup']['ready_ms']:6.1f} ms of it after the interpreter started")
+    return results
+
+
+# Metrics that got worse than the baseline by more than their threshold
+def compare(results, baseline, thresholds):
+    groups = dict(results["scenarios"])
+    baseline_groups = dict(baseline.get("scenarios", {}))
+    for group in ("startup", "endless"):
+        if group in results and group in baseline:
+            groups[group] = results[group]
+            baseline_groups[group] = baseline[group]
+
+    regressions = []
+    for group, metrics in groups.items():
+        for metric, value in metrics.items():
+            old = baseline_groups.get(group, {}).get(metric)
+            if old is None or metric not in thresholds:
+                continue
+            slack = ABSOLUTE_SLACK["kib" if metric.endswith("_kib") else "ms"]
+            if value > old * (1 + thresholds[metric]) + slack:
+                regressions.append(f"{group}.{metric}: {old:.3f} -> {value:.3f} "
+                                   f"(+{(value - old) / max(old, 1e-9) * 100:.0f}%, "
+                                   f"allowed +{thresholds[metric] * 100:.0f}%)")
+    return regressions
+
+
+# Past the warmup every wave should be built from the pools without memory
+# growing, whatever the baseline says
+def check_endless(endless):
+    failures = []
+    for metric in ("fighters_created", "characters_created"):
+        if endless[metric]:
+            failures.append(f"endless.{metric}: {endless[metric]} after the warmup, expected 0")
+    limit = WAVE_GROWTH_SLACK_KIB + endless["waves"] * MAX_WAVE_GROWTH_BYTES / 1024
+    if endless["wave_growth_kib"] > limit:
+        failures.append(f"endless.wave_growth_kib: {endless['wave_growth_kib']:.1f} over {endless['waves']} waves, "
+                        f"allowed {limit:.1f}")
+    return failures
+
+
+def parse_threshold(text):
+    metric, _, fraction = text.partition("=")
+    if metric not in THRESHOLDS:
+        raise argparse.ArgumentTypeError(f"unknown metric {metric!r}, expected one of {', '.join(THRESHOLDS)}")
+    try:
+        return metric, float(fraction)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected {metric}=FRACTION, got {text!r}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the game's scenes headlessly")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("-n", "--frames", type=int, default=600, help="measured frames per iteration")
+    parser.add_argument("--warmup", type=int, default=60, help="frames run before measuring")
+    parser.add_argument("-i", "--iterations", type=int, default=5, help="timed runs of each scenario")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh processes to time startup in; 0 skips it")
+    parser.add_argument("--waves", type=int, default=500, help="endless waves to check memory over; 0 skips it")
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", type=parse_threshold, action="append", default=[],
+                        metavar="METRIC=FRACTION", help="allowed slowdown of a metric (repeatable)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    results = run_benchmarks(args.scenarios or list(SCENARIOS), args.frames, args.warmup, args.iterations,
+                             args.startup_runs, args.waves)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=1)
+    print(f"Wrote {args.output}")
+
+    failures = check_endless(results["endless"]) if "endless" in results else []
+    if failures:
+        print(f"{len(failures)} endless battle check(s) failed:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, {**THRESHOLDS, **dict(args.threshold)})
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,528 @@
+import random
+import sys
+import time
+import argparse
+from collections import namedtuple
+
+from eventlog import JsonlSink
+
+# Headless combat rules for Fantasy Battle Arena. Nothing in this module
+# touches pygame, so battles can be simulated by the million for balancing
+# and testing; lab.py only animates the events returned from here.
+
+# Base stats per character type: health, attack, defense
+BASE_STATS = {
+    "player": (25, 8, 5),
+    "goblin": (15, 5, 3),
+    "orc": (30, 7, 6),
+    "elf": (18, 6, 4),
+}
+
+PLAYER_NAME = "Hero"
+STARTING_POTIONS = 3
+
+# Enemies in the order they are faced
+ENEMY_ROSTER = [
+    ("Gobbly", "goblin"),
+    ("Grog", "orc"),
+    ("Elindril", "elf"),
+]
+
+# Tunable parameters of the combat rules. The defaults are the game as
+# shipped; balancing tools build variants of it to sweep over.
+class Rules:
+    def __init__(self, stats=None, potions=STARTING_POTIONS, stun_chance=0.3,
+                 crushing_multiplier=1.5, level_up_factor=20, enemy_attack_chance=0.7):
+        self.stats = dict(BASE_STATS if stats is None else stats)
+        self.potions = potions
+        self.stun_chance = stun_chance
+        self.crushing_multiplier = crushing_multiplier
+        self.level_up_factor = level_up_factor
+        self.enemy_attack_chance = enemy_attack_chance
+
+
+DEFAULT_RULES = Rules()
+
+# Structured result of a combat action. kind is one of attack, special, stun,
+# heal, level_up, death, skip, no_potions, enemy_switch or wave; ability
+# names the special move or "potion" for heals.
+Event = namedtuple("Event", "kind actor target amount value ability",
+                   defaults=(None, 0, 0, None))
+
+
+# Stat record of one combatant. With slots an arena of hundreds of enemies
+# takes a fraction of the memory of dict-backed instances.
+class Fighter:
+    __slots__ = ("name", "kind", "max_health", "health", "attack", "defense", "level", "experience",
+                 "is_alive", "stunned", "potions")
+
+    def __init__(self, name, kind, health, attack, defense, potions=0):
+        self.reset(name, kind, health, attack, defense, potions)
+
+    # Start over as a fresh fighter, so pooled fighters can be reused
+    def reset(self, name, kind, health, attack, defense, potions=0):
+        self.name = name
+        self.kind = kind
+        self.max_health = health
+        self.health = health
+        self.attack = attack
+        self.defense = defense
+        self.level = 1
+        self.experience = 0
+        self.is_alive = True
+        self.stunned = False
+        self.potions = potions
+
+
+# Enemies of an arena battle: count of them, cycling through the kinds of
+# the regular roster
+def arena_roster(count):
+    kinds = [kind for _, kind in ENEMY_ROSTER]
+    return [(f"{kinds[index % len(kinds)].title()} {index + 1}", kinds[index % len(kinds)])
+            for index in range(count)]
+
+
+def create_fighter(name, kind, rules=DEFAULT_RULES):
+    health, attack, defense = rules.stats[kind]
+    potions = rules.potions if kind == "player" else 0
+    return Fighter(name, kind, health, attack, defense, potions)
+
+
+# Free list of fighters that are out of the battle. created counts the
+# fighters ever built, which stops growing once the pool has warmed up.
+class FighterPool:
+    def __init__(self):
+        self.free = []
+        self.created = 0
+
+    def acquire(self, name, kind, health, attack, defense, potions=0):
+        if self.free:
+            fighter = self.free.pop()
+            fighter.reset(name, kind, health, attack, defense, potions)
+            return fighter
+        self.created += 1
+        return Fighter(name, kind, health, attack, defense, potions)
+
+    def release(self, fighters):
+        self.free.extend(fighters)
+
+
+# Endless mode: the waves grow by an enemy every few waves, up to a limit,
+# and enemy stats grow geometrically so that they outpace the player's
+# level-ups sooner or later
+FIRST_WAVE_SIZE = 2
+MAX_WAVE_SIZE = 6
+WAVE_STAT_GROWTH = 1.08  # Stat multiplier from one wave to the next
+WAVE_POTIONS = 1  # Potions handed out for clearing a wave
+
+
+# Procedural waves of scaled goblins, orcs and elves. Each wave is made
+# when the one before it starts, so the game is always one wave ahead and
+# never holds more than two.
+class WaveGenerator:
+    def __init__(self, seed, rules=DEFAULT_RULES):
+        self.rng = random.Random(seed)
+        self.rules = rules
+        self.kinds = [kind for _, kind in ENEMY_ROSTER]
+        self.number = 0
+        self.upcoming = self.generate(1)
+
+    # (name, kind, health, attack, defense) of each enemy of a wave
+    def generate(self, number):
+        size = min(MAX_WAVE_SIZE, FIRST_WAVE_SIZE + (number - 1) // 3)
+        scale = WAVE_STAT_GROWTH ** (number - 1)
+        wave = []
+        for index in range(size):
+            kind = self.rng.choice(self.kinds)
+            health, attack, defense = self.rules.stats[kind]
+            wave.append((f"{kind.title()} {number}-{index + 1}", kind, round(health * scale),
+                         round(attack * scale), round(defense * scale)))
+        return wave
+
+    # The next wave, generating the one after it
+    def next_wave(self):
+        wave = self.upcoming
+        self.number += 1
+        self.upcoming = self.generate(self.number + 1)
+        return wave
+
+
+def apply_damage(attacker, target, damage, events):
+    target.health -= damage
+    if target.health <= 0:
+        target.health = 0
+        target.is_alive = False
+        events.append(Event("death", attacker.name, target.name))
+        return True
+    return False
+
+
+def gain_experience(fighter, amount, events, rules=DEFAULT_RULES):
+    fighter.experience += amount
+    level_up_threshold = fighter.level * rules.level_up_factor
+
+    if fighter.experience >= level_up_threshold:
+        level_up(fighter)
+        events.append(Event("level_up", fighter.name, fighter.name, value=fighter.level))
+        return True
+    return False
+
+
+def level_up(fighter):
+    fighter.level += 1
+    fighter.max_health += 5
+    fighter.health = fighter.max_health
+    fighter.attack += 2
+    fighter.defense += 1
+
+
+def attack(attacker, target, rng, rules=DEFAULT_RULES):
+    if not attacker.is_alive or not target.is_alive:
+        return []
+
+    damage = max(1, attacker.attack - target.defense // 2)
+    damage += rng.randint(-2, 2)  # Add some randomness
+    damage = max(1, damage)  # Ensure at least 1 damage
+
+    events = [Event("attack", attacker.name, target.name, damage)]
+    if apply_damage(attacker, target, damage, events):
+        gain_experience(attacker, target.level * 10, events, rules)
+    return events
+
+
+def heal(fighter, amount, events, ability=None):
+    if not fighter.is_alive:
+        return 0
+
+    old_health = fighter.health
+    fighter.health = min(fighter.max_health, fighter.health + amount)
+    actual_heal = fighter.health - old_health
+    events.append(Event("heal", fighter.name, fighter.name, actual_heal, fighter.potions, ability))
+    return actual_heal
+
+
+def use_potion(fighter):
+    if not fighter.is_alive:
+        return []
+
+    if fighter.potions <= 0:
+        return [Event("no_potions", fighter.name, fighter.name)]
+
+    fighter.potions -= 1
+    events = []
+    heal(fighter, fighter.max_health // 2, events, ability="potion")
+    return events
+
+
+# Critical strike - double damage with a chance to stun
+def critical_strike(attacker, target, rng, rules):
+    damage = attacker.attack * 2 - target.defense // 3
+    damage = max(1, damage)
+    events = [Event("special", attacker.name, target.name, damage, ability="critical_strike")]
+
+    if rng.random() < rules.stun_chance:  # 30% chance to stun by default
+        target.stunned = True
+        events.append(Event("stun", attacker.name, target.name))
+
+    if apply_damage(attacker, target, damage, events):
+        gain_experience(attacker, target.level * 10, events, rules)
+    return events
+
+
+# Frenzy - multiple quick strikes
+def frenzy(attacker, target, rng, rules):
+    hits = rng.randint(2, 4)
+    damage = max(1, attacker.attack // 2 - target.defense // 4)
+    total_damage = hits * damage
+
+    events = [Event("special", attacker.name, target.name, total_damage, hits, "frenzy")]
+    apply_damage(attacker, target, total_damage, events)
+    return events
+
+
+# Crushing blow - high damage with defense reduction
+def crushing_blow(attacker, target, rng, rules):
+    damage = attacker.attack * rules.crushing_multiplier - target.defense // 4
+    damage = max(1, int(damage))
+
+    old_defense = target.defense
+    target.defense = max(0, target.defense - 2)
+    defense_reduction = old_defense - target.defense
+
+    events = [Event("special", attacker.name, target.name, damage, defense_reduction, "crushing_blow")]
+    apply_damage(attacker, target, damage, events)
+    return events
+
+
+# Nature's blessing - deal damage and heal self
+def natures_blessing(attacker, target, rng, rules):
+    damage = attacker.attack - target.defense // 3
+    damage = max(1, damage)
+
+    heal_amount = damage // 2
+    attacker.health = min(attacker.max_health, attacker.health + heal_amount)
+
+    events = [Event("special", attacker.name, target.name, damage, heal_amount, "natures_blessing")]
+    apply_damage(attacker, target, damage, events)
+    return events
+
+
+SPECIAL_ABILITIES = {
+    "player": critical_strike,
+    "goblin": frenzy,
+    "orc": crushing_blow,
+    "elf": natures_blessing,
+}
+
+
+def special_ability(attacker, target, rng, rules=DEFAULT_RULES):
+    if not attacker.is_alive or not target.is_alive:
+        return []
+    return SPECIAL_ABILITIES[attacker.kind](attacker, target, rng, rules)
+
+
+# One run of Hero against the enemy roster. The engine owns its random
+# stream, so two engines built with the same seed and fed the same player
+# actions produce identical battles. Without a seed every battle draws a
+# fresh one, kept in current_seed so the battle can still be replayed.
+# Every action's events also go to the optional sink (see eventlog.py).
+#
+# The roster defaults to the three regular enemies; an arena roster can hold
+# hundreds. Living enemies are tracked as a set of roster indices, so a
+# death, the victory check and finding the next enemy to face do not scan
+# the whole roster. In endless mode the roster is replaced by wave after
+# wave from a WaveGenerator until the player dies.
+#
+# Fighters come from a pool and go back to it when a wave is cleared or the
+# battle is reset, and the enemy containers are refilled in place, so a long
+# endless battle settles into reusing the same objects.
+class BattleEngine:
+    def __init__(self, seed=None, rules=None, sink=None, roster=None, endless=False):
+        self.seed = seed
+        self.rules = DEFAULT_RULES if rules is None else rules
+        self.sink = sink
+        self.roster = ENEMY_ROSTER if roster is None else roster
+        self.endless = endless
+        self.pool = FighterPool()
+        self.player = None
+        self.enemies = []
+        self.enemy_indices = {}
+        self.alive = set()
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seed = seed
+        self.current_seed = self.seed if self.seed is not None else random.randrange(2 ** 63)
+        self.rng = random.Random(self.current_seed)
+
+        if self.player is not None:
+            self.pool.release([self.player])
+        self.player = self.pool.acquire(PLAYER_NAME, "player", *self.rules.stats["player"], self.rules.potions)
+        if self.endless:
+            self.waves = WaveGenerator(self.current_seed, self.rules)
+            self.start_wave()
+        else:
+            self.waves = None
+            self.field_enemies((name, kind, *self.rules.stats[kind]) for name, kind in self.roster)
+        self.player_turn = True
+        self.state = "battle"  # battle, victory, game_over
+        self.turns = 0
+
+    @property
+    def wave(self):
+        return self.waves.number if self.waves is not None else 0
+
+    # Send the current enemies back to the pool and field new ones, each
+    # given as (name, kind, health, attack, defense)
+    def field_enemies(self, enemies):
+        self.pool.release(self.enemies)
+        self.enemies.clear()
+        self.enemies.extend(self.pool.acquire(*enemy) for enemy in enemies)
+        self.enemy_indices.clear()
+        self.enemy_indices.update((enemy.name, index) for index, enemy in enumerate(self.enemies))
+        self.alive.clear()
+        self.alive.update(range(len(self.enemies)))
+        self.current_index = 0
+        self.first_alive = 0  # No enemy before this index is alive
+
+    # Field the next wave of an endless battle
+    def start_wave(self):
+        self.field_enemies(self.waves.next_wave())
+        if self.waves.number > 1:
+            self.player.potions += WAVE_POTIONS
+        return Event("wave", None, self.enemies[0].name, len(self.enemies), self.waves.number)
+
+    @property
+    def current_enemy(self):
+        return self.enemies[self.current_index]
+
+    @current_enemy.setter
+    def current_enemy(self, enemy):
+        self.current_index = self.enemy_indices[enemy.name]
+
+    def alive_enemies(self):
+        return [self.enemies[index] for index in sorted(self.alive)]
+
+    # First living enemy in roster order. Enemies never come back to life,
+    # so the search resumes where it last stopped.
+    def first_alive_index(self):
+        while self.first_alive not in self.alive:
+            self.first_alive += 1
+        return self.first_alive
+
+    # Next living enemy after index in roster order, wrapping around
+    def next_alive_index(self, index):
+        count = len(self.enemies)
+        for offset in range(1, count + 1):
+            candidate = (index + offset) % count
+            if candidate in self.alive:
+                return candidate
+        return None
+
+    # The enemy that acts on the next enemy turn: the current one, or the
+    # first living one if the current enemy is dead. None once all are dead.
+    def acting_index(self):
+        if self.current_index in self.alive:
+            return self.current_index
+        if not self.alive:
+            return None
+        return self.first_alive_index()
+
+    def log(self, events):
+        if self.sink is not None and events:
+            self.sink.emit(self.current_seed, self.turns, events)
+        return events
+
+    def update_state(self):
+        if not self.player.is_alive:
+            self.state = "game_over"
+        elif not self.alive:
+            self.state = "victory"
+
+    # Player actions: attack, special, potion or next_enemy. Everything but
+    # next_enemy and a failed potion ends the player's turn.
+    def player_action(self, action):
+        if self.state != "battle" or not self.player_turn:
+            return []
+
+        if action == "next_enemy":
+            return self.change_enemy()
+
+        if action == "attack":
+            events = attack(self.player, self.current_enemy, self.rng, self.rules)
+        elif action == "special":
+            events = special_ability(self.player, self.current_enemy, self.rng, self.rules)
+        elif action == "potion":
+            events = use_potion(self.player)
+            if events and events[0].kind == "no_potions":
+                return self.log(events)
+        else:
+            raise ValueError(f"Unknown action: {action}")
+
+        if events:
+            self.player_turn = False
+            self.turns += 1
+        if not self.current_enemy.is_alive:
+            self.alive.discard(self.current_index)
+            if not self.alive and self.endless:
+                events.append(self.start_wave())
+        self.update_state()
+        return self.log(events)
+
+    # action is the enemy's move, attack or special, when an enemy AI picks
+    # it (see ai.py); otherwise the enemy picks one at random
+    def enemy_turn(self, action=None):
+        if self.state != "battle" or self.player_turn:
+            return []
+
+        events = []
+        if not self.current_enemy.is_alive:
+            # Find next alive enemy
+            if not self.alive:
+                self.state = "victory"
+                return events
+            self.current_index = self.first_alive_index()
+            events.append(Event("enemy_switch", None, self.current_enemy.name))
+
+        enemy = self.current_enemy
+        if enemy.stunned:
+            enemy.stunned = False
+            events.append(Event("skip", enemy.name, self.player.name))
+        else:
+            if action is None:
+                # 70% normal attack by default, otherwise the special ability
+                action = "attack" if self.rng.random() < self.rules.enemy_attack_chance else "special"
+            if action == "attack":
+                events.extend(attack(enemy, self.player, self.rng, self.rules))
+            elif action == "special":
+                events.extend(special_ability(enemy, self.player, self.rng, self.rules))
+            else:
+                raise ValueError(f"Unknown enemy action: {action}")
+
+        self.player_turn = True
+        self.turns += 1
+        self.update_state()
+        return self.log(events)
+
+    def change_enemy(self):
+        # Cycle to the next enemy
+        if not self.alive:
+            self.state = "victory"
+            return []
+
+        if self.current_index in self.alive:
+            self.current_index = self.next_alive_index(self.current_index)
+        else:
+            self.current_index = self.first_alive_index()
+
+        return self.log([Event("enemy_switch", None, self.current_enemy.name)])
+
+
+# Default headless player: drink a potion when low, otherwise attack
+def default_policy(engine):
+    player = engine.player
+    if player.potions > 0 and player.health <= player.max_health // 3:
+        return "potion"
+    return "attack"
+
+
+def simulate(seed=None, policy=default_policy, max_turns=1000, rules=None, sink=None, endless=False,
+             enemy_ai=None):
+    engine = BattleEngine(seed, rules, sink, endless=endless)
+    while engine.state == "battle" and engine.turns < max_turns:
+        if engine.player_turn:
+            engine.player_action(policy(engine))
+        else:
+            engine.enemy_turn(enemy_ai.choose(engine) if enemy_ai is not None else None)
+    return engine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate battles without a window")
+    parser.add_argument("-n", "--battles", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--event-log", metavar="FILE", help="write every battle's events to a JSON lines file")
+    args = parser.parse_args(argv)
+
+    sink = JsonlSink(args.event_log) if args.event_log else None
+    wins = 0
+    turns = 0
+    start = time.perf_counter()
+    for i in range(args.battles):
+        engine = simulate(args.seed + i, sink=sink)
+        wins += engine.state == "victory"
+        turns += engine.turns
+    elapsed = time.perf_counter() - start
+    if sink is not None:
+        sink.close()
+        print(f"Wrote {sink.written} events to {args.event_log}")
+
+    print(f"Battles: {args.battles}")
+    print(f"Win rate: {wins / args.battles * 100:.2f}%")
+    print(f"Average turns: {turns / args.battles:.1f}")
+    print(f"Time per battle: {elapsed / args.battles * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
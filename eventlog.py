@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import deque
+
+# Sinks for the typed combat events a BattleEngine emits (attack, special,
+# heal, stun, level_up, death, enemy_switch, ...). The engine calls
+# sink.emit(seed, turn, events) after every action; emitting only appends to
+# a deque, so a sink never stalls the frame loop or a simulation.
+#
+# JsonlSink turns the events into JSON lines on a background thread and
+# writes them in batches, optionally rotating the file once it grows past a
+# size limit. RingBufferSink keeps the most recent events in memory.
+
+FIELDS = ("kind", "actor", "target", "amount", "value", "ability")
+ENCODER = json.JSONEncoder(separators=(",", ":"))
+QUOTED = {}
+
+
+# One event as a JSON-ready dict, leaving out unset fields
+def event_record(seed, turn, event):
+    record = {"seed": seed, "turn": turn}
+    for name, value in zip(FIELDS, event):
+        if value is not None:
+            record[name] = value
+    return record
+
+
+# The same event as a JSON line, built directly. Names, kinds and abilities
+# come from small fixed sets, so their quoted forms are cached.
+def event_line(seed, turn, event):
+    parts = [f'{{"seed":{seed},"turn":{turn}']
+    for name, value in zip(FIELDS, event):
+        if value is None:
+            continue
+        if isinstance(value, str):
+            quoted = QUOTED.get(value)
+            if quoted is None:
+                quoted = QUOTED[value] = ENCODER.encode(value)
+            value = quoted
+        parts.append(f',"{name}":{value}')
+    parts.append("}")
+    return "".join(parts)
+
+
+class RingBufferSink:
+    def __init__(self, capacity=10000):
+        self.events = deque(maxlen=capacity)
+
+    def emit(self, seed, turn, events):
+        for event in events:
+            self.events.append((seed, turn, event))
+
+    def records(self):
+        return [event_record(seed, turn, event) for seed, turn, event in self.events]
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    # Batches are written every flush_interval seconds, or sooner once
+    # batch_size events are waiting. With max_bytes the file is rotated to
+    # path.1, path.2, ... keeping the given number of backups.
+    def __init__(self, path, batch_size=4096, flush_interval=1.0, max_bytes=None, backups=3):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending = deque()
+        self.written = 0
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.file = open(path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+        self.thread = threading.Thread(target=self.writer, name="event-log", daemon=True)
+        self.thread.start()
+
+    def emit(self, seed, turn, events):
+        self.pending.append((seed, turn, events))
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def writer(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            closing = self.closing
+            self.write_pending()
+            if closing:
+                self.write_pending()
+                return
+
+    # Write what is pending now; events emitted meanwhile go in the next batch
+    def write_pending(self):
+        lines = []
+        for _ in range(len(self.pending)):
+            seed, turn, events = self.pending.popleft()
+            lines.extend(event_line(seed, turn, event) for event in events)
+        if not lines:
+            return
+        data = "\n".join(lines) + "\n"
+        if self.max_bytes is not None and self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.written += len(lines)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.size = 0
+
+    # Write everything still pending and stop the writer thread
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join()
+        self.file.close()
+
+
+# Simulate battles into an event log and report how long emitting took on
+# the simulating thread against the whole run
+def benchmark(path, battles, max_bytes):
+    from combat import simulate
+
+    sink = JsonlSink(path, max_bytes=max_bytes)
+    turns = 0
+    start = time.perf_counter()
+    for seed in range(battles):
+        turns += simulate(seed, sink=sink).turns
+    simulated = time.perf_counter() - start
+    sink.close()
+    total = time.perf_counter() - start
+
+    baseline_start = time.perf_counter()
+    for seed in range(battles):
+        simulate(seed)
+    baseline = time.perf_counter() - baseline_start
+
+    print(f"{battles} battles, {turns} turns, {sink.written} events written to {path}")
+    print(f"  simulation without a sink {baseline:6.2f} s")
+    print(f"  simulation with the sink  {simulated:6.2f} s ({(simulated - baseline) / turns * 1e6:+.2f} us per turn)")
+    print(f"  until all events written  {total:6.2f} s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write simulated battles to a JSON lines event log")
+    parser.add_argument("-o", "--output", default="events.jsonl")
+    parser.add_argument("-n", "--battles", type=int, default=10000)
+    parser.add_argument("--max-mb", type=float, help="rotate the log once it grows past this size")
+    args = parser.parse_args(argv)
+
+    max_bytes = int(args.max_mb * 1024 * 1024) if args.max_mb else None
+    benchmark(args.output, args.battles, max_bytes)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
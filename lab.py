@@ -1,8 +1,26 @@
 import pygame
 import sys
-import random
-import math
+import argparse
 import os
+import time
+import heapq
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import atlas
+import parallax
+import pixel_cache
+import sweep
+from replay import MAX_ARENA, Replay, ReplayPlayer, ReplayRecorder, engine_result
+from profiler import CountingSurface, FrameProfiler
+from combat import BattleEngine, ENEMY_ROSTER, arena_roster
+from eventlog import JsonlSink
+from particles import ParticleSystem, circle_frames, image_frames
+from solver import Solver, state_from_engine
+from ai import DIFFICULTIES, SearchAI
+from server import SESSION_ERRORS, RemoteSession
+from snapshot import Snapshot
 
 # Initialize pygame
 pygame.init()
@@ -11,8 +29,33 @@ pygame.font.init()
 # Screen setup
 SCREEN_WIDTH = 1000
 SCREEN_HEIGHT = 600
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Fantasy Battle Arena")
+screen = None
+window = None
+
+
+# Open the game window. Nothing else in this module needs a display, so the
+# combat engine and the tools built on it can import lab without one. With
+# count_blits the game draws into a back buffer that counts its blits for
+# the frame profiler, and present() copies it to the window.
+def init_display(count_blits=False):
+    global screen, window
+    window = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Fantasy Battle Arena")
+    screen = window
+    if count_blits:
+        screen = CountingSurface((SCREEN_WIDTH, SCREEN_HEIGHT), 0, window)
+    return screen
+
+
+# Show the drawn frame, or just the given areas of it
+def present(rects=None):
+    if screen is not window:
+        for rect in rects or [screen.get_rect()]:
+            window.blit(screen, rect, rect)
+    if rects is None:
+        pygame.display.flip()
+    else:
+        pygame.display.update(rects)
 
 # Colors
 WHITE = (255, 255, 255)
@@ -30,67 +73,507 @@ font_small = pygame.font.SysFont('Arial', 16)
 font_medium = pygame.font.SysFont('Arial', 24)
 font_large = pygame.font.SysFont('Arial', 32)
 font_title = pygame.font.SysFont('Arial', 48, bold=True)
+placeholder_font = pygame.font.SysFont('Arial', 14)
+font_profiler = pygame.font.SysFont('Arial', 13)
 
 # Game clock
 clock = pygame.time.Clock()
 FPS = 60
 
+# The battle simulation advances in fixed steps of SIM_STEP seconds no matter
+# how fast frames are drawn. Frame times above MAX_FRAME_TIME are clamped so a
+# long stall cannot trigger an endless catch-up.
+SIM_RATE = 60
+SIM_STEP = 1.0 / SIM_RATE
+MAX_FRAME_TIME = 0.25
+
+# Animation lengths, in seconds
+ATTACK_ANIMATION_TIME = 1 / 3  # Lunge halfway to the target and back
+HIT_ANIMATION_TIME = 0.25  # Shake right, left and back to center
+HEAL_ANIMATION_TIME = 0.25
+HIT_SHAKE_DISTANCE = 10
+
+ANIMATION_TIMES = {
+    "attack": ATTACK_ANIMATION_TIME,
+    "hit": HIT_ANIMATION_TIME,
+    "heal": HEAL_ANIMATION_TIME,
+}
+
+# Battle pacing, in milliseconds of game clock
+MESSAGE_DURATION = 3000  # How long a battle message stays on screen
+ENEMY_THINK_TIME = 400  # Pause before the enemy acts
+TURN_HANDOFF_DELAY = 500  # Pause after the enemy acts before the player's turn
+IDLE_WAIT_TIMEOUT = 250  # Longest sleep between wakeups on a static screen
+PROFILER_REFRESH = 15  # Frames between updates of the profiler overlay
+PROFILER_LINE_HEIGHT = 15
+EVENT_LOG_MAX_BYTES = 64 * 1024 * 1024  # Event log size before it is rotated
+MENU_PREVIEWS = 3  # Enemies shown on the main menu
+QUICKSAVE_PATH = "quicksave.fbs"  # Written with F5, read back with F9
+CRASH_SNAPSHOT_PATH = "crash.fbs"  # The battle as it was when the game crashed
+
+# Background fill colors used when the background images are missing
+MENU_BG_COLOR = (100, 100, 150)
+BATTLE_BG_COLOR = (220, 220, 220)
+
+# Window events after which the whole window has to be drawn again
+REDRAW_EVENTS = {
+    pygame.VIDEOEXPOSE,
+    pygame.WINDOWEXPOSED,
+    pygame.WINDOWSHOWN,
+    pygame.WINDOWRESTORED,
+    pygame.WINDOWSIZECHANGED,
+}
+
 # Create an "images" folder if it doesn't exist
 if not os.path.exists("images"):
     os.makedirs("images")
     print("Created 'images' folder. Please add character sprites to this folder.")
 
 
-# Load images (now with placeholders that suggest adding real images)
-def load_image(name, scale=1.0):
-    image_path = os.path.join("images", f"{name}.png")
-
-    # Try to load the actual image
-    try:
-        image = pygame.image.load(image_path)
-        print(f"Loaded image: {image_path}")
-    except:
-        # If the image doesn't exist, create a placeholder with text prompting to add real images
-        print(f"Image not found: {image_path}")
-        size = (100, 150)
-        image = pygame.Surface(size)
-
-        if name == "player":
-            image.fill(BLUE)
-            text = "Add hero.png"
-            color = WHITE
-        elif name == "goblin":
-            image.fill(GREEN)
-            text = "Add goblin.png"
-            color = BLACK
-        elif name == "orc":
-            image.fill(RED)
-            text = "Add orc.png"
-            color = WHITE
-        elif name == "elf":
-            image.fill(LIGHT_BLUE)
-            text = "Add elf.png"
-            color = BLACK
-        else:
-            image.fill(GRAY)
-            text = f"Add {name}.png"
-            color = WHITE
-
-        # Add text to the placeholder
-        font = pygame.font.SysFont('Arial', 14)
-        text_surface = font.render(text, True, color)
-        text_rect = text_surface.get_rect(center=(size[0] // 2, size[1] // 2))
-        image.blit(text_surface, text_rect)
-
-    # Scale the image if needed
-    if scale != 1.0:
-        original_size = image.get_size()
-        new_size = (int(original_size[0] * scale), int(original_size[1] * scale))
-        image = pygame.transform.scale(image, new_size)
+# Placeholder for a sprite that is missing from the images folder
+def make_placeholder(name):
+    size = (100, 150)
+    image = pygame.Surface(size)
+
+    if name == "player":
+        image.fill(BLUE)
+        text = "Add hero.png"
+        color = WHITE
+    elif name == "goblin":
+        image.fill(GREEN)
+        text = "Add goblin.png"
+        color = BLACK
+    elif name == "orc":
+        image.fill(RED)
+        text = "Add orc.png"
+        color = WHITE
+    elif name == "elf":
+        image.fill(LIGHT_BLUE)
+        text = "Add elf.png"
+        color = BLACK
+    else:
+        image.fill(GRAY)
+        text = f"Add {name}.png"
+        color = WHITE
+
+    # Add text to the placeholder
+    text_surface = placeholder_font.render(text, True, color)
+    text_rect = text_surface.get_rect(center=(size[0] // 2, size[1] // 2))
+    image.blit(text_surface, text_rect)
+    return image
+
+
+# Surface size in bytes, used by the asset format report
+def surface_bytes(image):
+    return image.get_pitch() * image.get_height()
+
 
+# Convert a freshly decoded Surface to the display pixel format so blits do not
+# pay for a per-pixel conversion. Images with per-pixel alpha keep it, opaque
+# images drop it, and a colorkey turns on RLE acceleration for sprites whose
+# transparency is a single flat color.
+def normalize_surface(image, colorkey=None):
+    if colorkey is not None:
+        image = image.convert()
+        image.set_colorkey(colorkey, pygame.RLEACCEL)
+    elif image.get_flags() & pygame.SRCALPHA:
+        image = image.convert_alpha()
+    else:
+        image = image.convert()
     return image
 
 
+# Process-wide image registry. Every (name, scale) pair is read from disk once
+# and the resulting Surface is shared by all characters of that type, so
+# restarting a battle or drawing a dead character never touches the disk.
+# Sprites packed by atlas.py are cut from the atlas sheets rather than
+# decoded from their own files. Images an AssetLoader has already decoded
+# wait in decoded until they are first asked for and converted.
+class AssetCache:
+    def __init__(self, folder="images"):
+        self.folder = folder
+        self.images = {}
+        self.missing = set()
+        self.formats = {}
+        self.atlas = None
+        self.decoded = {}
+        self.sprite_sets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def exists(self, name):
+        if name in self.missing:
+            return False
+        if (name, 1.0, None) in self.images:
+            return True
+        return os.path.exists(os.path.join(self.folder, f"{name}.png"))
+
+    def get(self, name, scale=1.0, colorkey=None):
+        key = (name, scale, colorkey)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        if scale != 1.0:
+            # Scale from the cached original instead of decoding the file again;
+            # the scaled copy keeps the original's display format
+            original = self.get(name, colorkey=colorkey)
+            original_size = original.get_size()
+            new_size = (int(original_size[0] * scale), int(original_size[1] * scale))
+            image = pygame.transform.scale(original, new_size)
+        elif colorkey is None and name in self.atlas_sprites():
+            image = self.atlas[name]
+        else:
+            raw = self.decoded.pop(name, None)
+            if raw is None:
+                raw = self.load(name)
+            image = normalize_surface(raw, colorkey)
+            self.formats[key] = (surface_bytes(raw), surface_bytes(image))
+
+        self.images[key] = image
+        return image
+
+    # Sprites from the atlas, loaded on first use; empty without an atlas
+    def atlas_sprites(self):
+        if self.atlas is None:
+            self.atlas = {}
+            index, raw_sheets = self.decoded.pop("atlas", None) or (atlas.read_index(self.folder), None)
+            if index is not None:
+                try:
+                    self.atlas = atlas.load_sprites(self.folder, index, raw_sheets)
+                except (pygame.error, OSError, ValueError) as error:
+                    # A sheet that is missing or does not match the index;
+                    # the sprites are loaded from their own files instead
+                    print(f"Ignoring the atlas, its sheets could not be read: {error}")
+                else:
+                    print(f"Loaded atlas: {len(self.atlas)} sprites from {len(index['sheets'])} sheet(s)")
+        return self.atlas
+
+    # Atlas index and unconverted sheets, or no index if a sheet cannot be
+    # read. Safe to call from loader threads.
+    def decode_atlas(self, index):
+        try:
+            return index, atlas.read_sheets(self.folder, index)
+        except (pygame.error, OSError) as error:
+            print(f"Ignoring the atlas, its sheets could not be read: {error}")
+            return None, None
+
+    # Full-screen backgrounds are scaled to the window size once and stored
+    # opaque, since nothing is ever drawn underneath them. The converted
+    # pixels are kept in the on-disk pixel cache for the next launch.
+    def get_background(self, name, size, fill_color):
+        key = (name, size, None)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        if self.exists(name):
+            decoded = self.decoded.pop(key, None) or self.decode_background(name, size, pygame.display.get_surface())
+            raw, cached = decoded
+            if raw is None:
+                raw = pygame.transform.scale(self.load(name), size)
+            image = raw.convert()
+            if cached:
+                print(f"Loaded cached background: {name}")
+            else:
+                pixel_cache.store(name, os.path.join(self.folder, f"{name}.png"), image)
+        else:
+            print(f"Background image {name} not found, using default color")
+            raw = pygame.Surface(size)
+            raw.fill(fill_color)
+            image = raw.convert()
+        self.formats[key] = (surface_bytes(raw), surface_bytes(image))
+
+        self.images[key] = image
+        return image
+
+    # Background scaled to size but not yet converted, taken from the pixel
+    # cache when it has an entry, together with whether it did. Safe to call
+    # from loader threads.
+    def decode_background(self, name, size, target):
+        image = pixel_cache.read(name, os.path.join(self.folder, f"{name}.png"), size, target)
+        if image is not None:
+            return image, True
+        raw = self.decode(name)
+        if raw is None:
+            return None, False
+        return pygame.transform.scale(raw, size), False
+
+    def get_rotated(self, name, angle):
+        key = (name, "rotated", angle)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+
+        self.misses += 1
+        image = pygame.transform.rotate(self.get(name), angle)
+        self.images[key] = image
+        return image
+
+    # Decode an image without converting it, or None if it cannot be read.
+    # Safe to call from loader threads.
+    def decode(self, name, verbose=True):
+        image_path = os.path.join(self.folder, f"{name}.png")
+        try:
+            image = pygame.image.load(image_path)
+        except (pygame.error, FileNotFoundError):
+            return None
+        if verbose:
+            print(f"Loaded image: {image_path}")
+        return image
+
+    def load(self, name, verbose=True):
+        # Failed lookups are remembered so a missing file is only reported once
+        if name not in self.missing:
+            image = self.decode(name, verbose)
+            if image is not None:
+                return image
+            print(f"Image not found: {os.path.join(self.folder, f'{name}.png')}")
+            self.missing.add(name)
+
+        return make_placeholder(name)
+
+    def clear(self):
+        self.images.clear()
+        self.formats.clear()
+        self.decoded.clear()
+        self.sprite_sets.clear()
+        self.atlas = None
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        print(f"Asset cache: {len(self.images)} surfaces, {self.hits} hits, "
+              f"{self.misses} misses ({hit_rate:.1f}% hit rate), {len(self.missing)} missing files")
+
+    # Print bytes per asset before and after display conversion, together with
+    # the time to blit the unconverted and the converted Surface to the screen
+    def format_report(self, target, blits=200):
+        print(f"{'asset':<20}{'before':>10}{'after':>10}{'raw blit':>12}{'conv blit':>12}{'speedup':>9}")
+        total_before = total_after = 0
+        for key, (before, after) in sorted(self.formats.items(), key=lambda item: str(item[0])):
+            name, size_or_scale, colorkey = key
+            raw = self.load(name, verbose=False)
+            if isinstance(size_or_scale, tuple):
+                raw = pygame.transform.scale(raw, size_or_scale)
+            converted = self.images[key]
+
+            timings = []
+            for image in (raw, converted):
+                start = time.perf_counter()
+                for _ in range(blits):
+                    target.blit(image, (0, 0))
+                timings.append((time.perf_counter() - start) / blits * 1e6)
+
+            speedup = timings[0] / timings[1] if timings[1] else 0.0
+            print(f"{name:<20}{before:>10}{after:>10}{timings[0]:>10.1f}us{timings[1]:>10.1f}us{speedup:>8.1f}x")
+            total_before += before
+            total_after += after
+        print(f"{'total':<20}{total_before:>10}{total_after:>10}")
+
+
+assets = AssetCache()
+
+
+# Posted by loader threads whenever an image has been decoded
+ASSET_LOADED = pygame.event.custom_type()
+
+
+# Streams images into an AssetCache. Images are decoded on a thread pool in
+# the order they are queued, so queueing the main menu's images first puts
+# them ahead of battle-only ones. poll() hands decoded Surfaces back on the
+# main thread, where the cache converts them to the display format. Every
+# finished decode wakes the main loop with an ASSET_LOADED event.
+class AssetLoader:
+    def __init__(self, cache, workers=4):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="assets")
+        self.pending = []
+        self.queued = {}
+        self.installed = {}
+
+    # Decode on a worker thread with decode(), then store the result in the
+    # cache under key and call install() on the main thread
+    def add(self, stage, key, decode, install):
+        future = self.executor.submit(decode)
+        future.add_done_callback(lambda _: pygame.event.post(pygame.event.Event(ASSET_LOADED)))
+        self.pending.append((stage, key, future, install))
+        self.queued[stage] = self.queued.get(stage, 0) + 1
+        self.installed.setdefault(stage, 0)
+
+    # Convert everything decoded since the last call
+    def poll(self):
+        pending = []
+        for stage, key, future, install in self.pending:
+            if not future.done():
+                pending.append((stage, key, future, install))
+                continue
+            decoded = future.result()
+            if decoded is not None:
+                self.cache.decoded[key] = decoded
+            install()
+            self.installed[stage] += 1
+        self.pending = pending
+
+    def ready(self, stage):
+        return self.installed.get(stage, 0) == self.queued.get(stage, 0)
+
+    # Images installed and queued over the given stages
+    def progress(self, stages):
+        return (sum(self.installed.get(stage, 0) for stage in stages),
+                sum(self.queued.get(stage, 0) for stage in stages))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Bounded LRU cache of rendered text. Names, stats, button labels and titles
+# rarely change between frames, so rendering them turns into a dict lookup.
+class TextCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def render(self, font, text, color, antialias=True):
+        key = (font, text, color, antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)
+            self.evictions += 1
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        print(f"Text cache: {len(self.surfaces)}/{self.max_entries} surfaces, {self.hits} hits, "
+              f"{self.misses} misses ({hit_rate:.1f}% hit rate), {self.evictions} evictions")
+
+
+text_cache = TextCache()
+
+
+def render_text(font, text, color, antialias=True):
+    return text_cache.render(font, text, color, antialias)
+
+
+# Queue of callbacks to run at a later point of the game clock. The main loop
+# calls update() once per frame, so delays never block event handling or
+# drawing the way pygame.time.delay does.
+class Scheduler:
+    def __init__(self):
+        self.now = 0
+        self.tasks = []
+        self.cancelled = set()
+        self.counter = itertools.count()
+
+    def call_later(self, delay, callback):
+        task_id = next(self.counter)
+        heapq.heappush(self.tasks, (self.now + delay, task_id, callback))
+        return task_id
+
+    def cancel(self, task_id):
+        if task_id is not None:
+            self.cancelled.add(task_id)
+
+    def update(self, now):
+        self.now = now
+        while self.tasks and self.tasks[0][0] <= now:
+            _, task_id, callback = heapq.heappop(self.tasks)
+            if task_id in self.cancelled:
+                self.cancelled.discard(task_id)
+                continue
+            callback()
+
+    def clear(self):
+        self.tasks.clear()
+        self.cancelled.clear()
+
+
+# Retained-mode renderer for scenes that mostly stand still. The scene is a
+# pre-composited static layer plus a list of widgets, each given as
+# (name, rect, key, draw) where key captures everything that affects how the
+# widget looks. Only widgets whose rect or key changed since the last frame
+# are redrawn, after restoring the static layer underneath them, and the
+# changed rectangles are returned for pygame.display.update.
+class DirtyRenderer:
+    def __init__(self):
+        self.drawn = {}
+        self.full_redraw = True
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    def render(self, target, static_layer, widgets):
+        if self.full_redraw:
+            self.full_redraw = False
+            target.blit(static_layer, (0, 0))
+            for name, rect, key, draw in widgets:
+                if rect is not None:
+                    draw()
+            self.drawn = {name: (rect, key) for name, rect, key, _ in widgets}
+            return [target.get_rect()]
+
+        dirty = []
+        current = {name for name, _, _, _ in widgets}
+        for name, (rect, _) in self.drawn.items():
+            if name not in current and rect is not None:
+                dirty.append(rect)
+
+        for name, rect, key, _ in widgets:
+            previous = self.drawn.get(name)
+            if previous is not None and previous == (rect, key):
+                continue
+            if previous is not None and previous[0] is not None:
+                dirty.append(previous[0])
+            if rect is not None:
+                dirty.append(rect)
+
+        # A widget that overlaps a dirty area has to be redrawn as a whole, which
+        # in turn dirties the rest of its rect
+        redraw = set()
+        changed = bool(dirty)
+        while changed:
+            changed = False
+            for name, rect, key, _ in widgets:
+                if name not in redraw and rect is not None and rect.collidelist(dirty) != -1:
+                    redraw.add(name)
+                    dirty.append(rect)
+                    changed = True
+
+        for rect in dirty:
+            target.blit(static_layer, rect, rect)
+        for name, rect, key, draw in widgets:
+            if name in redraw:
+                draw()
+
+        self.drawn = {name: (rect, key) for name, rect, key, _ in widgets}
+        return dirty
+
+
+# Load images (now with placeholders that suggest adding real images)
+def load_image(name, scale=1.0):
+    return assets.get(name, scale)
+
+
 # Button class for UI
 class Button:
     def __init__(self, x, y, width, height, text, color, hover_color):
@@ -106,17 +589,23 @@ class Button:
         pygame.draw.rect(surface, self.current_color, self.rect, border_radius=10)
         pygame.draw.rect(surface, BLACK, self.rect, 2, border_radius=10)
 
-        text_surface = self.font.render(self.text, True, BLACK)
+        text_surface = render_text(self.font, self.text, BLACK)
         text_rect = text_surface.get_rect(center=self.rect.center)
         surface.blit(text_surface, text_rect)
 
+    def draw_key(self):
+        return self.text, self.current_color
+
+    # Returns True when the hover state changed and the button needs a redraw
     def update(self, mouse_pos):
+        was_hovered = self.is_hovered
         if self.rect.collidepoint(mouse_pos):
             self.current_color = self.hover_color
             self.is_hovered = True
         else:
             self.current_color = self.color
             self.is_hovered = False
+        return self.is_hovered != was_hovered
 
     def is_clicked(self, event):
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
@@ -125,89 +614,122 @@ class Button:
         return False
 
 
-# Game character classes
+# Images of one kind of character. They are looked up once per kind and
+# shared by every character of that kind, however many there are.
+class SpriteSet:
+    __slots__ = ("image", "attack_frames", "hit_frames", "dead_image", "dead_offset")
+
+    def __init__(self, char_type):
+        self.image = load_image(char_type)
+
+        # Attack, hit and dead frames come from the shared asset cache; frames
+        # that are missing on disk fall back to the regular image
+        self.attack_frames = [load_image(f"{char_type}_attack{i}")
+                              for i in range(1, 4)
+                              if assets.exists(f"{char_type}_attack{i}")]
+
+        self.hit_frames = []
+        if assets.exists(f"{char_type}_hit"):
+            self.hit_frames.append(load_image(f"{char_type}_hit"))
+
+        if assets.exists(f"{char_type}_dead"):
+            self.dead_image = load_image(f"{char_type}_dead")
+            self.dead_offset = 0
+        else:
+            self.dead_image = assets.get_rotated(char_type, 90)
+            self.dead_offset = 20
+
+
+def sprite_set(char_type):
+    sprites = assets.sprite_sets.get(char_type)
+    if sprites is None:
+        sprites = assets.sprite_sets[char_type] = SpriteSet(char_type)
+    return sprites
+
+
+# On-screen side of a combat.Fighter. Slots and shared sprite sets keep an
+# arena with hundreds of enemies small.
 class Character:
-    def __init__(self, name, char_type, health, attack, defense, x, y):
-        self.name = name
-        self.char_type = char_type
-        self.max_health = health
-        self.health = health
-        self.attack = attack
-        self.defense = defense
-        self.level = 1
-        self.experience = 0
-        self.is_alive = True
-        self.stunned = False
-
-        # Position and animation
+    __slots__ = ("fighter", "name", "char_type", "x", "y", "original_x", "previous_x", "draw_x",
+                 "sprites", "animating", "animation_time", "animation_type", "animation_target")
+
+    def __init__(self, fighter, x, y):
+        self.reset(fighter, x, y)
+
+    # Show another fighter, so pooled characters can be reused
+    def reset(self, fighter, x, y):
+        self.fighter = fighter
+        self.name = fighter.name
+        self.char_type = fighter.kind
+
+        # Position and animation. x is the simulated position; draw_x is
+        # interpolated between the last two simulation steps for drawing.
         self.x = x
         self.y = y
         self.original_x = x
-        self.original_y = y
-        self.image = load_image(char_type)
-        self.rect = self.image.get_rect(center=(x, y))
+        self.previous_x = x
+        self.draw_x = x
+        self.sprites = sprite_set(fighter.kind)
 
         # Animation state
         self.animating = False
-        self.animation_frames = 0
+        self.animation_time = 0.0
         self.animation_type = None
         self.animation_target = None
 
-        # Load attack animation frames if they exist
-        self.attack_frames = []
-        for i in range(1, 4):  # Try to load 3 attack frames
-            try:
-                frame = load_image(f"{char_type}_attack{i}", scale=1.0)
-                self.attack_frames.append(frame)
-            except:
-                # If we can't load an attack frame, just use the regular image
-                pass
-
-        # Load hit animation frames
-        self.hit_frames = []
-        try:
-            self.hit_frames.append(load_image(f"{char_type}_hit", scale=1.0))
-        except:
-            # If we can't load a hit frame, just use the regular image
-            pass
+    # Image to show this frame and where it goes
+    def current_sprite(self):
+        sprites = self.sprites
+        if not self.fighter.is_alive:
+            # Draw character lying down if dead
+            return sprites.dead_image, sprites.dead_image.get_rect(center=(self.draw_x, self.y + sprites.dead_offset))
+
+        # If character is attacking and we have attack frames
+        if self.animating and self.animation_type == "attack" and sprites.attack_frames:
+            # Choose appropriate attack frame based on animation progress
+            frame_index = min(len(sprites.attack_frames) - 1, int(self.animation_progress() * 4))
+            attack_image = sprites.attack_frames[frame_index]
+            return attack_image, attack_image.get_rect(center=(self.draw_x, self.y))
+
+        # If character is being hit and we have hit frames
+        if self.animating and self.animation_type == "hit" and sprites.hit_frames:
+            hit_image = sprites.hit_frames[0]
+            return hit_image, hit_image.get_rect(center=(self.draw_x, self.y))
+
+        # Otherwise use the default image
+        return sprites.image, sprites.image.get_rect(center=(self.draw_x, self.y))
+
+    # Everything that changes how the character looks; the dirty-rectangle
+    # renderer only redraws the character when this changes. The sprite's
+    # rect rounds draw_x while the health bar and name truncate it, so both
+    # are part of the key.
+    def draw_key(self):
+        fighter = self.fighter
+        image, rect = self.current_sprite()
+        return (image, tuple(rect), int(self.draw_x), fighter.health, fighter.max_health, fighter.level,
+                fighter.stunned)
+
+    # Screen area covered by the sprite, the name and the health bar
+    def bounds(self):
+        _, rect = self.current_sprite()
+        name_text = render_text(font_small, f"{self.name} (Lvl {self.fighter.level})", BLACK)
+        label_width = max(100, name_text.get_width()) + 2
+        label = pygame.Rect(int(self.draw_x) - label_width // 2 - 1, self.y - 100, label_width + 2, 60)
+        return rect.union(label)
 
     def draw(self, surface):
-        if not self.is_alive:
-            # Draw character lying down if dead
-            try:
-                dead_image = load_image(f"{self.char_type}_dead")
-                dead_rect = dead_image.get_rect(center=(self.x, self.y))
-                surface.blit(dead_image, dead_rect)
-            except:
-                # Fall back to rotation if no specific dead image
-                rotated_image = pygame.transform.rotate(self.image, 90)
-                rotated_rect = rotated_image.get_rect(center=(self.x, self.y + 20))
-                surface.blit(rotated_image, rotated_rect)
-        else:
-            # If character is attacking and we have attack frames
-            if self.animating and self.animation_type == "attack" and self.attack_frames:
-                # Choose appropriate attack frame based on animation progress
-                frame_index = min(len(self.attack_frames) - 1, self.animation_frames // 5)
-                attack_image = self.attack_frames[frame_index]
-                attack_rect = attack_image.get_rect(center=(self.x, self.y))
-                surface.blit(attack_image, attack_rect)
-            # If character is being hit and we have hit frames
-            elif self.animating and self.animation_type == "hit" and self.hit_frames:
-                hit_image = self.hit_frames[0]
-                hit_rect = hit_image.get_rect(center=(self.x, self.y))
-                surface.blit(hit_image, hit_rect)
-            # Otherwise use the default image
-            else:
-                surface.blit(self.image, self.rect)
+        fighter = self.fighter
+        image, rect = self.current_sprite()
+        surface.blit(image, rect)
 
         # Draw health bar
         health_bar_width = 100
         health_bar_height = 10
-        health_ratio = self.health / self.max_health
+        health_ratio = fighter.health / fighter.max_health
 
         # Background (empty health)
         pygame.draw.rect(surface, RED,
-                         (self.x - health_bar_width // 2,
+                         (self.draw_x - health_bar_width // 2,
                           self.y - 80,
                           health_bar_width,
                           health_bar_height))
@@ -215,339 +737,281 @@ class Character:
         # Foreground (filled health)
         if health_ratio > 0:
             pygame.draw.rect(surface, GREEN,
-                             (self.x - health_bar_width // 2,
+                             (self.draw_x - health_bar_width // 2,
                               self.y - 80,
                               int(health_bar_width * health_ratio),
                               health_bar_height))
 
         # Border
         pygame.draw.rect(surface, BLACK,
-                         (self.x - health_bar_width // 2,
+                         (self.draw_x - health_bar_width // 2,
                           self.y - 80,
                           health_bar_width,
                           health_bar_height), 1)
 
         # Name and level
-        name_text = font_small.render(f"{self.name} (Lvl {self.level})", True, BLACK)
-        surface.blit(name_text, (self.x - name_text.get_width() // 2, self.y - 100))
+        name_text = render_text(font_small, f"{self.name} (Lvl {fighter.level})", BLACK)
+        surface.blit(name_text, (self.draw_x - name_text.get_width() // 2, self.y - 100))
 
         # Status effects
-        if self.stunned:
-            stun_text = font_small.render("STUNNED", True, RED)
-            surface.blit(stun_text, (self.x - stun_text.get_width() // 2, self.y - 60))
+        if fighter.stunned:
+            stun_text = render_text(font_small, "STUNNED", RED)
+            surface.blit(stun_text, (self.draw_x - stun_text.get_width() // 2, self.y - 60))
 
-        # Draw special effects
-        if self.animation_type == "heal" and self.animating:
-            draw_heal_effect(screen, self)
-
-    def update_animation(self):
+    # Advance the current animation by dt seconds of simulation time
+    def update_animation(self, dt):
+        self.previous_x = self.x
         if not self.animating:
             return
 
+        self.animation_time += dt
+        progress = self.animation_progress()
+        if progress >= 1:  # Animation finished
+            self.animating = False
+            self.animation_time = 0.0
+            self.x = self.original_x
+            return
+
         if self.animation_type == "attack":
-            if self.animation_frames < 10:  # Moving forward
-                self.x += (self.animation_target.x - self.original_x) / 20
-                self.animation_frames += 1
-            elif self.animation_frames < 20:  # Moving back
-                self.x -= (self.animation_target.x - self.original_x) / 20
-                self.animation_frames += 1
-            else:  # Animation finished
-                self.animating = False
-                self.animation_frames = 0
-                self.x = self.original_x
+            # Move forward to halfway to the target, then back
+            reach = (self.animation_target.original_x - self.original_x) / 2
+            self.x = self.original_x + reach * (1 - abs(1 - 2 * progress))
 
         elif self.animation_type == "hit":
-            if self.animation_frames < 5:  # Shake right
-                self.x += 2
-                self.animation_frames += 1
-            elif self.animation_frames < 10:  # Shake left
-                self.x -= 4
-                self.animation_frames += 1
-            elif self.animation_frames < 15:  # Back to center
-                self.x += 2
-                self.animation_frames += 1
-            else:  # Animation finished
-                self.animating = False
-                self.animation_frames = 0
-                self.x = self.original_x
-
-        elif self.animation_type == "heal":
-            if self.animation_frames < 15:
-                self.animation_frames += 1
-            else:
-                self.animating = False
-                self.animation_frames = 0
-
-        # Update rectangle position
-        self.rect = self.image.get_rect(center=(self.x, self.y))
-
-    def attack_target(self, target):
-        if not self.is_alive:
-            return f"{self.name} is dead and cannot attack!"
-
-        if not target.is_alive:
-            return f"{target.name} is already dead!"
-
-        # Start attack animation
-        self.animating = True
-        self.animation_frames = 0
-        self.animation_type = "attack"
-        self.animation_target = target
-
-        # Start hit animation for target
-        target.animating = True
-        target.animation_frames = 0
-        target.animation_type = "hit"
-
-        # Calculate damage
-        damage = max(1, self.attack - target.defense // 2)
-        damage += random.randint(-2, 2)  # Add some randomness
-        damage = max(1, damage)  # Ensure at least 1 damage
-
-        target.health -= damage
-
-        if target.health <= 0:
-            target.health = 0
-            target.is_alive = False
-            self.gain_experience(target.level * 10)
-            return f"{self.name} attacked {target.name} for {damage} damage and killed them!"
-
-        return f"{self.name} attacked {target.name} for {damage} damage!"
-
-    def gain_experience(self, amount):
-        self.experience += amount
-        level_up_threshold = self.level * 20
-
-        if self.experience >= level_up_threshold:
-            self.level_up()
-            return True
-        return False
-
-    def level_up(self):
-        self.level += 1
-        self.max_health += 5
-        self.health = self.max_health
-        self.attack += 2
-        self.defense += 1
-
-    def heal(self, amount):
-        if not self.is_alive:
-            return f"{self.name} is dead and cannot be healed!"
-
+            if progress < 1 / 3:  # Shake right
+                offset = progress * 3
+            elif progress < 2 / 3:  # Shake left
+                offset = 1 - (progress - 1 / 3) * 6
+            else:  # Back to center
+                offset = (progress - 2 / 3) * 3 - 1
+            self.x = self.original_x + HIT_SHAKE_DISTANCE * offset
+
+    def animation_progress(self):
+        return self.animation_time / ANIMATION_TIMES[self.animation_type]
+
+    # Position to draw at, blended between the last two simulation steps
+    def interpolate(self, alpha):
+        self.draw_x = self.previous_x + (self.x - self.previous_x) * alpha
+
+    def start_animation(self, animation_type, target=None):
         self.animating = True
-        self.animation_frames = 0
-        self.animation_type = "heal"
-
-        old_health = self.health
-        self.health = min(self.max_health, self.health + amount)
-        actual_heal = self.health - old_health
-
-        return f"{self.name} was healed for {actual_heal} health points!"
-
-    def special_ability(self, target):
-        return f"{self.name} has no special ability!"
-
-
-class Player(Character):
-    def __init__(self, name, x, y):
-        super().__init__(name, "player", health=25, attack=8, defense=5, x=x, y=y)
-        self.potions = 3
-
-    def use_potion(self):
-        if not self.is_alive:
-            return "You cannot use potions while dead!"
-
-        if self.potions <= 0:
-            return "You have no potions left!"
-
-        self.potions -= 1
-        heal_amount = self.max_health // 2
-        result = self.heal(heal_amount)
-
-        return f"You used a potion! {result} Potions left: {self.potions}"
-
-    def special_ability(self, target):
-        if not self.is_alive or not target.is_alive:
-            return "Cannot use special ability now!"
-
-        # Start special animation
-        self.animating = True
-        self.animation_frames = 0
-        self.animation_type = "attack"  # Reuse attack animation for now
+        self.animation_time = 0.0
+        self.animation_type = animation_type
         self.animation_target = target
 
-        # Start hit animation for target
-        target.animating = True
-        target.animation_frames = 0
-        target.animation_type = "hit"
-
-        # Critical strike - double damage with a chance to stun
-        damage = self.attack * 2 - target.defense // 3
-        damage = max(1, damage)
-        target.health -= damage
-
-        message = f"You use CRITICAL STRIKE on {target.name} for {damage} damage!"
-
-        if random.random() < 0.3:  # 30% chance to stun
-            message += f" {target.name} is stunned and will miss their next turn!"
-            target.stunned = True
-
-        if target.health <= 0:
-            target.health = 0
-            target.is_alive = False
-            self.gain_experience(target.level * 10)
-            message += f" You defeated {target.name}!"
-
-        return message
 
-
-class Goblin(Character):
-    def __init__(self, name, x, y):
-        super().__init__(name, "goblin", health=15, attack=5, defense=3, x=x, y=y)
-
-    def special_ability(self, target):
-        if not self.is_alive or not target.is_alive:
-            return f"{self.name} cannot use special ability now!"
-
-        # Start special animation
-        self.animating = True
-        self.animation_frames = 0
-        self.animation_type = "attack"
-        self.animation_target = target
-
-        # Start hit animation for target
-        target.animating = True
-        target.animation_frames = 0
-        target.animation_type = "hit"
-
-        # Frenzy - multiple quick strikes
-        hits = random.randint(2, 4)
-        total_damage = 0
-
-        for i in range(hits):
-            damage = max(1, self.attack // 2 - target.defense // 4)
-            target.health -= damage
-            total_damage += damage
-
-        message = f"{self.name} goes into a FRENZY and strikes {hits} times for {total_damage} total damage!"
-
-        if target.health <= 0:
-            target.health = 0
-            target.is_alive = False
-            message += f" {self.name} defeated {target.name}!"
-
-        return message
-
-
-class Orc(Character):
-    def __init__(self, name, x, y):
-        super().__init__(name, "orc", health=30, attack=7, defense=6, x=x, y=y)
-
-    def special_ability(self, target):
-        if not self.is_alive or not target.is_alive:
-            return f"{self.name} cannot use special ability now!"
-
-        # Start special animation
-        self.animating = True
-        self.animation_frames = 0
-        self.animation_type = "attack"
-        self.animation_target = target
-
-        # Start hit animation for target
-        target.animating = True
-        target.animation_frames = 0
-        target.animation_type = "hit"
-
-        # Crushing blow - high damage with defense reduction
-        damage = self.attack * 1.5 - target.defense // 4
-        damage = max(1, int(damage))
-        target.health -= damage
-
-        old_defense = target.defense
-        target.defense = max(0, target.defense - 2)
-        defense_reduction = old_defense - target.defense
-
-        message = f"{self.name} uses CRUSHING BLOW on {target.name} for {damage} damage and reduces defense by {defense_reduction}!"
-
-        if target.health <= 0:
-            target.health = 0
-            target.is_alive = False
-            message += f" {self.name} defeated {target.name}!"
-
-        return message
-
-
-class Elf(Character):
-    def __init__(self, name, x, y):
-        super().__init__(name, "elf", health=18, attack=6, defense=4, x=x, y=y)
-
-    def special_ability(self, target):
-        if not self.is_alive or not target.is_alive:
-            return f"{self.name} cannot use special ability now!"
-
-        # Start special animation
-        self.animating = True
-        self.animation_frames = 0
-        self.animation_type = "attack"
-        self.animation_target = target
-
-        # Start hit animation for target
-        target.animating = True
-        target.animation_frames = 0
-        target.animation_type = "hit"
-
-        # Nature's blessing - deal damage and heal self
-        damage = self.attack - target.defense // 3
-        damage = max(1, damage)
-        target.health -= damage
-
-        heal_amount = damage // 2
-        self.health = min(self.max_health, self.health + heal_amount)
-
-        message = f"{self.name} uses NATURE'S BLESSING on {target.name} for {damage} damage and heals for {heal_amount}!"
-
-        if target.health <= 0:
-            target.health = 0
-            target.is_alive = False
-            message += f" {self.name} defeated {target.name}!"
-
-        return message
-
-
-# Battle class to manage the game
-class Battle:
+# Free list of characters whose fighters left the battle, the counterpart
+# of combat.FighterPool
+class CharacterPool:
     def __init__(self):
-        self.game_state = "main_menu"  # main_menu, battle, game_over, victory
-
-        # Load background images
-        self.menu_bg = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-        self.menu_bg.fill((100, 100, 150))
-        self.battle_bg = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-        self.battle_bg.fill((220, 220, 220))
-
-        try:
-            self.menu_bg = pygame.image.load(os.path.join("images", "menu_bg.png"))
-            self.menu_bg = pygame.transform.scale(self.menu_bg, (SCREEN_WIDTH, SCREEN_HEIGHT))
-        except:
-            print("Menu background image not found, using default color")
-
-        try:
-            self.battle_bg = pygame.image.load(os.path.join("images", "battle_bg.png"))
-            self.battle_bg = pygame.transform.scale(self.battle_bg, (SCREEN_WIDTH, SCREEN_HEIGHT))
-        except:
-            print("Battle background image not found, using default color")
-
-        # Create player character
-        self.player = Player("Hero", 250, 300)
-
-        # Create enemies
-        self.goblin = Goblin("Gobbly", 750, 200)
-        self.orc = Orc("Grog", 750, 300)
-        self.elf = Elf("Elindril", 750, 400)
-
-        self.enemies = [self.goblin, self.orc, self.elf]
-        self.current_enemy_index = 0
-        self.current_enemy = self.enemies[self.current_enemy_index]
+        self.free = []
+        self.created = 0
+
+    def acquire(self, fighter, x, y):
+        if self.free:
+            character = self.free.pop()
+            character.reset(fighter, x, y)
+            return character
+        self.created += 1
+        return Character(fighter, x, y)
+
+    def release(self, characters):
+        self.free.extend(characters)
+
+
+# Battle messages for special abilities, keyed by combat ability name
+SPECIAL_MESSAGES = {
+    "critical_strike": "You use CRITICAL STRIKE on {target} for {amount} damage!",
+    "frenzy": "{actor} goes into a FRENZY and strikes {value} times for {amount} total damage!",
+    "crushing_blow": "{actor} uses CRUSHING BLOW on {target} for {amount} damage and reduces defense by {value}!",
+    "natures_blessing": "{actor} uses NATURE'S BLESSING on {target} for {amount} damage and heals for {value}!",
+}
+
+
+# Turn the structured events of one combat action into the battle message
+def describe_events(events, player_name):
+    parts = []
+    reported_deaths = set()
+
+    for i, event in enumerate(events):
+        if event.kind == "attack":
+            killed = any(later.kind == "death" and later.target == event.target for later in events[i + 1:])
+            if killed:
+                reported_deaths.add(event.target)
+                parts.append(f"{event.actor} attacked {event.target} for {event.amount} damage and killed them!")
+            else:
+                parts.append(f"{event.actor} attacked {event.target} for {event.amount} damage!")
+        elif event.kind == "special":
+            parts.append(SPECIAL_MESSAGES[event.ability].format(**event._asdict()))
+        elif event.kind == "stun":
+            parts.append(f"{event.target} is stunned and will miss their next turn!")
+        elif event.kind == "death" and event.target not in reported_deaths:
+            if event.actor == player_name:
+                parts.append(f"You defeated {event.target}!")
+            else:
+                parts.append(f"{event.actor} defeated {event.target}!")
+        elif event.kind == "heal" and event.ability == "potion":
+            parts.append(f"You used a potion! {event.target} was healed for {event.amount} health points! "
+                         f"Potions left: {event.value}")
+        elif event.kind == "skip":
+            parts.append(f"{event.actor} is stunned and misses their turn!")
+        elif event.kind == "no_potions":
+            parts.append("You have no potions left!")
+        elif event.kind == "enemy_switch":
+            parts.append(f"You are now facing {event.target}!")
+        elif event.kind == "wave":
+            parts.append(f"Wave {event.value}: {event.amount} enemies appear!")
+
+    return " ".join(parts)
+
+
+# Exact solver behind the "best move" hint. It runs on its own worker thread so
+# the first, slowest solve never stalls a frame.
+hint_solver = Solver()
+hint_executor = ThreadPoolExecutor(max_workers=1)
+
+# The enemy AI searches on a worker thread of its own while the enemy
+# "thinks", so even the hardest level never holds up a frame
+ai_executor = ThreadPoolExecutor(max_workers=1)
+
+# Requests to a battle server go out in order on one thread, so the frame
+# loop never waits on the network
+remote_executor = ThreadPoolExecutor(max_workers=1)
+
+
+# Where each enemy stands on the battlefield, in roster order
+ENEMY_POSITIONS = [(750, 200), (750, 300), (750, 400)]
+
+# Particle burst for each combat event kind, played at the event's target:
+# (style, count, height offset, emit options)
+PARTICLE_BURSTS = {
+    "attack": ("hit", 40, 0, {"speed": (60, 180), "life": (0.2, 0.5), "gravity": 300}),
+    "special": ("hit", 80, 0, {"speed": (80, 240), "life": (0.3, 0.6), "gravity": 300}),
+    "heal": ("heal", 60, 0, {"speed": (20, 60), "angle": (-2.4, -0.7), "life": (0.6, 1.0), "radius": 25}),
+    "stun": ("stun", 12, -60, {"speed": (10, 40), "life": (0.6, 1.0), "radius": 20}),
+    "death": ("death", 150, 0, {"speed": (40, 160), "life": (0.5, 1.0), "radius": 10, "gravity": 200}),
+    "level_up": ("level_up", 100, 0, {"speed": (40, 120), "angle": (-2.8, -0.3), "life": (0.6, 1.2)}),
+}
+
+
+# Particle system with a pre-rasterized sprite set for every burst style
+def create_particles():
+    particles = ParticleSystem()
+    particles.add_style("hit", circle_frames(RED, 4))
+    particles.add_style("heal", circle_frames(GREEN, 5))
+    particles.add_style("death", circle_frames(GRAY, 6))
+    particles.add_style("level_up", circle_frames(GOLD, 4))
+    particles.add_style("stun", image_frames(assets.get("stun_effect"), (24, 22)))
+    return particles
+
+
+# Backgrounds the --parallax scrolling background is cut from
+PARALLAX_BACKGROUNDS = [name for name, *_ in parallax.DEFAULT_BANDS]
+
+
+# Scrolling background for --parallax: bands of the arena backgrounds, each
+# scaled once and moving at its own speed
+def create_parallax():
+    size = (SCREEN_WIDTH, SCREEN_HEIGHT)
+    backgrounds = {name: assets.get_background(name, size, BATTLE_BG_COLOR) for name in PARALLAX_BACKGROUNDS}
+    return parallax.ParallaxBackground(parallax.build_layers(backgrounds), size)
+
+
+# Sprites drawn for every character type, by suffix of the character type
+SPRITE_SUFFIXES = ["", "_attack1", "_attack2", "_attack3", "_hit", "_dead"]
+
+
+# Queue every image the game draws on the loader in two stages: what the
+# main menu shows first, then what only the battle needs. Without an atlas
+# the menu needs just the background and one image per character type.
+def queue_assets(loader, parallax=False):
+    size = (SCREEN_WIDTH, SCREEN_HEIGHT)
+    target = screen
+    backgrounds = [("menu", "menu_bg", MENU_BG_COLOR), ("battle", "battle_bg", BATTLE_BG_COLOR)]
+    if parallax:
+        backgrounds += [("menu", name, BATTLE_BG_COLOR) for name in PARALLAX_BACKGROUNDS]
+    for stage, name, fill_color in backgrounds:
+        if assets.exists(name):
+            loader.add(stage, (name, size, None),
+                       lambda name=name: assets.decode_background(name, size, target),
+                       lambda name=name, fill_color=fill_color: assets.get_background(name, size, fill_color))
+
+    packed = set()
+    index = atlas.read_index(assets.folder)
+    if index is not None:
+        packed = {name for name, entry in index["sprites"].items() if atlas.is_current(assets.folder, name, entry)}
+        loader.add("menu", "atlas", lambda: assets.decode_atlas(index), assets.atlas_sprites)
+
+    sprites = [("menu" if suffix == "" else "battle", kind + suffix)
+               for kind in ["player"] + [kind for _, kind in ENEMY_ROSTER]
+               for suffix in SPRITE_SUFFIXES]
+    sprites.append(("battle", "stun_effect"))
+    for stage, name in sprites:
+        if name not in packed and assets.exists(name):
+            loader.add(stage, name, lambda name=name: assets.decode(name), lambda name=name: assets.get(name))
+
+
+# Battle class to manage the game. The combat rules run headless in a
+# BattleEngine; this class only turns its events into animations and messages.
+class Battle:
+    def __init__(self, seed=None, fps=FPS, loader=None, parallax=False, profiler=None,
+                 replay=None, record_path=None, event_sink=None, arena=0, endless=False, enemy_ai=None,
+                 remote=None, snapshot=None):
+        self.game_state = "main_menu"  # loading, main_menu, battle, game_over, victory
+        self.fps = fps
+
+        # Frame timings, shown in an overlay toggled with F3
+        self.profiler = profiler or FrameProfiler()
+        self.show_profiler = False
+        self.profiler_lines = ()
+        self.counter_totals = {}
+
+        # Scrolling background behind the menu and the battle, if enabled
+        self.parallax_enabled = parallax
+        self.parallax = None
+
+        # Create the combat engine; the characters that show it are created
+        # once their images are loaded. An arena battle faces arena enemies
+        # instead of the regular three, an endless one wave after wave. A
+        # replay brings its own enemy moves, if any.
+        if replay is not None:
+            seed, arena, endless = replay.seed, replay.arena, replay.endless
+            enemy_ai = None
+        self.arena = arena
+        self.endless = endless
+        self.engine = BattleEngine(seed, sink=event_sink, roster=arena_roster(arena) if arena else None,
+                                   endless=endless)
+
+        # A snapshot (see snapshot.py) picks a saved battle up where it was
+        # left. Its replay would not start from the beginning, so a restored
+        # battle is not recorded.
+        self.restored = snapshot is not None
+        if snapshot is not None:
+            snapshot.restore(self.engine)
+            self.arena = snapshot.arena
+            self.endless = snapshot.endless
+        self.character_pool = CharacterPool()
+        self.player = None
+        self.enemies = []
+
+        # With an enemy AI (see ai.py) its search replaces the enemy's coin flip
+        self.enemy_ai = enemy_ai
+        self.enemy_choice = None
+
+        # Against a battle server (see server.py) the server plays the battle
+        # and this engine follows it in lockstep, taking the enemy's moves
+        # from its replies
+        self.remote = remote
+        self.server_reply = None
+        self.server_lost = False
+        if remote is not None:
+            self.enemy_ai = None
+
+        # Each battle's actions are recorded to record_path if given, and a
+        # replay plays its actions instead of the player
+        self.record_path = record_path
+        self.recorder = None
+        self.replay_player = ReplayPlayer(replay) if replay is not None else None
 
         # Create UI buttons
         button_width = 150
@@ -569,7 +1033,7 @@ class Battle:
         self.potion_button = Button(
             100 + (button_width + button_spacing) * 2, button_y,
             button_width, button_height,
-            f"Potion ({self.player.potions})", WHITE, LIGHT_BLUE
+            f"Potion ({self.engine.player.potions})", WHITE, LIGHT_BLUE
         )
 
         self.next_enemy_button = Button(
@@ -585,11 +1049,32 @@ class Battle:
             self.next_enemy_button
         ]
 
+        # Fixed-timestep simulation clock
+        self.sim_time = 0.0  # Milliseconds of simulated battle time
+        self.sim_steps = 0
+        self.accumulator = 0.0
+        self.interpolation = 1.0
+
         # Battle state
-        self.player_turn = True
+        self.scheduler = Scheduler()
+        self.player_turn = self.engine.player_turn
+        self.enemy_turn_pending = False
         self.battle_active = True
-        self.battle_message = "Battle begins! Your turn!"
-        self.message_timer = 180  # Frames to display a message
+        self.message_task = None
+        self.show_message("Battle begins! Your turn!")
+
+        # Retained-mode drawing of the battle scene
+        self.message_bg = pygame.Rect(SCREEN_WIDTH // 2 - 250, 10, 500, 40)
+        self.stat_bg = pygame.Rect(15, 15, 150, 105)
+        self.battle_renderer = DirtyRenderer()
+        self.drawn_state = None
+        self.needs_redraw = True
+        self.pending_events = []
+
+        # Best move hint, toggled with H
+        self.show_hint = False
+        self.hint_state = None
+        self.hint_future = None
 
         # Main menu button
         self.start_button = Button(
@@ -605,331 +1090,838 @@ class Battle:
             "Play Again", WHITE, LIGHT_BLUE
         )
 
-    def draw_battle_scene(self):
-        # Draw background
-        screen.blit(self.battle_bg, (0, 0))
+        # Without a loader every image is loaded right here. With one, a
+        # loading screen is shown until the menu's images are in, and the
+        # battle's images keep streaming in while the player is on the menu.
+        self.loader = loader
+        self.finished_stages = set()
+        self.loading_stage = None
+        self.after_loading = None
+        if loader is None:
+            self.finish_stage("menu")
+            self.finish_stage("battle")
+            if replay is not None:
+                self.game_state = "battle"
+            elif snapshot is not None:
+                self.game_state = snapshot.game_state
+        elif replay is not None:
+            self.wait_for_stage("battle", "battle")
+        elif snapshot is not None:
+            self.wait_for_stage("battle", snapshot.game_state)
+        else:
+            self.wait_for_stage("menu", "main_menu")
+
+    # Build everything that needs the images of a loading stage. With a loader
+    # the images are already converted, so this only hits the asset cache.
+    def finish_stage(self, stage):
+        if stage == "menu":
+            self.menu_bg = assets.get_background("menu_bg", (SCREEN_WIDTH, SCREEN_HEIGHT), MENU_BG_COLOR)
+            if self.parallax_enabled:
+                self.parallax = create_parallax()
+
+            # Pre-built layer for the menu, which is only redrawn when
+            # something on it changes
+            self.menu_layer = self.build_menu_layer()
+            if self.parallax is not None:
+                self.menu_overlay, self.menu_layer = self.menu_layer, self.menu_bg.copy()
+        elif stage == "battle":
+            self.battle_bg = assets.get_background("battle_bg", (SCREEN_WIDTH, SCREEN_HEIGHT), BATTLE_BG_COLOR)
+            self.create_characters()
+            self.particles = create_particles()
+            self.battle_layer = self.build_battle_layer()
+            if self.parallax is not None:
+                self.battle_overlay, self.battle_layer = self.battle_layer, self.battle_bg.copy()
+
+            # Pre-built layers for the end screens
+            self.game_over_layer = self.build_end_layer((255, 0, 0), "Game Over", WHITE, "You have been defeated!")
+            self.victory_layer = self.build_end_layer((0, 255, 0), "Victory!", GOLD,
+                                                      "You have defeated all enemies!")
+        self.finished_stages.add(stage)
+
+    # Show the loading screen until a stage is loaded, then go to next_state
+    def wait_for_stage(self, stage, next_state):
+        self.loading_stage = stage
+        self.after_loading = next_state
+        self.game_state = "loading"
+        self.update_loading()
+
+    # Convert newly decoded images and build each stage as soon as all of its
+    # images are in, leaving the loading screen once the awaited one is done
+    def update_loading(self):
+        if self.loader is None:
+            return
+        self.loader.poll()
+        for stage in ("menu", "battle"):
+            if stage not in self.finished_stages and self.loader.ready(stage):
+                self.finish_stage(stage)
+        if self.game_state == "loading":
+            self.needs_redraw = True
+            if self.loading_stage in self.finished_stages:
+                self.game_state = self.after_loading
+
+    # Characters for the engine's fighters, recycling the ones from the last
+    # battle
+    def create_characters(self):
+        pool = self.character_pool
+        if self.player is not None:
+            pool.release([self.player])
+        self.player = pool.acquire(self.engine.player, 250, 300)
+        self.create_enemy_characters()
+
+    # Characters for the engine's enemies, as when a new wave comes in. The
+    # player's character and its running animation are left alone, and each
+    # recycled character goes back to the same position, so an attack on the
+    # last enemy of a wave carries on smoothly.
+    def create_enemy_characters(self):
+        pool = self.character_pool
+        pool.release(reversed(self.enemies))
+        self.enemies = [pool.acquire(fighter, *ENEMY_POSITIONS[index % len(ENEMY_POSITIONS)])
+                        for index, fighter in enumerate(self.engine.enemies)]
+        self.characters = {character.name: character for character in [self.player] + self.enemies}
+
+    @property
+    def current_enemy(self):
+        return self.characters[self.engine.current_enemy.name]
+
+    # Static part of the battle scene: background, battle area, stats panel
+    # and the buttons in their idle state
+    def build_battle_layer(self):
+        layer = self.new_layer(self.battle_bg)
 
         # Draw battle area
-        pygame.draw.rect(screen, (200, 200, 200, 150), (50, 50, SCREEN_WIDTH - 100, 400), border_radius=5)
-        pygame.draw.rect(screen, BLACK, (50, 50, SCREEN_WIDTH - 100, 400), 2, border_radius=5)
+        pygame.draw.rect(layer, (200, 200, 200, 150), (50, 50, SCREEN_WIDTH - 100, 400), border_radius=5)
+        pygame.draw.rect(layer, BLACK, (50, 50, SCREEN_WIDTH - 100, 400), 2, border_radius=5)
 
-        # Draw characters
-        self.player.draw(screen)
-        self.current_enemy.draw(screen)
+        # Draw stat background
+        pygame.draw.rect(layer, (0, 0, 0, 150), self.stat_bg, border_radius=5)
+        pygame.draw.rect(layer, BLACK, self.stat_bg, 2, border_radius=5)
 
-        # Draw UI buttons
+        # Draw idle UI buttons
+        self.idle_button_keys = {}
         for button in self.buttons:
+            button.draw(layer)
+            self.idle_button_keys[button] = button.draw_key()
+        return layer
+
+    def draw_button(self, button):
+        # An idle button is already part of the static layer
+        if button.draw_key() != self.idle_button_keys.get(button):
             button.draw(screen)
 
+    # Draw the battle scene and return the screen areas that changed
+    def draw_battle_scene(self):
         # Update potion button text
-        self.potion_button.text = f"Potion ({self.player.potions})"
-
-        # Draw battle message
-        if self.message_timer > 0:
-            message_bg = pygame.Rect(SCREEN_WIDTH // 2 - 250, 10, 500, 40)
-            pygame.draw.rect(screen, (0, 0, 0, 150), message_bg, border_radius=10)
-            pygame.draw.rect(screen, BLACK, message_bg, 2, border_radius=10)
-
-            message_surface = font_medium.render(self.battle_message, True, WHITE)
-            screen.blit(message_surface, (SCREEN_WIDTH // 2 - message_surface.get_width() // 2, 20))
-            self.message_timer -= 1
-
-        # Draw turn indicator
+        self.potion_button.text = f"Potion ({self.engine.player.potions})"
+
+        widgets = []
+
+        # Characters
+        for character in (self.player, self.current_enemy):
+            character.interpolate(self.interpolation)
+            widgets.append((character.name, character.bounds(), character.draw_key(),
+                            lambda character=character: character.draw(screen)))
+
+        # Particles move every simulation step while any are alive. They are
+        # drawn between the last two steps like the characters are.
+        particles_ahead = (self.interpolation - 1) * SIM_STEP
+        widgets.append(("particles", self.particles.bounds(particles_ahead), self.sim_time + particles_ahead,
+                        lambda: self.particles.draw(screen, particles_ahead)))
+
+        # UI buttons
+        for index, button in enumerate(self.buttons):
+            widgets.append((f"button{index}", button.rect, button.draw_key(),
+                            lambda button=button: self.draw_button(button)))
+
+        # Battle message
+        message_rect = None
+        if self.message_visible:
+            message_surface = render_text(font_medium, self.battle_message, WHITE)
+            message_rect = message_surface.get_rect(midtop=(SCREEN_WIDTH // 2, 20)).union(self.message_bg)
+        widgets.append(("message", message_rect, self.battle_message, self.draw_message))
+
+        # Turn indicator
         turn_text = "Player's Turn" if self.player_turn else "Enemy's Turn"
         turn_color = BLUE if self.player_turn else RED
-        turn_surface = font_medium.render(turn_text, True, turn_color)
-        screen.blit(turn_surface, (SCREEN_WIDTH - turn_surface.get_width() - 20, 20))
+        turn_surface = render_text(font_medium, turn_text, turn_color)
+        turn_rect = turn_surface.get_rect(topright=(SCREEN_WIDTH - 20, 20))
+        widgets.append(("turn", turn_rect, turn_text,
+                        lambda: screen.blit(turn_surface, turn_rect)))
+
+        # Best move hint
+        hint_surface = None
+        if self.show_hint and self.player_turn:
+            hint_surface = render_text(font_small, self.hint_text(), BLACK)
+        hint_rect = hint_surface.get_rect(topright=(SCREEN_WIDTH - 20, 55)) if hint_surface else None
+        widgets.append(("hint", hint_rect, hint_surface,
+                        lambda: screen.blit(hint_surface, hint_rect)))
+
+        # Enemies left in an arena battle
+        arena_surface = arena_rect = None
+        if self.endless:
+            arena_text = f"Wave {self.engine.wave}, enemies left: {len(self.engine.alive)}/{len(self.engine.enemies)}"
+            arena_surface = render_text(font_small, arena_text, BLACK)
+            arena_rect = arena_surface.get_rect(topright=(SCREEN_WIDTH - 20, 80))
+        elif self.arena:
+            arena_text = f"Enemies left: {len(self.engine.alive)}/{self.arena}"
+            arena_surface = render_text(font_small, arena_text, BLACK)
+            arena_rect = arena_surface.get_rect(topright=(SCREEN_WIDTH - 20, 80))
+        widgets.append(("arena", arena_rect, arena_surface,
+                        lambda: screen.blit(arena_surface, arena_rect)))
+
+        # Player stats
+        player = self.engine.player
+        stats = (
+            f"Level: {player.level}",
+            f"EXP: {player.experience}/{player.level * self.engine.rules.level_up_factor}",
+            f"Attack: {player.attack}",
+            f"Defense: {player.defense}"
+        )
+        widgets.append(("stats", self.stat_bg, stats, lambda: self.draw_stats(stats)))
 
-        # Draw player stats
-        stat_x = 20
-        stat_y = 20
+        # Profiler overlay, redrawn only when its numbers are refreshed
+        profiler_rect = self.profiler_rect() if self.show_profiler else None
+        widgets.append(("profiler", profiler_rect, self.profiler_lines, self.draw_profiler))
 
-        # Draw stat background
-        stat_bg = pygame.Rect(stat_x - 5, stat_y - 5, 150, 105)
-        pygame.draw.rect(screen, (0, 0, 0, 150), stat_bg, border_radius=5)
-        pygame.draw.rect(screen, BLACK, stat_bg, 2, border_radius=5)
+        return self.battle_renderer.render(screen, self.battle_layer, widgets)
 
-        stats = [
-            f"Level: {self.player.level}",
-            f"EXP: {self.player.experience}/{self.player.level * 20}",
-            f"Attack: {self.player.attack}",
-            f"Defense: {self.player.defense}"
-        ]
+    def draw_message(self):
+        pygame.draw.rect(screen, (0, 0, 0, 150), self.message_bg, border_radius=10)
+        pygame.draw.rect(screen, BLACK, self.message_bg, 2, border_radius=10)
 
+        message_surface = render_text(font_medium, self.battle_message, WHITE)
+        screen.blit(message_surface, (SCREEN_WIDTH // 2 - message_surface.get_width() // 2, 20))
+
+    # Refresh the profiler overlay's numbers every PROFILER_REFRESH frames
+    def update_profiler_lines(self):
+        if not self.show_profiler or (self.profiler_lines and self.profiler.frames % PROFILER_REFRESH):
+            return
+        percentiles = self.profiler.percentiles()
+        counters = self.profiler.counters
+        blits = counters.get("blits", "-")
+        phases = sorted(self.profiler.phase_means().items(), key=lambda item: -item[1])[:3]
+        self.profiler_lines = (
+            "frame p50 {:.1f}  p95 {:.1f}  p99 {:.1f} ms".format(percentiles[50], percentiles[95], percentiles[99]),
+            f"blits {blits}  text renders {counters.get('text_renders', 0)}  "
+            f"asset misses {counters.get('asset_misses', 0)}",
+            *(f"{name} {mean:.2f} ms" for name, mean in phases),
+        )
+
+    def profiler_rect(self):
+        height = len(self.profiler_lines) * PROFILER_LINE_HEIGHT + 8
+        return pygame.Rect(SCREEN_WIDTH - 235, SCREEN_HEIGHT - height - 5, 230, height)
+
+    # The overlay renders its text directly so it does not show up in the
+    # text cache counters it reports
+    def draw_profiler(self):
+        rect = self.profiler_rect()
+        pygame.draw.rect(screen, BLACK, rect)
+        for row, line in enumerate(self.profiler_lines):
+            screen.blit(font_profiler.render(line, True, WHITE), (rect.x + 5, rect.y + 4 + row * PROFILER_LINE_HEIGHT))
+
+    # What the counters counted since the previous frame
+    def frame_counters(self):
+        totals = {"text_renders": text_cache.misses, "asset_misses": assets.misses}
+        if isinstance(screen, CountingSurface):
+            totals["blits"] = screen.blit_count
+        counters = {name: total - self.counter_totals.get(name, total) for name, total in totals.items()}
+        self.counter_totals = totals
+        return counters
+
+    def draw_stats(self, stats):
+        stat_x = self.stat_bg.x + 5
+        stat_y = self.stat_bg.y + 5
         for stat in stats:
-            stat_surface = font_small.render(stat, True, WHITE)
+            stat_surface = render_text(font_small, stat, WHITE)
             screen.blit(stat_surface, (stat_x, stat_y))
             stat_y += 20
 
-    def draw_main_menu(self):
-        # Draw background
-        screen.blit(self.menu_bg, (0, 0))
+    def hint_text(self):
+        # The solver only knows the regular roster and the coin-flipping enemy
+        if self.arena or self.endless or self.enemy_ai is not None:
+            return "Best move: not available in this mode"
+
+        state = state_from_engine(self.engine)
+        if state != self.hint_state:
+            self.hint_state = state
+            self.hint_future = hint_executor.submit(hint_solver.action_values, state)
+
+        if not self.hint_future.done():
+            return "Best move: thinking..."
+
+        action_values = self.hint_future.result()
+        best_action = max(action_values, key=action_values.get)
+        return f"Best move: {best_action.title()} ({action_values[best_action] * 100:.1f}% to win)"
+
+    # The menu is static apart from the start button, so everything else is
+    # composited into one layer up front
+    def build_menu_layer(self):
+        layer = self.new_layer(self.menu_bg)
 
         # Draw title
-        title_shadow = font_title.render("Fantasy Battle Arena", True, BLACK)
-        screen.blit(title_shadow, (SCREEN_WIDTH // 2 - title_shadow.get_width() // 2 + 2, 102))
+        title_shadow = render_text(font_title, "Fantasy Battle Arena", BLACK)
+        layer.blit(title_shadow, (SCREEN_WIDTH // 2 - title_shadow.get_width() // 2 + 2, 102))
 
-        title_surface = font_title.render("Fantasy Battle Arena", True, GOLD)
-        screen.blit(title_surface, (SCREEN_WIDTH // 2 - title_surface.get_width() // 2, 100))
+        title_surface = render_text(font_title, "Fantasy Battle Arena", GOLD)
+        layer.blit(title_surface, (SCREEN_WIDTH // 2 - title_surface.get_width() // 2, 100))
 
         # Draw subtitle
         subtitle_bg = pygame.Rect(SCREEN_WIDTH // 2 - 250, 180, 500, 50)
-        pygame.draw.rect(screen, (0, 0, 0, 150), subtitle_bg, border_radius=10)
+        pygame.draw.rect(layer, (0, 0, 0, 150), subtitle_bg, border_radius=10)
 
-        subtitle_surface = font_medium.render("Face off against fearsome fantasy creatures!", True, WHITE)
-        screen.blit(subtitle_surface, (SCREEN_WIDTH // 2 - subtitle_surface.get_width() // 2, 195))
+        subtitle_surface = render_text(font_medium, "Face off against fearsome fantasy creatures!", WHITE)
+        layer.blit(subtitle_surface, (SCREEN_WIDTH // 2 - subtitle_surface.get_width() // 2, 195))
 
         # Draw character previews
         char_spacing = 200
-        start_x = SCREEN_WIDTH // 2 - (3 * char_spacing) // 2 + char_spacing // 2
+        start_x = SCREEN_WIDTH // 2 - (MENU_PREVIEWS * char_spacing) // 2 + char_spacing // 2
 
         # Draw player preview
-        player_image = self.player.image
+        player_image = load_image(self.engine.player.kind)
         player_rect = player_image.get_rect(center=(start_x - char_spacing, 300))
-        screen.blit(player_image, player_rect)
+        layer.blit(player_image, player_rect)
 
-        # Draw enemy previews
-        for i, enemy in enumerate(self.enemies):
-            enemy_image = enemy.image
+        # Draw enemy previews; an arena only shows its first opponents
+        for i, enemy in enumerate(self.engine.enemies[:MENU_PREVIEWS]):
+            enemy_image = load_image(enemy.kind)
             enemy_rect = enemy_image.get_rect(center=(start_x + i * char_spacing, 300))
-            screen.blit(enemy_image, enemy_rect)
+            layer.blit(enemy_image, enemy_rect)
+
+        return layer
+
+    # Surface that the static parts of a screen are drawn on: a copy of its
+    # background, or with the parallax background a transparent overlay
+    # that is composited over the background whenever it scrolls
+    def new_layer(self, background):
+        if self.parallax is None:
+            return background.copy()
+        return pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+
+    # Recomposite the current screen's layer if the parallax background has
+    # scrolled since it was last drawn, and report whether it did
+    def update_parallax(self):
+        if self.parallax is None:
+            return False
+        if self.game_state == "main_menu":
+            layer, overlay = self.menu_layer, self.menu_overlay
+        elif self.game_state == "battle":
+            layer, overlay = self.battle_layer, self.battle_overlay
+        else:
+            return False
 
-        # Draw start button
-        self.start_button.draw(screen)
+        background, changed = self.parallax.render(pygame.time.get_ticks() / 1000)
+        if changed:
+            layer.blit(background, (0, 0))
+            layer.blit(overlay, (0, 0))
+        return changed
 
-    def draw_game_over(self):
-        # Draw background (red tint)
+    # Battle background with a colored tint and the end screen title
+    def build_end_layer(self, tint, title, title_color, message):
         overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-        overlay.fill((255, 0, 0))
+        overlay.fill(tint)
         overlay.set_alpha(100)
 
-        screen.blit(self.battle_bg, (0, 0))
-        screen.blit(overlay, (0, 0))
+        layer = self.battle_bg.copy()
+        layer.blit(overlay, (0, 0))
 
         # Draw title
-        title_surface = font_title.render("Game Over", True, WHITE)
-        screen.blit(title_surface, (SCREEN_WIDTH // 2 - title_surface.get_width() // 2, 150))
+        title_surface = render_text(font_title, title, title_color)
+        layer.blit(title_surface, (SCREEN_WIDTH // 2 - title_surface.get_width() // 2, 150))
 
         # Draw message
-        message_surface = font_medium.render("You have been defeated!", True, WHITE)
-        screen.blit(message_surface, (SCREEN_WIDTH // 2 - message_surface.get_width() // 2, 250))
+        message_surface = render_text(font_medium, message, WHITE)
+        layer.blit(message_surface, (SCREEN_WIDTH // 2 - message_surface.get_width() // 2, 250))
+        return layer
 
-        # Draw restart button
-        self.restart_button.draw(screen)
+    def draw_loading_screen(self):
+        screen.fill((30, 30, 45))
 
-    def draw_victory(self):
-        # Draw background (green tint)
-        overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
-        overlay.fill((0, 255, 0))
-        overlay.set_alpha(100)
+        title_surface = render_text(font_title, "Fantasy Battle Arena", GOLD)
+        screen.blit(title_surface, (SCREEN_WIDTH // 2 - title_surface.get_width() // 2, 180))
 
-        screen.blit(self.battle_bg, (0, 0))
-        screen.blit(overlay, (0, 0))
+        # Progress over every stage up to the one being waited for
+        stages = ("menu",) if self.loading_stage == "menu" else ("menu", "battle")
+        installed, queued = self.loader.progress(stages)
+        progress = installed / queued if queued else 1.0
 
-        # Draw title
-        title_surface = font_title.render("Victory!", True, GOLD)
-        screen.blit(title_surface, (SCREEN_WIDTH // 2 - title_surface.get_width() // 2, 150))
+        bar = pygame.Rect(SCREEN_WIDTH // 2 - 200, 320, 400, 24)
+        pygame.draw.rect(screen, GRAY, bar, border_radius=5)
+        pygame.draw.rect(screen, GREEN, (bar.x, bar.y, int(bar.width * progress), bar.height), border_radius=5)
+        pygame.draw.rect(screen, BLACK, bar, 2, border_radius=5)
 
-        # Draw message
-        message_surface = font_medium.render("You have defeated all enemies!", True, WHITE)
-        screen.blit(message_surface, (SCREEN_WIDTH // 2 - message_surface.get_width() // 2, 250))
+        status_surface = render_text(font_small, f"Loading images... {installed}/{queued}", WHITE)
+        screen.blit(status_surface, (SCREEN_WIDTH // 2 - status_surface.get_width() // 2, 355))
+
+    def draw_main_menu(self):
+        screen.blit(self.menu_layer, (0, 0))
+
+        # Draw start button
+        self.start_button.draw(screen)
+
+    def draw_game_over(self):
+        screen.blit(self.game_over_layer, (0, 0))
+
+        # Draw restart button
+        self.restart_button.draw(screen)
+
+    def draw_victory(self):
+        screen.blit(self.victory_layer, (0, 0))
 
         # Draw player's final stats
         stats_bg = pygame.Rect(SCREEN_WIDTH // 2 - 100, 300, 200, 80)
         pygame.draw.rect(screen, (0, 0, 0, 150), stats_bg, border_radius=10)
 
+        player = self.engine.player
         stats = [
-            f"Final Level: {self.player.level}",
-            f"Monsters Defeated: {len([enemy for enemy in self.enemies if not enemy.is_alive])}",
-            f"Potions Remaining: {self.player.potions}"
+            f"Final Level: {player.level}",
+            f"Monsters Defeated: {len([enemy for enemy in self.engine.enemies if not enemy.is_alive])}",
+            f"Potions Remaining: {player.potions}"
         ]
 
         for i, stat in enumerate(stats):
-            stat_surface = font_small.render(stat, True, WHITE)
+            stat_surface = render_text(font_small, stat, WHITE)
             screen.blit(stat_surface, (SCREEN_WIDTH // 2 - stat_surface.get_width() // 2, 310 + i * 20))
 
         # Draw restart button
         self.restart_button.draw(screen)
 
-    def update_battle(self):
-        # Update character animations
-        self.player.update_animation()
-        self.current_enemy.update_animation()
-
-        # Check if the enemy is dead and make the next enemy current
-        if not self.current_enemy.is_alive:
-            all_dead = True
-            for enemy in self.enemies:
-                if enemy.is_alive:
-                    all_dead = False
-                    break
-
-            if all_dead:
-                self.game_state = "victory"
+    def show_message(self, text):
+        # Replace the current message and restart its expiry timer
+        self.battle_message = text
+        self.message_visible = True
+        self.scheduler.cancel(self.message_task)
+        self.message_task = self.scheduler.call_later(MESSAGE_DURATION, self.hide_message)
 
-        # Check if player is dead
-        if not self.player.is_alive:
-            self.game_state = "game_over"
+    def hide_message(self):
+        self.message_visible = False
+        self.message_task = None
 
-        # If it's the enemy's turn and no animations are playing, make the enemy act
-        if not self.player_turn and not self.player.animating and not self.current_enemy.animating:
-            self.enemy_action()
+    def update_battle(self, dt=SIM_STEP):
+        # Update character animations
+        self.player.update_animation(dt)
+        self.current_enemy.update_animation(dt)
+        self.particles.update(dt)
+
+        # Victory and defeat are decided by the combat rules
+        if self.engine.state != "battle":
+            self.game_state = self.engine.state
+
+        # If it's the enemy's turn and no animations are playing, let the enemy
+        # think for a moment and then act
+        if (not self.player_turn and not self.enemy_turn_pending
+                and not self.player.animating and not self.current_enemy.animating):
+            self.enemy_turn_pending = True
+            self.scheduler.call_later(ENEMY_THINK_TIME, self.enemy_action)
+            if self.enemy_ai is not None:
+                root = self.enemy_ai.snapshot(self.engine)
+                if root is not None:
+                    self.enemy_choice = ai_executor.submit(self.enemy_ai.best_action, root)
+
+    # Run as many fixed simulation steps as fit into the elapsed frame time.
+    # A slow frame is caught up with extra steps rather than by slowing the
+    # game down, and the remainder sets how far to interpolate when drawing.
+    def advance(self, frame_time):
+        self.accumulator += min(frame_time, MAX_FRAME_TIME)
+        while self.accumulator >= SIM_STEP:
+            if self.replay_player is not None:
+                self.play_replay()
+            self.sim_steps += 1
+            self.sim_time += SIM_STEP * 1000
+            self.scheduler.update(self.sim_time)
+            self.update_battle(SIM_STEP)
+            self.accumulator -= SIM_STEP
+        self.interpolation = self.accumulator / SIM_STEP
+
+    def play_events(self, events):
+        # Start the animations for what just happened and show it as a message
+        for event in events:
+            if event.kind == "attack" or event.kind == "special":
+                attacker = self.characters[event.actor]
+                target = self.characters[event.target]
+                attacker.start_animation("attack", target)
+                target.start_animation("hit")
+            elif event.kind == "heal":
+                self.characters[event.target].start_animation("heal")
+            elif event.kind == "wave":
+                self.create_enemy_characters()
+
+            burst = PARTICLE_BURSTS.get(event.kind)
+            if burst:
+                style, count, offset, options = burst
+                target = self.characters[event.target]
+                self.particles.emit(style, target.original_x, target.y + offset, count, **options)
+
+        message = describe_events(events, self.engine.player.name)
+        if message:
+            self.show_message(message)
+
+    def player_action(self, action):
+        if self.recorder is not None:
+            self.recorder.record(self.sim_steps, action)
+        self.play_events(self.engine.player_action(action))
+        self.player_turn = self.engine.player_turn
+        if self.remote is not None:
+            self.server_reply = remote_executor.submit(self.remote.act, action)
+
+    # Take the replay's next action once it is due and the player could act
+    def play_replay(self):
+        if self.player_turn and not self.player.animating and not self.current_enemy.animating:
+            action = self.replay_player.due(self.sim_steps)
+            if action is not None:
+                self.player_action(action)
+
+    def save_recording(self):
+        if self.recorder is None:
+            return
+        replay = self.recorder.finish(self.engine)
+        replay.save(self.record_path)
+        self.recorder = None
+        print(f"Saved replay of seed {replay.seed} ({len(replay.inputs)} inputs) to {self.record_path}")
 
     def enemy_action(self):
-        if not self.current_enemy.is_alive:
-            # Find next alive enemy
-            alive_enemies = [enemy for enemy in self.enemies if enemy.is_alive]
-            if alive_enemies:
-                self.current_enemy = alive_enemies[0]
-            else:
-                self.game_state = "victory"
-                return
-
-        if self.current_enemy.stunned:
-            self.battle_message = f"{self.current_enemy.name} is stunned and misses their turn!"
-            self.message_timer = 180
-            self.current_enemy.stunned = False
-        else:
-            # Decide what the enemy will do
-            action = random.random()
-
-            if action < 0.7:  # 70% chance to use normal attack
-                result = self.current_enemy.attack_target(self.player)
-            else:  # 30% chance to use special ability
-                result = self.current_enemy.special_ability(self.player)
-
-            self.battle_message = result
-            self.message_timer = 180
-
-        # End enemy turn after a delay
-        pygame.time.delay(500)  # Small delay for readability
-        self.player_turn = True
-
-    def change_enemy(self):
-        # Cycle to the next enemy
-        alive_enemies = [enemy for enemy in self.enemies if enemy.is_alive]
-
-        if not alive_enemies:
-            self.game_state = "victory"
+        pending = self.server_reply or self.enemy_choice
+        if pending is not None and not pending.done():
+            # Still waiting for the server or the search; look again on the next step
+            self.scheduler.call_later(SIM_STEP * 1000, self.enemy_action)
             return
 
-        if self.current_enemy in alive_enemies:
-            current_index = alive_enemies.index(self.current_enemy)
-            next_index = (current_index + 1) % len(alive_enemies)
-            self.current_enemy = alive_enemies[next_index]
-        else:
-            self.current_enemy = alive_enemies[0]
+        choice = None
+        reply = None
+        if self.server_reply is not None:
+            try:
+                reply = self.server_reply.result()
+            except SESSION_ERRORS as error:
+                self.lose_server(error)
+                return
+            choice = reply.enemy_move
+        elif self.enemy_choice is not None:
+            choice = self.enemy_choice.result()
+        elif self.replay_player is not None:
+            index = self.engine.acting_index()
+            if index is not None and not self.engine.enemies[index].stunned:
+                choice = self.replay_player.enemy_action()
+        self.server_reply = self.enemy_choice = None
+        if choice is not None and self.recorder is not None:
+            self.recorder.record(self.sim_steps, "enemy_" + choice)
+        self.play_events(self.engine.enemy_turn(choice))
+        if reply is not None and (reply.state, reply.turns, reply.health) != engine_result(self.engine):
+            print(f"Out of step with the server: it has {reply.state} after {reply.turns} turns, "
+                  f"player health {reply.health}")
+
+        # Hand the turn back after a short pause for readability
+        self.scheduler.call_later(TURN_HANDOFF_DELAY, self.end_enemy_turn)
+
+    # Ask the server for a new battle and follow it; waits once per battle
+    # for the seed. Reconnects first if the last session failed.
+    def start_remote_battle(self):
+        try:
+            if self.server_lost:
+                remote_executor.submit(self.remote.reconnect).result()
+                self.server_lost = False
+            seed = remote_executor.submit(self.remote.start, -1, self.arena, self.endless).result()
+        except SESSION_ERRORS as error:
+            self.lose_server(error)
+            return False
+        self.engine.reset(seed)
+        self.create_characters()
+        return True
+
+    # The battle cannot go on without the server, so go back to the main
+    # menu; the next battle tries to reconnect
+    def lose_server(self, error):
+        print(f"Lost the battle server: {error}")
+        self.server_lost = True
+        self.save_recording()
+        self.reset_game()
+        self.show_message(f"Lost the battle server: {error}")
+
+    # Quick-save (F5) and quick-load (F9)
+    def save_snapshot(self, path=QUICKSAVE_PATH):
+        Snapshot.capture(self.engine, self.game_state).save(path)
+        self.show_message("Game saved")
+
+    def load_snapshot(self, path=QUICKSAVE_PATH):
+        if self.remote is not None or self.replay_player is not None:
+            self.show_message("Loading is not available while playing on a server or a replay")
+            return
+        try:
+            snapshot = Snapshot.load(path)
+        except (OSError, ValueError) as error:
+            self.show_message(f"Could not load {path}: {error}")
+            return
+        self.restore_snapshot(snapshot)
+        self.show_message("Game loaded")
+
+    # Continue from a snapshot. Animations and anything queued are dropped,
+    # and a pending enemy turn starts over.
+    def restore_snapshot(self, snapshot):
+        self.save_recording()
+        snapshot.restore(self.engine)
+        self.arena = snapshot.arena
+        self.endless = snapshot.endless
+        self.restored = True
+        self.create_characters()
+
+        self.scheduler.clear()
+        self.particles.clear()
+        self.player_turn = self.engine.player_turn
+        self.enemy_turn_pending = False
+        self.enemy_choice = None
+        self.server_reply = None
+        self.message_task = None
+        self.game_state = snapshot.game_state
+        self.battle_renderer.invalidate()
+        self.needs_redraw = True
+
+    # Keep the battle for --restore when the game crashes
+    def save_crash_snapshot(self):
+        if self.game_state != "battle":
+            return
+        try:
+            Snapshot.capture(self.engine, self.game_state).save(CRASH_SNAPSHOT_PATH)
+        except Exception as error:
+            print(f"Could not save the battle: {error}")
+            return
+        print(f"Saved the battle to {CRASH_SNAPSHOT_PATH}; continue it with --restore {CRASH_SNAPSHOT_PATH}")
 
-        self.battle_message = f"You are now facing {self.current_enemy.name}!"
-        self.message_timer = 180
+    def end_enemy_turn(self):
+        self.enemy_turn_pending = False
+        self.player_turn = self.engine.player_turn
 
     def reset_game(self):
-        # Reset player
-        self.player = Player("Hero", 250, 300)
-
-        # Reset enemies
-        self.goblin = Goblin("Gobbly", 750, 200)
-        self.orc = Orc("Grog", 750, 300)
-        self.elf = Elf("Elindril", 750, 400)
+        # Reset the combat engine and rebuild the characters around it
+        self.engine.reset()
+        self.create_characters()
 
-        self.enemies = [self.goblin, self.orc, self.elf]
-        self.current_enemy_index = 0
-        self.current_enemy = self.enemies[self.current_enemy_index]
-
-        # Reset battle state
+        # Reset battle state, dropping anything still queued from the last game
+        self.scheduler.clear()
+        self.particles.clear()
         self.player_turn = True
+        self.enemy_turn_pending = False
+        self.enemy_choice = None
+        self.server_reply = None
+        self.restored = False
         self.battle_active = True
-        self.battle_message = "Battle begins! Your turn!"
-        self.message_timer = 180
+        self.message_task = None
+        self.show_message("Battle begins! Your turn!")
 
         # Return to main menu
         self.game_state = "main_menu"
 
     def handle_events(self):
         mouse_pos = pygame.mouse.get_pos()
+        events = self.pending_events + pygame.event.get()
+        self.pending_events = []
 
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
+                if self.loader is not None:
+                    self.loader.shutdown()
+                self.profiler.close()
+                self.save_recording()
+                if self.engine.sink is not None:
+                    self.engine.sink.close()
+                if self.remote is not None:
+                    self.remote.close()
+                assets.report()
+                text_cache.report()
                 pygame.quit()
                 sys.exit()
 
+            if event.type == ASSET_LOADED:
+                self.update_loading()
+
+            if event.type in REDRAW_EVENTS:
+                self.needs_redraw = True
+                self.battle_renderer.invalidate()
+
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                self.show_profiler = not self.show_profiler
+                self.profiler_lines = ()
+                self.needs_redraw = True
+                self.battle_renderer.invalidate()
+
+            if event.type == pygame.KEYDOWN and self.game_state != "loading":
+                if event.key == pygame.K_F5 and self.game_state == "battle":
+                    self.save_snapshot()
+                elif event.key == pygame.K_F9 and "battle" in self.finished_stages:
+                    self.load_snapshot()
+
             if self.game_state == "main_menu":
-                self.start_button.update(mouse_pos)
+                if self.start_button.update(mouse_pos):
+                    self.needs_redraw = True
                 if self.start_button.is_clicked(event):
-                    self.game_state = "battle"
+                    self.show_message(self.battle_message)
+                    if "battle" in self.finished_stages:
+                        self.game_state = "battle"
+                    else:
+                        self.wait_for_stage("battle", "battle")
 
             elif self.game_state == "battle":
-                # Only process button clicks during player's turn and when no animations are active
-                if self.player_turn and not self.player.animating and not self.current_enemy.animating:
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_h:
+                    self.show_hint = not self.show_hint
+
+                # Only process button clicks during player's turn and when no
+                # animations are active, and not while a replay is playing
+                replaying = self.replay_player is not None and not self.replay_player.finished
+                if (self.player_turn and not replaying
+                        and not self.player.animating and not self.current_enemy.animating):
                     # Update all buttons
                     for button in self.buttons:
                         button.update(mouse_pos)
 
                     # Check for button clicks
                     if self.attack_button.is_clicked(event):
-                        result = self.player.attack_target(self.current_enemy)
-                        self.battle_message = result
-                        self.message_timer = 180
-                        self.player_turn = False
+                        self.player_action("attack")
 
                     elif self.special_button.is_clicked(event):
-                        result = self.player.special_ability(self.current_enemy)
-                        self.battle_message = result
-                        self.message_timer = 180
-                        self.player_turn = False
+                        self.player_action("special")
 
                     elif self.potion_button.is_clicked(event):
-                        result = self.player.use_potion()
-                        self.battle_message = result
-                        self.message_timer = 180
-                        if "Potions left" in result:  # If potion was successfully used
-                            self.player_turn = False
+                        self.player_action("potion")
 
                     elif self.next_enemy_button.is_clicked(event):
-                        self.change_enemy()
+                        self.player_action("next_enemy")
 
             elif self.game_state == "game_over" or self.game_state == "victory":
-                self.restart_button.update(mouse_pos)
+                if self.restart_button.update(mouse_pos):
+                    self.needs_redraw = True
                 if self.restart_button.is_clicked(event):
                     self.reset_game()
 
+    # Sleep until an event arrives or the timeout passes, keeping the event
+    # for the next handle_events call
+    def wait_for_event(self, timeout=IDLE_WAIT_TIMEOUT):
+        event = pygame.event.wait(timeout)
+        if event.type != pygame.NOEVENT:
+            self.pending_events.append(event)
+
     def run(self):
-        while True:
+        try:
+            while True:
+                self.frame()
+        except Exception:
+            self.save_crash_snapshot()
+            raise
+
+    # One pass of the game loop, split into profiled phases: event handling,
+    # simulation, drawing, presenting, and sleeping in clock.tick or while
+    # idle. Benchmarks pass a fixed frame_time to step the battle without the
+    # frame cap, and wait=False to skip sleeping on idle screens.
+    def frame(self, frame_time=None, wait=True):
+        profiler = self.profiler
+        profiler.next_frame(self.frame_counters())
+        self.update_profiler_lines()
+        with profiler.phase("handle_events"):
             self.handle_events()
 
-            if self.game_state == "main_menu":
-                self.draw_main_menu()
-            elif self.game_state == "battle":
-                self.update_battle()
-                self.draw_battle_scene()
-            elif self.game_state == "game_over":
-                self.draw_game_over()
-            elif self.game_state == "victory":
-                self.draw_victory()
-
-            pygame.display.flip()
-            clock.tick(FPS)
-
-
-# Draw special effects
-def draw_particle_effect(surface, x, y, color, size, count):
-    for _ in range(count):
-        angle = random.uniform(0, math.pi * 2)
-        speed = random.uniform(1, 3)
-        particle_x = x + math.cos(angle) * random.uniform(0, 20)
-        particle_y = y + math.sin(angle) * random.uniform(0, 20)
-        particle_size = random.uniform(size / 2, size)
-
-        pygame.draw.circle(surface, color, (int(particle_x), int(particle_y)), int(particle_size))
-
+        # Every screen is redrawn from scratch whenever it is entered
+        if self.game_state != self.drawn_state:
+            self.battle_renderer.invalidate()
+            self.needs_redraw = True
+            self.drawn_state = self.game_state
+            if self.parallax is not None:
+                self.parallax.invalidate()
+            if self.game_state == "battle":
+                # Time spent on the menu does not count as battle time
+                clock.tick()
+                self.accumulator = 0.0
+                started = self.remote is None or self.start_remote_battle()
+                if started and self.record_path is not None and not self.restored:
+                    self.recorder = ReplayRecorder(self.engine.current_seed, self.sim_steps, self.arena,
+                                                   self.endless)
+                if self.replay_player is not None:
+                    self.replay_player.start(self.sim_steps)
+            else:
+                self.save_recording()
+
+        if self.game_state == "battle":
+            if frame_time is None:
+                with profiler.phase("clock.tick"):
+                    frame_time = clock.tick(self.fps) / 1000
+            with profiler.phase("update_battle"):
+                self.advance(frame_time)
+            with profiler.phase("draw_battle_scene"):
+                if self.update_parallax():
+                    self.battle_renderer.invalidate()
+                dirty_rects = self.draw_battle_scene()
+            if dirty_rects:
+                with profiler.phase("display.update"):
+                    present(dirty_rects)
+            return
 
-def draw_heal_effect(surface, character):
-    if character.animation_type == "heal" and character.animating:
-        particles = int(character.animation_frames)
-        draw_particle_effect(surface, character.x, character.y, GREEN, 5, particles)
+        # The menu and end screens only change on hover, clicks and window
+        # events, so when nothing changed the loop sleeps instead of drawing.
+        # A scrolling menu background also wakes it once per frame.
+        if self.update_parallax():
+            self.needs_redraw = True
+        if not self.needs_redraw:
+            if wait:
+                with profiler.phase("wait"):
+                    if self.parallax is not None and self.game_state == "main_menu":
+                        self.wait_for_event(1000 // self.fps)
+                    else:
+                        self.wait_for_event()
+            return
 
+        draw = {
+            "loading": self.draw_loading_screen,
+            "main_menu": self.draw_main_menu,
+            "game_over": self.draw_game_over,
+            "victory": self.draw_victory,
+        }[self.game_state]
+        with profiler.phase(draw.__name__):
+            draw()
+            if self.show_profiler:
+                self.draw_profiler()
+
+        self.needs_redraw = False
+        with profiler.phase("display.flip"):
+            present()
+        if wait:
+            with profiler.phase("clock.tick"):
+                clock.tick(self.fps)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fantasy Battle Arena")
+    parser.add_argument("--fps", type=int, default=FPS,
+                        help="frames drawn per second; the simulation always runs at 60 Hz")
+    parser.add_argument("--parallax", action="store_true",
+                        help="scroll a parallax background behind the menu and the battle")
+    parser.add_argument("--asset-report", action="store_true",
+                        help="print asset sizes and blit timings before and after display conversion")
+    parser.add_argument("--profile", action="store_true",
+                        help="show the frame profiler overlay (F3) from the start and count blits")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record every frame's phases and write them as a Chrome trace on exit")
+    parser.add_argument("--record", metavar="FILE",
+                        help="save a replay of each battle to FILE when it ends or the game is closed")
+    parser.add_argument("--replay", metavar="FILE", help="play back a replay recorded with --record")
+    parser.add_argument("--arena", type=int, default=0, metavar="N",
+                        help="fight N enemies in a row instead of the regular three")
+    parser.add_argument("--endless", action="store_true",
+                        help="survive endless, ever stronger waves of enemies")
+    parser.add_argument("--ai", choices=list(DIFFICULTIES),
+                        help="let enemies search for their best move instead of choosing at random")
+    parser.add_argument("--restore", metavar="FILE",
+                        help="continue a battle saved with F5 or after a crash")
+    parser.add_argument("--server", metavar="ADDRESS",
+                        help="play on a battle server at HOST:PORT or unix:PATH (see server.py)")
+    parser.add_argument("--event-log", metavar="FILE",
+                        help="append every combat event to a JSON lines file, rotated at 64 MiB")
+    args = parser.parse_args(argv)
+    if not 0 <= args.arena <= MAX_ARENA:
+        parser.error(f"--arena must be between 0 and {MAX_ARENA}")
+    if args.server and (args.ai or args.replay or args.restore):
+        parser.error("--server cannot be combined with --ai, --replay or --restore; the server runs the battle")
+    if args.replay and args.restore:
+        parser.error("--replay and --restore cannot be combined")
+    enemy_ai = SearchAI(*DIFFICULTIES[args.ai]) if args.ai else None
+    remote = RemoteSession(args.server) if args.server else None
+    snapshot = Snapshot.load(args.restore) if args.restore else None
+    replay = Replay.load(args.replay) if args.replay else None
+    event_sink = JsonlSink(args.event_log, max_bytes=EVENT_LOG_MAX_BYTES) if args.event_log else None
 
-def main():
     # Print instructions for adding images
     print("\nFantasy Battle Arena")
     print("--------------------")
@@ -946,10 +1938,29 @@ def main():
     print("- menu_bg.png - Main menu background")
     print("- battle_bg.png - Battle scene background")
 
-    # Start the game
-    game = Battle()
+    # Start the game. Images stream in behind a loading screen, except for
+    # the asset report, which needs them all up front.
+    init_display(count_blits=args.profile or args.trace is not None)
+    loader = None
+    if not args.asset_report:
+        loader = AssetLoader(assets)
+        queue_assets(loader, args.parallax)
+    game = Battle(fps=args.fps, loader=loader, parallax=args.parallax,
+                  profiler=FrameProfiler(trace_path=args.trace), replay=replay, record_path=args.record,
+                  event_sink=event_sink, arena=args.arena, endless=args.endless, enemy_ai=enemy_ai,
+                  remote=remote, snapshot=snapshot)
+    game.show_profiler = args.profile
+    if args.asset_report:
+        assets.format_report(screen)
     game.run()
 
 
+# Headless parameter sweep over the combat rules: python lab.py sweep --param ...
+def sweep_main(argv=None):
+    return sweep.main(argv)
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["sweep"]:
+        sys.exit(sweep_main(sys.argv[2:]))
     main()
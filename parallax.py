@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import argparse
+
+import pygame
+
+import pixel_cache
+
+# Scrolling parallax background made of horizontal bands, each moving at its
+# own speed. Every band is scaled once and laid out as a strip holding the
+# band and its mirror image, so it wraps around without a seam and without
+# any per-frame scaling: a frame is at most two area-clipped blits per band.
+# The composite is kept between frames and only redrawn when some band has
+# moved by at least a pixel.
+
+
+class ParallaxLayer:
+    # image is the band at its final size; it is drawn at height y and moves
+    # speed pixels per second to the left
+    def __init__(self, image, y, speed):
+        self.width, self.height = image.get_size()
+        self.strip = pygame.Surface((self.width * 2, self.height), 0, image)
+        self.strip.blit(image, (0, 0))
+        self.strip.blit(pygame.transform.flip(image, True, False), (self.width, 0))
+        self.y = y
+        self.speed = speed
+
+    def offset(self, seconds):
+        return int(seconds * self.speed) % (self.width * 2)
+
+    def draw(self, target, offset):
+        period = self.width * 2
+        target_width = target.get_width()
+        first = min(period - offset, target_width)
+        target.blit(self.strip, (0, self.y), (offset, 0, first, self.height))
+        if first < target_width:
+            target.blit(self.strip, (first, self.y), (0, 0, target_width - first, self.height))
+
+
+class ParallaxBackground:
+    def __init__(self, layers, size, fill_color=(0, 0, 0)):
+        self.layers = layers
+        self.surface = pygame.Surface(size, 0, layers[0].strip) if layers else pygame.Surface(size)
+        self.fill_color = fill_color
+        self.offsets = None
+
+        # Bands that leave rows uncovered need the composite cleared first
+        covered = 0
+        for layer in sorted(layers, key=lambda layer: layer.y):
+            if layer.y > covered:
+                break
+            covered = max(covered, layer.y + layer.height)
+        self.covered = covered >= size[1]
+
+    # Composite at the given time, and whether it changed since the last call
+    def render(self, seconds):
+        offsets = tuple(layer.offset(seconds) for layer in self.layers)
+        if offsets == self.offsets:
+            return self.surface, False
+
+        if not self.covered:
+            self.surface.fill(self.fill_color)
+        for layer, offset in zip(self.layers, offsets):
+            layer.draw(self.surface, offset)
+        self.offsets = offsets
+        return self.surface, True
+
+    # Force the next render to redraw, e.g. when the composite was copied to
+    # a layer that has since been drawn over
+    def invalidate(self):
+        self.offsets = None
+
+
+# Bands of the battle arena backgrounds: image, source row, screen row,
+# height and speed in pixels per second. Rows are in the image scaled to
+# the screen size.
+DEFAULT_BANDS = [
+    ("sky", 0, 0, 230, 6),
+    ("mountains", 170, 230, 170, 18),
+    ("trees", 400, 400, 200, 40),
+]
+
+
+# Layers for the bands, cut from backgrounds already scaled to the screen
+def build_layers(backgrounds, bands=DEFAULT_BANDS):
+    layers = []
+    for name, source_y, y, height, speed in bands:
+        background = backgrounds[name]
+        band = background.subsurface((0, source_y, background.get_width(), height))
+        layers.append(ParallaxLayer(band, y, speed))
+    return layers
+
+
+# Frame cost of the parallax background against rescaling the three images
+# every frame, with every band scrolling each frame and with nothing moving
+def benchmark(size, frames, folder="images"):
+    target = pygame.display.get_surface()
+    images = {name: pygame.image.load(os.path.join(folder, f"{name}.png")).convert() for name, *_ in DEFAULT_BANDS}
+    backgrounds = {name: pygame.transform.scale(image, size) for name, image in images.items()}
+
+    def rescale_every_frame(frame):
+        for name, source_y, y, height, speed in DEFAULT_BANDS:
+            scaled = pygame.transform.scale(images[name], size)
+            target.blit(scaled, (0, y), (int(frame * speed / 60) % size[0], source_y, size[0], height))
+
+    # Speeds well above a pixel per frame, so every band moves every frame
+    fast = [(name, source_y, y, height, speed * 30) for name, source_y, y, height, speed in DEFAULT_BANDS]
+    scrolling = ParallaxBackground(build_layers(backgrounds, fast), size)
+    still = ParallaxBackground(build_layers(backgrounds), size)
+
+    def parallax_scrolling(frame):
+        surface, _ = scrolling.render(frame / 60)
+        target.blit(surface, (0, 0))
+
+    def parallax_still(frame):
+        surface, _ = still.render(0.0)
+        target.blit(surface, (0, 0))
+
+    print(f"{len(DEFAULT_BANDS)} bands at {size[0]}x{size[1]}, {frames} frames each, "
+          f"including the full-screen blit to the display")
+    for label, draw in (("rescale per frame", rescale_every_frame),
+                        ("parallax, scrolling", parallax_scrolling),
+                        ("parallax, cached", parallax_still)):
+        start = time.perf_counter()
+        for frame in range(frames):
+            draw(frame)
+        per_frame = (time.perf_counter() - start) / frames * 1000
+        print(f"  {label:<20} {per_frame:6.2f} ms/frame ({per_frame / (1000 / 60) * 100:5.1f}% of a 60 FPS frame)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the parallax background")
+    parser.add_argument("--size", type=int, nargs=2, default=(1000, 600), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("-n", "--frames", type=int, default=600)
+    args = parser.parse_args(argv)
+
+    pixel_cache.hidden_display(tuple(args.size))
+    benchmark(tuple(args.size), args.frames)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
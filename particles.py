@@ -0,0 +1,147 @@
+import math
+
+import numpy as np
+import pygame
+
+# Pooled particle engine. Position, velocity, lifetime and sprite of every
+# particle live in preallocated NumPy arrays; emitting takes slots from a free
+# list and expired particles give them back, so nothing is allocated per
+# particle. All live particles are advanced in one vectorized step and drawn
+# with a single Surface.blits call from sprites rasterized up front.
+
+
+# Fading frames of a soft round particle, from nearly transparent to solid
+def circle_frames(color, radius, frames=8):
+    sprites = []
+    for frame in range(1, frames + 1):
+        strength = frame / frames
+        size = max(1, round(radius * (0.5 + 0.5 * strength)))
+        sprite = pygame.Surface((size * 2, size * 2), pygame.SRCALPHA)
+        pygame.draw.circle(sprite, (*color, int(255 * strength)), (size, size), size)
+        sprites.append(sprite.convert_alpha())
+    return sprites
+
+
+# Fading frames of an image particle, e.g. the stun stars
+def image_frames(image, size, frames=8):
+    scaled = pygame.transform.smoothscale(image, size).convert_alpha()
+    sprites = []
+    for frame in range(1, frames + 1):
+        sprite = scaled.copy()
+        sprite.set_alpha(int(255 * frame / frames))
+        sprites.append(sprite)
+    return sprites
+
+
+class ParticleSystem:
+    def __init__(self, capacity=4096, seed=None):
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.vx = np.zeros(capacity)
+        self.vy = np.zeros(capacity)
+        self.gravity = np.zeros(capacity)
+        self.life = np.zeros(capacity)
+        self.max_life = np.ones(capacity)
+        self.style = np.zeros(capacity, dtype=np.int64)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.free = list(range(capacity - 1, -1, -1))
+
+        # Every frame of every style in one flat table, with the offset of each
+        # style's first frame and the half size used to center a sprite
+        self.sprites = []
+        self.style_offsets = []
+        self.style_frames = []
+        self.half_width = np.zeros(0)
+        self.half_height = np.zeros(0)
+        self.styles = {}
+
+    def add_style(self, name, frames):
+        self.styles[name] = len(self.style_offsets)
+        self.style_offsets.append(len(self.sprites))
+        self.style_frames.append(len(frames))
+        self.sprites.extend(frames)
+        self.half_width = np.array([sprite.get_width() // 2 for sprite in self.sprites])
+        self.half_height = np.array([sprite.get_height() // 2 for sprite in self.sprites])
+        self.offset_table = np.array(self.style_offsets)
+        self.frame_table = np.array(self.style_frames)
+
+    @property
+    def count(self):
+        return self.capacity - len(self.free)
+
+    # Emit up to count particles around (x, y). Speeds are in pixels per second,
+    # angles in radians and lifetimes in seconds; each is a (low, high) range.
+    def emit(self, style, x, y, count, speed=(20, 80), angle=(0, 2 * math.pi),
+             life=(0.4, 0.8), radius=0, gravity=0.0):
+        count = min(count, len(self.free))
+        if count == 0:
+            return
+        slots = np.array(self.free[-count:])
+        del self.free[-count:]
+
+        rng = self.rng
+        angles = rng.uniform(angle[0], angle[1], count)
+        speeds = rng.uniform(speed[0], speed[1], count)
+        offsets = rng.uniform(0, radius, count)
+        self.x[slots] = x + np.cos(angles) * offsets
+        self.y[slots] = y + np.sin(angles) * offsets
+        self.vx[slots] = np.cos(angles) * speeds
+        self.vy[slots] = np.sin(angles) * speeds
+        self.gravity[slots] = gravity
+        self.life[slots] = self.max_life[slots] = rng.uniform(life[0], life[1], count)
+        self.style[slots] = self.styles[style]
+        self.active[slots] = True
+
+    def update(self, dt):
+        active = self.active
+        self.vy[active] += self.gravity[active] * dt
+        self.x[active] += self.vx[active] * dt
+        self.y[active] += self.vy[active] * dt
+        self.life[active] -= dt
+
+        expired = np.flatnonzero(active & (self.life <= 0))
+        if expired.size:
+            self.active[expired] = False
+            self.free.extend(expired.tolist())
+
+    # Screen area covered by live particles as draw() places them, or None
+    # when there are none
+    def bounds(self, ahead=0.0):
+        slots = np.flatnonzero(self.active)
+        if slots.size == 0:
+            return None
+        xs = self.x[slots] + self.vx[slots] * ahead
+        ys = self.y[slots] + self.vy[slots] * ahead
+        margin_x = int(self.half_width.max()) + 2
+        margin_y = int(self.half_height.max()) + 2
+        left = int(xs.min()) - margin_x
+        top = int(ys.min()) - margin_y
+        right = int(xs.max()) + margin_x
+        bottom = int(ys.max()) + margin_y
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    # Draw all live particles; ahead extrapolates positions by that many
+    # seconds so drawing can be interpolated between simulation steps
+    def draw(self, surface, ahead=0.0):
+        slots = np.flatnonzero(self.active)
+        if slots.size == 0:
+            return
+
+        style = self.style[slots]
+        frames = self.frame_table[style]
+        fade = np.clip(self.life[slots] / self.max_life[slots], 0, 1)
+        sprite = self.offset_table[style] + np.minimum(frames - 1, (fade * frames).astype(np.int64))
+
+        xs = (self.x[slots] + self.vx[slots] * ahead - self.half_width[sprite]).astype(np.int64)
+        ys = (self.y[slots] + self.vy[slots] * ahead - self.half_height[sprite]).astype(np.int64)
+
+        sprites = self.sprites
+        surface.blits([(sprites[index], (x, y)) for index, x, y in zip(sprite.tolist(), xs.tolist(), ys.tolist())],
+                      doreturn=False)
+
+    def clear(self):
+        self.active[:] = False
+        self.free = list(range(self.capacity - 1, -1, -1))
@@ -0,0 +1,170 @@
+import os
+import sys
+import mmap
+import time
+import shutil
+import struct
+import argparse
+
+import pygame
+
+# On-disk cache of decoded, scaled and display-converted pixels for the
+# full-screen backgrounds. The first launch decodes the PNG, scales it to
+# the window and stores the converted pixels raw in .asset_cache/. Later
+# launches memory-map that file and wrap it with pygame.image.frombuffer,
+# so there is no decode or scale step.
+#
+# The wrapped buffer has an alpha mask over the padding byte, so it is
+# converted once to a real display Surface. The pixel layouts already
+# match, which makes that a plain copy. Without it, copies of the
+# background and translucent shapes drawn onto them would blend.
+#
+# Each entry is named after the image and target size. Its header records
+# the source file's size and modification time and the display pixel
+# layout. An entry that no longer matches is rebuilt. Only the common
+# 32-bit display layouts are cached; anything else falls back to
+# decoding every time.
+
+CACHE_FOLDER = ".asset_cache"
+MAGIC = b"FBPX"
+VERSION = 1
+HEADER = struct.Struct("<4sHHqqII4s")
+HEADER_SIZE = 64  # Pixel data starts on a cache-line boundary
+
+# Byte order of a pixel for frombuffer/tobytes, keyed by the display's
+# red, green and blue masks on a little-endian machine
+PIXEL_LAYOUTS = {
+    (0xFF0000, 0x00FF00, 0x0000FF): "BGRA",
+    (0x0000FF, 0x00FF00, 0xFF0000): "RGBA",
+}
+
+
+def pixel_layout(target):
+    if sys.byteorder != "little" or target.get_bitsize() != 32:
+        return None
+    return PIXEL_LAYOUTS.get(tuple(target.get_masks()[:3]))
+
+
+def entry_path(name, size, folder=CACHE_FOLDER):
+    width, height = size
+    return os.path.join(folder, f"{name}-{width}x{height}.pix")
+
+
+def source_header(source_path, size, layout):
+    stat = os.stat(source_path)
+    return HEADER.pack(MAGIC, VERSION, 0, stat.st_size, stat.st_mtime_ns, size[0], size[1], layout.encode())
+
+
+# Surface wrapping the cached pixels of source_path scaled to size, or None
+# if there is no up-to-date entry for the display's pixel layout. Nothing
+# here needs the display, so loader threads can call it.
+def read(name, source_path, size, target, folder=CACHE_FOLDER):
+    layout = pixel_layout(target)
+    if layout is None:
+        return None
+    try:
+        expected = source_header(source_path, size, layout)
+        with open(entry_path(name, size, folder), "rb") as entry:
+            if entry.read(HEADER.size) != expected:
+                return None
+            pixels = mmap.mmap(entry.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    if len(pixels) != HEADER_SIZE + size[0] * size[1] * 4:
+        return None
+    return pygame.image.frombuffer(memoryview(pixels)[HEADER_SIZE:], size, layout)
+
+
+# Display Surface from the cache, or None if there is no up-to-date entry
+def load(name, source_path, size, target, folder=CACHE_FOLDER):
+    image = read(name, source_path, size, target, folder)
+    if image is None:
+        return None
+    return image.convert(target)
+
+
+# Store a display-converted Surface for later launches. Entries are written
+# to a temporary file first so a crash never leaves a truncated entry.
+def store(name, source_path, image, folder=CACHE_FOLDER):
+    layout = pixel_layout(image)
+    if layout is None:
+        return False
+    try:
+        os.makedirs(folder, exist_ok=True)
+        path = entry_path(name, image.get_size(), folder)
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "wb") as entry:
+            entry.write(source_header(source_path, image.get_size(), layout).ljust(HEADER_SIZE, b"\0"))
+            entry.write(pygame.image.tobytes(image, layout))
+        os.replace(partial, path)
+    except OSError as error:
+        print(f"Could not write asset cache entry for {name}: {error}")
+        return False
+    return True
+
+
+def clear(folder=CACHE_FOLDER):
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+# Hidden display for the benchmarks, which need one to convert images to the
+# display format
+def hidden_display(size):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    return pygame.display.set_mode(size)
+
+
+# Time getting the backgrounds ready to blit, decoding them as before, on a
+# cold cache (decode and store) and on a warm cache (memory-mapped)
+def benchmark(names, size, repeats, image_folder="images", folder=CACHE_FOLDER):
+    target = pygame.display.get_surface()
+    sources = {name: os.path.join(image_folder, f"{name}.png") for name in names}
+
+    def decode(name):
+        return pygame.transform.scale(pygame.image.load(sources[name]), size).convert()
+
+    def without_cache():
+        for name in names:
+            decode(name)
+
+    def cold():
+        clear(folder)
+        for name in names:
+            store(name, sources[name], decode(name), folder)
+
+    def warm():
+        for name in names:
+            load(name, sources[name], size, target, folder)
+
+    print(f"{len(names)} backgrounds at {size[0]}x{size[1]}, {repeats} runs each")
+    for label, run in (("no cache", without_cache), ("cold cache", cold), ("warm cache", warm)):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"  {label:<11} median {timings[len(timings) // 2]:7.1f} ms, min {timings[0]:7.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the decoded background cache")
+    parser.add_argument("--clear", action="store_true", help="delete all cache entries")
+    parser.add_argument("--bench", action="store_true", help="compare cold and warm cache startup")
+    parser.add_argument("--size", type=int, nargs=2, default=(1000, 600), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    parser.add_argument("names", nargs="*", default=["menu_bg", "battle_bg", "sky", "mountains", "trees"])
+    args = parser.parse_args(argv)
+
+    if args.clear:
+        clear()
+        print(f"Removed {CACHE_FOLDER}")
+    if args.bench:
+        hidden_display(tuple(args.size))
+        benchmark(args.names, tuple(args.size), args.repeats)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
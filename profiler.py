@@ -0,0 +1,105 @@
+import os
+import json
+import time
+from collections import deque
+
+import pygame
+
+# Frame profiler for the game loop. Each phase of a frame (event handling,
+# simulation, drawing, presenting, sleeping) is timed with perf_counter_ns.
+# Rolling frame time percentiles and per-frame counters feed the in-game
+# HUD. With recording on, every phase also becomes a complete event in a
+# Chrome trace (load it in chrome://tracing or Perfetto), and the counters
+# become counter tracks. Hitches show up there as long frames next to a
+# spike in blits, text renders or asset cache misses.
+
+
+# Display-format back buffer that counts the blits drawn onto it. The game
+# draws into it while profiling and copies it to the window to present.
+class CountingSurface(pygame.Surface):
+    blit_count = 0
+
+    def blit(self, *args, **kwargs):
+        self.blit_count += 1
+        return super().blit(*args, **kwargs)
+
+    def blits(self, blit_sequence, doreturn=True):
+        blit_sequence = list(blit_sequence)
+        self.blit_count += len(blit_sequence)
+        return super().blits(blit_sequence, doreturn)
+
+
+class Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_phase(self.name, self.start, time.perf_counter_ns())
+
+
+# Phase timings of the recent frames, recorded to trace_path if given
+class FrameProfiler:
+    def __init__(self, history=300, trace_path=None):
+        self.frame_times = deque(maxlen=history)
+        self.phase_times = {}
+        self.frame_start = None
+        self.frame_phases = {}
+        self.counters = {}
+        self.frames = 0
+        self.trace_path = trace_path
+        self.trace = [] if trace_path else None
+        self.origin = time.perf_counter_ns()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_phase(self, name, start, end):
+        self.frame_phases[name] = self.frame_phases.get(name, 0) + end - start
+        if self.trace is not None:
+            self.trace.append({"name": name, "cat": "frame", "ph": "X", "pid": os.getpid(), "tid": 0,
+                               "ts": (start - self.origin) / 1000, "dur": (end - start) / 1000})
+
+    # Close the current frame and start the next one. counters holds what was
+    # counted during the frame, e.g. blits and text renders.
+    def next_frame(self, counters=None):
+        now = time.perf_counter_ns()
+        if self.frame_start is not None:
+            self.frame_times.append(now - self.frame_start)
+            for name, elapsed in self.frame_phases.items():
+                self.phase_times.setdefault(name, deque(maxlen=self.frame_times.maxlen)).append(elapsed)
+            self.counters = dict(counters or {})
+            if self.trace is not None:
+                timestamp = (self.frame_start - self.origin) / 1000
+                self.trace.append({"name": "frame", "cat": "frame", "ph": "X", "pid": os.getpid(), "tid": 1,
+                                   "ts": timestamp, "dur": (now - self.frame_start) / 1000,
+                                   "args": {"frame": self.frames}})
+                if self.counters:
+                    self.trace.append({"name": "counters", "ph": "C", "pid": os.getpid(),
+                                       "ts": timestamp, "args": self.counters})
+            self.frames += 1
+        self.frame_start = now
+        self.frame_phases = {}
+
+    # Frame time percentiles over the recent frames, in milliseconds
+    def percentiles(self, points=(50, 95, 99)):
+        if not self.frame_times:
+            return {point: 0.0 for point in points}
+        ordered = sorted(self.frame_times)
+        last = len(ordered) - 1
+        return {point: ordered[min(last, int(last * point / 100 + 0.5))] / 1e6 for point in points}
+
+    # Mean time per frame of each phase over the recent frames, in milliseconds
+    def phase_means(self):
+        return {name: sum(times) / len(times) / 1e6 for name, times in self.phase_times.items()}
+
+    # Write the Chrome trace, if recording
+    def close(self):
+        if self.trace is None:
+            return
+        with open(self.trace_path, "w") as trace_file:
+            json.dump({"traceEvents": self.trace, "displayTimeUnit": "ms"}, trace_file)
+        print(f"Wrote {len(self.trace)} trace events over {self.frames} frames to {self.trace_path}")
@@ -0,0 +1,215 @@
+import sys
+import time
+import struct
+import argparse
+from collections import deque
+
+from combat import BattleEngine, arena_roster
+
+# Compact binary battle replays. A battle is fully determined by its seed
+# and the player's actions, so that is all a replay stores, together with
+# when each action was taken in simulation steps (1/60 s) and the outcome
+# for checking a re-simulation against. Against an enemy AI, whose choices
+# depend on how far its search got, the enemy's moves are stored as inputs
+# too:
+#
+#   header   magic, format version, seed, arena size (0 for the regular
+#            roster), flags (1 for endless waves)
+#   input    steps since the previous input, action code   (3 bytes each)
+#   end      steps since the previous input, END
+#   result   final state, turns taken, player health
+#
+# A gap longer than a u16 of steps is split with WAIT inputs. Re-simulating
+# needs only the combat engine, so it runs at full speed without pygame;
+# lab.py --replay plays a replay back in the window in real time.
+
+MAGIC = b"FBRP"
+VERSION = 1
+HEADER = struct.Struct("<4sHqHB")
+INPUT = struct.Struct("<HB")
+RESULT = struct.Struct("<BIi")
+
+ACTIONS = ("attack", "special", "potion", "next_enemy", "enemy_attack", "enemy_special")
+ENEMY_ACTIONS = {"enemy_attack": "attack", "enemy_special": "special"}
+WAIT = 0xFE
+END = 0xFF
+STATES = ("battle", "victory", "game_over")
+MAX_DELTA = 0xFFFF
+MAX_ARENA = 0xFFFF  # Largest arena size the header holds
+ENDLESS = 1
+
+
+class Replay:
+    # inputs is a list of (step, action) with steps counted from the start
+    # of the battle; result is (state, turns, player health) or None
+    def __init__(self, seed, inputs=None, result=None, arena=0, endless=False):
+        self.seed = seed
+        self.inputs = inputs if inputs is not None else []
+        self.result = result
+        self.arena = arena
+        self.endless = endless
+
+    @property
+    def roster(self):
+        return arena_roster(self.arena) if self.arena else None
+
+    def to_bytes(self):
+        data = bytearray(HEADER.pack(MAGIC, VERSION, self.seed, self.arena, ENDLESS if self.endless else 0))
+        last = 0
+        for step, action in self.inputs:
+            last = pack_input(data, step - last, ACTIONS.index(action), last)
+        if self.result is not None:
+            state, turns, health = self.result
+            pack_input(data, 0, END, last)
+            data += RESULT.pack(STATES.index(state), turns, health)
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < HEADER.size:
+            raise ValueError("Not a replay: file too short")
+        magic, version, seed, arena, flags = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a replay: bad magic")
+        if version != VERSION:
+            raise ValueError(f"Unsupported replay version {version}")
+
+        replay = cls(seed, arena=arena, endless=bool(flags & ENDLESS))
+        step = 0
+        offset = HEADER.size
+        while offset + INPUT.size <= len(data):
+            delta, code = INPUT.unpack_from(data, offset)
+            offset += INPUT.size
+            step += delta
+            if code == END:
+                state, turns, health = RESULT.unpack_from(data, offset)
+                replay.result = (STATES[state], turns, health)
+                break
+            if code != WAIT:
+                replay.inputs.append((step, ACTIONS[code]))
+        return replay
+
+    def save(self, path):
+        with open(path, "wb") as replay_file:
+            replay_file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as replay_file:
+            return cls.from_bytes(replay_file.read())
+
+
+# Append an input, preceded by WAIT inputs if the gap does not fit in a u16
+def pack_input(data, delta, code, last):
+    while delta > MAX_DELTA:
+        data += INPUT.pack(MAX_DELTA, WAIT)
+        delta -= MAX_DELTA
+        last += MAX_DELTA
+    data += INPUT.pack(delta, code)
+    return last + delta
+
+
+# Records the player's actions in a running battle
+class ReplayRecorder:
+    def __init__(self, seed, start_step, arena=0, endless=False):
+        self.replay = Replay(seed, arena=arena, endless=endless)
+        self.start_step = start_step
+
+    def record(self, step, action):
+        self.replay.inputs.append((step - self.start_step, action))
+
+    def finish(self, engine):
+        self.replay.result = (engine.state, engine.turns, engine.player.health)
+        return self.replay
+
+
+# Hands out a replay's actions once their step has come. The enemy's
+# recorded moves are handed out in order whenever the enemy has a choice to
+# make, as the game decides when that is.
+class ReplayPlayer:
+    def __init__(self, replay):
+        self.replay = replay
+        self.start(0)
+
+    @property
+    def finished(self):
+        return not self.pending
+
+    def start(self, step):
+        self.start_step = step
+        self.pending = deque(entry for entry in self.replay.inputs if entry[1] not in ENEMY_ACTIONS)
+        self.enemy_actions = deque(ENEMY_ACTIONS[action] for _, action in self.replay.inputs
+                                   if action in ENEMY_ACTIONS)
+
+    # The next action if it is due at this step, else None
+    def due(self, step):
+        if self.pending and step - self.start_step >= self.pending[0][0]:
+            return self.pending.popleft()[1]
+        return None
+
+    # The enemy's next recorded move, or None for a replay without them
+    def enemy_action(self):
+        return self.enemy_actions.popleft() if self.enemy_actions else None
+
+
+# Play a replay on a fresh engine as fast as possible. Enemy turns run
+# between the player's actions as they did in the game, and after the last
+# one up to the recorded number of turns. Recorded enemy moves are played as
+# they come; without them the enemy flips its coin.
+def resimulate(replay, rules=None):
+    engine = BattleEngine(replay.seed, rules, roster=replay.roster, endless=replay.endless)
+    for _, action in replay.inputs:
+        if action in ENEMY_ACTIONS:
+            engine.enemy_turn(ENEMY_ACTIONS[action])
+            continue
+        while engine.state == "battle" and not engine.player_turn:
+            engine.enemy_turn()
+        engine.player_action(action)
+    recorded_turns = replay.result[1] if replay.result is not None else None
+    while (engine.state == "battle" and not engine.player_turn
+           and (recorded_turns is None or engine.turns < recorded_turns)):
+        engine.enemy_turn()
+    return engine
+
+
+def engine_result(engine):
+    return engine.state, engine.turns, engine.player.health
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-simulate a recorded battle")
+    parser.add_argument("replay", help="replay file written by lab.py --record")
+    parser.add_argument("--realtime", action="store_true", help="play it back in the game window")
+    parser.add_argument("-r", "--repeats", type=int, default=1, help="re-simulate this many times and time it")
+    args = parser.parse_args(argv)
+
+    if args.realtime:
+        import lab
+        return lab.main(["--replay", args.replay])
+
+    replay = Replay.load(args.replay)
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        engine = resimulate(replay)
+    elapsed = time.perf_counter() - start
+
+    state, turns, health = engine_result(engine)
+    mode = ""
+    if replay.arena:
+        mode = f", arena of {replay.arena}"
+    elif replay.endless:
+        mode = f", endless up to wave {engine.wave}"
+    print(f"Seed {replay.seed}{mode}, {len(replay.inputs)} inputs: {state} after {turns} turns, "
+          f"player health {health} ({elapsed / args.repeats * 1e6:.0f} us per re-simulation)")
+    if replay.result is None:
+        print("Replay has no recorded result to check against")
+        return 0
+    if engine_result(engine) != replay.result:
+        print("Mismatch: recorded {} after {} turns, player health {}".format(*replay.result))
+        return 1
+    print("Matches the recorded result")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,449 @@
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import threading
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ai import DIFFICULTIES, SearchAI
+from combat import BattleEngine, arena_roster
+
+# Battle server: hosts many independent battles in one asyncio event loop.
+# Every connection is a session that goes through the same states as the
+# game (main_menu, battle, victory, game_over). The server is authoritative:
+# it applies the player's action, plays the enemy's turn right away, and
+# replies with the enemy's move and the outcome so far. A battle is fully
+# determined by its seed and the moves made, so a client can run its own
+# engine in lockstep to animate the battle and check it against every reply;
+# lab.py --server does exactly that.
+#
+# Messages are a type byte followed by a fixed-size little-endian body:
+#
+#   client  HELLO    magic, protocol version (once, on connecting)
+#           START    seed (-1 for any), arena size (0 for the regular
+#                    roster), flags (1 for endless waves)
+#           ACTION   attack, special, potion or next_enemy
+#           MENU     leave the battle for the main menu
+#   server  STARTED  seed of the new battle
+#           STATE    session state, player's turn, enemy move (0 none,
+#                    1 attack, 2 special), turns, player health, wave
+#           ERROR    error code; the connection is closed after a bad HELLO
+#                    or an unknown message
+#
+# Every client message but HELLO gets exactly one reply.
+#
+#   python server.py --address 127.0.0.1:7777
+#   python server.py --address unix:/tmp/battle.sock --ai normal
+#   python server.py load --spawn -n 2000 --duration 10
+
+MAGIC = b"FBSV"
+PROTOCOL_VERSION = 1
+DEFAULT_ADDRESS = "127.0.0.1:7777"
+
+HELLO, START, ACTION, MENU = b"H", b"S", b"A", b"M"
+STARTED, STATE, ERROR = b"s", b"t", b"e"
+BODIES = {
+    HELLO: struct.Struct("<4sH"),
+    START: struct.Struct("<qHB"),
+    ACTION: struct.Struct("<B"),
+    MENU: struct.Struct("<"),
+    STARTED: struct.Struct("<q"),
+    STATE: struct.Struct("<BBBIiH"),
+    ERROR: struct.Struct("<B"),
+}
+
+SESSION_STATES = ("main_menu", "battle", "victory", "game_over")
+ACTIONS = ("attack", "special", "potion", "next_enemy")
+ENEMY_MOVES = (None, "attack", "special")
+ENDLESS = 1
+
+BAD_HELLO, BAD_MESSAGE, NOT_IN_BATTLE, NOT_YOUR_TURN = 1, 2, 3, 4
+ERRORS = {
+    BAD_HELLO: "bad hello or protocol version",
+    BAD_MESSAGE: "unknown message",
+    NOT_IN_BATTLE: "no battle in progress",
+    NOT_YOUR_TURN: "not the player's turn",
+}
+
+# Outcome of an action as the server saw it
+Reply = namedtuple("Reply", "state player_turn enemy_move turns health wave")
+
+
+def message(kind, *values):
+    return kind + BODIES[kind].pack(*values)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# What a RemoteSession call raises when the server cannot be reached, drops
+# the connection, stops answering or rejects a request
+SESSION_ERRORS = (OSError, ProtocolError)
+
+
+# "unix:PATH" for a Unix socket, otherwise "HOST:PORT" for TCP
+def parse_address(address):
+    if address.startswith("unix:"):
+        return address[len("unix:"):], None
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+# One client's battle, played the way the game plays it
+class Session:
+    def __init__(self):
+        self.state = "main_menu"
+        self.engine = None
+
+    # Start a new battle, from any state
+    def start(self, seed, arena, endless):
+        roster = arena_roster(arena) if arena else None
+        self.engine = BattleEngine(seed if seed >= 0 else None, roster=roster, endless=endless)
+        self.state = "battle"
+        return self.engine.current_seed
+
+    def check_action(self):
+        if self.state != "battle":
+            return NOT_IN_BATTLE
+        if not self.engine.player_turn:
+            return NOT_YOUR_TURN
+        return None
+
+    def player_action(self, action):
+        self.engine.player_action(action)
+        self.update_state()
+
+    def enemy_turn(self, move):
+        self.engine.enemy_turn(move)
+        self.update_state()
+
+    def update_state(self):
+        if self.engine.state != "battle":
+            self.state = self.engine.state
+
+    def reply(self, move=None):
+        engine = self.engine
+        if engine is None:
+            return (SESSION_STATES.index(self.state), 0, 0, 0, 0, 0)
+        return (SESSION_STATES.index(self.state), engine.player_turn, ENEMY_MOVES.index(move),
+                engine.turns, engine.player.health, engine.wave)
+
+
+# Enemy AI searches for all sessions, on worker threads so that a search
+# never blocks the event loop. Each worker thread keeps its own SearchAI and
+# transposition table; snapshots are taken on the event loop's thread.
+class EnemyAIWorkers:
+    def __init__(self, difficulty, workers=2):
+        self.difficulty = difficulty
+        self.snapshots = SearchAI(*DIFFICULTIES[difficulty])
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enemy-ai")
+        self.local = threading.local()
+
+    def search(self, root):
+        ai = getattr(self.local, "ai", None)
+        if ai is None:
+            ai = self.local.ai = SearchAI(*DIFFICULTIES[self.difficulty])
+        return ai.best_action(root)
+
+    async def choose(self, engine):
+        root = self.snapshots.snapshot(engine)
+        if root is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.search, root)
+
+
+class BattleServer:
+    def __init__(self, enemy_ai=None):
+        self.enemy_ai = enemy_ai
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.actions = 0
+        self.battles = 0
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        self.peak_sessions = max(self.peak_sessions, self.sessions)
+        session = Session()
+        try:
+            magic, version = BODIES[HELLO].unpack(await self.read_message(reader, HELLO))
+            if magic != MAGIC or version != PROTOCOL_VERSION:
+                raise ProtocolError(BAD_HELLO)
+            while True:
+                kind = await reader.readexactly(1)
+                if kind not in BODIES or kind == HELLO:
+                    raise ProtocolError(BAD_MESSAGE)
+                body = BODIES[kind].unpack(await reader.readexactly(BODIES[kind].size))
+                writer.write(await self.respond(session, kind, body))
+                await writer.drain()
+        except ProtocolError as error:
+            writer.write(message(ERROR, error.args[0]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def read_message(self, reader, expected):
+        kind = await reader.readexactly(1)
+        if kind != expected:
+            raise ProtocolError(BAD_HELLO)
+        return await reader.readexactly(BODIES[kind].size)
+
+    async def respond(self, session, kind, body):
+        if kind == START:
+            seed, arena, flags = body
+            self.battles += 1
+            return message(STARTED, session.start(seed, arena, bool(flags & ENDLESS)))
+
+        if kind == MENU:
+            session.state = "main_menu"
+            return message(STATE, *session.reply())
+
+        (code,) = body
+        if code >= len(ACTIONS):
+            raise ProtocolError(BAD_MESSAGE)
+        error = session.check_action()
+        if error is not None:
+            return message(ERROR, error)
+
+        self.actions += 1
+        session.player_action(ACTIONS[code])
+        engine = session.engine
+        move = None
+        if session.state == "battle" and not engine.player_turn:
+            if self.enemy_ai is not None:
+                move = await self.enemy_ai.choose(engine)
+            session.enemy_turn(move)
+        return message(STATE, *session.reply(move))
+
+    # A line of totals every interval seconds while sessions are open
+    async def report(self, interval):
+        actions = self.actions
+        while True:
+            await asyncio.sleep(interval)
+            if self.sessions or self.actions != actions:
+                print(f"{self.sessions} sessions (peak {self.peak_sessions}), {self.battles} battles, "
+                      f"{(self.actions - actions) / interval:.0f} actions/s")
+            actions = self.actions
+
+
+async def serve(address, enemy_ai=None, report_interval=10.0):
+    server = BattleServer(enemy_ai)
+    path, port = parse_address(address)
+    if port is None:
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = await asyncio.start_unix_server(server.handle, path, backlog=4096)
+    else:
+        listener = await asyncio.start_server(server.handle, path, port, backlog=4096)
+    mode = f", enemy AI {enemy_ai.difficulty}" if enemy_ai is not None else ""
+    print(f"Serving battles on {address}{mode}", flush=True)
+    reporter = asyncio.create_task(server.report(report_interval)) if report_interval else None
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+
+
+async def open_connection(address):
+    path, port = parse_address(address)
+    if port is None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(path, port)
+
+
+# Blocking client for one session, for the game window and scripts
+class RemoteSession:
+    def __init__(self, address, timeout=5.0):
+        self.address = address
+        self.timeout = timeout
+        self.connect()
+
+    def connect(self):
+        path, port = parse_address(self.address)
+        if port is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((path, port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(message(HELLO, MAGIC, PROTOCOL_VERSION))
+
+    # A new session after the last one failed, e.g. when the server restarted
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    def request(self, data, expected):
+        self.sock.sendall(data)
+        kind = self.receive(1)
+        body = BODIES[kind].unpack(self.receive(BODIES[kind].size)) if kind in BODIES else None
+        if kind == ERROR:
+            raise ProtocolError(ERRORS.get(body[0], f"error {body[0]}"))
+        if kind != expected:
+            raise ProtocolError(f"unexpected reply {kind!r}")
+        return body
+
+    def receive(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("the server closed the connection")
+            data += chunk
+        return data
+
+    def start(self, seed=-1, arena=0, endless=False):
+        return self.request(message(START, seed, arena, ENDLESS if endless else 0), STARTED)[0]
+
+    def act(self, action):
+        return reply_from(self.request(message(ACTION, ACTIONS.index(action)), STATE))
+
+    def menu(self):
+        return reply_from(self.request(message(MENU), STATE))
+
+    def close(self):
+        self.sock.close()
+
+
+def reply_from(body):
+    state, player_turn, move, turns, health, wave = body
+    return Reply(SESSION_STATES[state], bool(player_turn), ENEMY_MOVES[move], turns, health, wave)
+
+
+# Load test: sessions that each play battle after battle as fast as the
+# server answers, drinking a potion when low and attacking otherwise
+async def load_session(address, deadline, latencies, totals):
+    reader, writer = await open_connection(address)
+    writer.write(message(HELLO, MAGIC, PROTOCOL_VERSION))
+
+    async def request(data):
+        writer.write(data)
+        kind = await reader.readexactly(1)
+        return kind, BODIES[kind].unpack(await reader.readexactly(BODIES[kind].size))
+
+    try:
+        while time.perf_counter() < deadline:
+            await request(message(START, random.randrange(2 ** 62), 0, 0))
+            totals["battles"] += 1
+            health, potions = None, 3
+            state = "battle"
+            while state == "battle" and time.perf_counter() < deadline:
+                action = "potion" if potions and health is not None and health <= 8 else "attack"
+                potions -= action == "potion"
+                start = time.perf_counter()
+                kind, body = await request(message(ACTION, ACTIONS.index(action)))
+                latencies.append(time.perf_counter() - start)
+                if kind != STATE:
+                    raise ProtocolError(ERRORS.get(body[0], f"error {body[0]}"))
+                reply = reply_from(body)
+                state, health = reply.state, reply.health
+                totals["turns"] += 1
+            totals[state] = totals.get(state, 0) + 1
+    finally:
+        writer.close()
+
+
+async def load_test(address, sessions, duration):
+    latencies = []
+    totals = {"battles": 0, "turns": 0}
+    start = time.perf_counter()
+    results = await asyncio.gather(*(load_session(address, start + duration, latencies, totals)
+                                     for _ in range(sessions)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = [repr(result) for result in results if isinstance(result, Exception)]
+    return totals, latencies, elapsed, failed
+
+
+# One load test process. A single Python client tops out well before the
+# server does, so big tests spread their sessions over several processes.
+def load_process(address, sessions, duration):
+    return asyncio.run(load_test(address, sessions, duration))
+
+
+# Start a server in another process and wait until it accepts connections
+def spawn_server(address, difficulty=None):
+    command = [sys.executable, os.path.abspath(__file__), "--address", address, "--report", "0"]
+    if difficulty:
+        command += ["--ai", difficulty]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    return process
+
+
+def load_main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a battle server")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="HOST:PORT or unix:PATH")
+    parser.add_argument("-n", "--sessions", type=int, default=1000, help="concurrent sessions to open")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to play for")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="client processes to share the sessions")
+    parser.add_argument("--spawn", action="store_true", help="start a server for the test in another process")
+    parser.add_argument("--ai", choices=list(DIFFICULTIES), help="enemy AI of the spawned server")
+    args = parser.parse_args(argv)
+
+    server = spawn_server(args.address, args.ai) if args.spawn else None
+    totals = {"battles": 0, "turns": 0}
+    latencies = []
+    failed = []
+    elapsed = 0.0
+    try:
+        shares = [args.sessions // args.processes + (index < args.sessions % args.processes)
+                  for index in range(args.processes)]
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            for result in executor.map(load_process, [args.address] * len(shares), shares,
+                                       [args.duration] * len(shares)):
+                process_totals, process_latencies, process_elapsed, process_failed = result
+                for name, count in process_totals.items():
+                    totals[name] = totals.get(name, 0) + count
+                latencies.extend(process_latencies)
+                failed.extend(process_failed)
+                elapsed = max(elapsed, process_elapsed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"{args.sessions} sessions on {args.address} for {elapsed:.1f} s: {totals['battles']} battles, "
+          f"{totals['turns']} turns ({totals['turns'] / elapsed:.0f} turns/s)")
+    if latencies:
+        latencies.sort()
+        last = len(latencies) - 1
+        p50, p99 = (latencies[min(last, int(last * point / 100 + 0.5))] * 1000 for point in (50, 99))
+        print(f"  turn latency p50 {p50:.2f} ms, p99 {p99:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    if failed:
+        print(f"  {len(failed)} sessions failed, e.g. {failed[0]}")
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Host battles for remote clients")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="HOST:PORT or unix:PATH")
+    parser.add_argument("--ai", choices=list(DIFFICULTIES),
+                        help="let enemies search for their best move instead of choosing at random")
+    parser.add_argument("--ai-workers", type=int, default=2, help="threads for enemy AI searches")
+    parser.add_argument("--report", type=float, default=10.0, help="seconds between status lines; 0 for none")
+    args = parser.parse_args(argv)
+
+    enemy_ai = EnemyAIWorkers(args.ai, args.ai_workers) if args.ai else None
+    try:
+        asyncio.run(serve(args.address, enemy_ai, args.report))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["load"]:
+        sys.exit(load_main(sys.argv[2:]))
+    sys.exit(main())
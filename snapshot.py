@@ -0,0 +1,305 @@
+import sys
+import math
+import time
+import random
+import struct
+import argparse
+
+from combat import ENEMY_ROSTER, BattleEngine, Rules, WaveGenerator, arena_roster, default_policy
+
+# Versioned binary snapshots of a battle in progress, for quick-saves, crash
+# recovery and forking a battle to explore it or to set up a test. A
+# snapshot holds everything the combat rules depend on, so a restored engine
+# plays on exactly like the original, random rolls included:
+#
+#   header   magic, format version, flags (1 seed given, 2 endless), game
+#            state, seed, current seed, arena size (0 for the regular roster)
+#   engine   battle state, player's turn, turns, current enemy, random state
+#   rules    potions, stun chance, crushing multiplier, level-up factor,
+#            enemy attack chance, base stats of each kind
+#   fighters enemy count, then the player's and every enemy's name, joined
+#            by newlines, followed by one fixed-size record each: kind (an
+#            index into the rules' stats), max health, health, attack,
+#            defense (with any crushing blow taken off), level, experience,
+#            potions, alive and stunned
+#   waves    endless only: wave number, random state and the upcoming wave
+#
+# Nothing about how the battle is drawn is stored. The game rebuilds its
+# characters from the restored fighters, which picks their sprites up from
+# the asset cache again.
+
+MAGIC = b"FBSS"
+VERSION = 1
+HEADER = struct.Struct("<4sHBBqqH")
+ENGINE = struct.Struct("<BBII")
+RANDOM = struct.Struct("<625Id")
+RULES = struct.Struct("<HddHdB")
+STATS = struct.Struct("<iii")
+FIGHTER = struct.Struct("<BiiiiiIHB")
+WAVES = struct.Struct("<IB")
+COUNT = struct.Struct("<I")
+LENGTH = struct.Struct("<B")
+
+HAS_SEED = 1
+ENDLESS = 2
+ALIVE = 1
+STUNNED = 2
+
+GAME_STATES = ("main_menu", "battle", "victory", "game_over")
+ENGINE_STATES = ("battle", "victory", "game_over")
+
+
+def pack_text(data, text):
+    encoded = text.encode("utf-8")
+    data += LENGTH.pack(len(encoded))
+    data += encoded
+
+
+def pack_random(data, rng):
+    _, internal, gauss_next = rng.getstate()
+    data += RANDOM.pack(*internal, math.nan if gauss_next is None else gauss_next)
+
+
+# Reads a snapshot front to back
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def text(self):
+        (length,) = self.unpack(LENGTH)
+        text = self.data[self.offset:self.offset + length].decode("utf-8")
+        self.offset += length
+        return text
+
+    def random(self, rng):
+        *internal, gauss_next = self.unpack(RANDOM)
+        rng.setstate((3, tuple(internal), None if math.isnan(gauss_next) else gauss_next))
+
+    def block(self):
+        (length,) = self.unpack(COUNT)
+        block = self.data[self.offset:self.offset + length]
+        self.offset += length
+        return block
+
+    # (name, kind, max health, ...) of count fighter records
+    def fighters(self, count, kinds):
+        names = self.block().decode("utf-8").split("\n")
+        end = self.offset + FIGHTER.size * count
+        records = FIGHTER.iter_unpack(memoryview(self.data)[self.offset:end])
+        self.offset = end
+        return [(name, kinds[record[0]]) + record[1:] for name, record in zip(names, records)]
+
+
+def restore_fighter(fighter, name, kind, max_health, health, attack, defense, level, experience, potions, flags):
+    fighter.name = name
+    fighter.kind = kind
+    fighter.max_health = max_health
+    fighter.health = health
+    fighter.attack = attack
+    fighter.defense = defense
+    fighter.level = level
+    fighter.experience = experience
+    fighter.potions = potions
+    fighter.is_alive = bool(flags & ALIVE)
+    fighter.stunned = bool(flags & STUNNED)
+
+
+class Snapshot:
+    def __init__(self, data):
+        if len(data) < HEADER.size:
+            raise ValueError("Not a snapshot: file too short")
+        magic, version, self.flags, game_state, self.seed, self.current_seed, self.arena = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a snapshot: bad magic")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        self.data = data
+        self.game_state = GAME_STATES[game_state]
+        self.endless = bool(self.flags & ENDLESS)
+
+    @classmethod
+    def capture(cls, engine, game_state="battle"):
+        arena = 0 if engine.roster == ENEMY_ROSTER else len(engine.roster)
+        flags = (HAS_SEED if engine.seed is not None else 0) | (ENDLESS if engine.endless else 0)
+        data = bytearray(HEADER.pack(MAGIC, VERSION, flags, GAME_STATES.index(game_state),
+                                     engine.seed or 0, engine.current_seed, arena))
+
+        data += ENGINE.pack(ENGINE_STATES.index(engine.state), engine.player_turn, engine.turns,
+                            engine.current_index)
+        pack_random(data, engine.rng)
+
+        rules = engine.rules
+        data += RULES.pack(rules.potions, rules.stun_chance, rules.crushing_multiplier, rules.level_up_factor,
+                           rules.enemy_attack_chance, len(rules.stats))
+        for kind, stats in rules.stats.items():
+            pack_text(data, kind)
+            data += STATS.pack(*stats)
+
+        fighters = [engine.player] + engine.enemies
+        kinds = {kind: index for index, kind in enumerate(rules.stats)}
+        names = "\n".join(fighter.name for fighter in fighters).encode("utf-8")
+        data += COUNT.pack(len(engine.enemies))
+        data += COUNT.pack(len(names))
+        data += names
+        data += b"".join([FIGHTER.pack(kinds[fighter.kind], fighter.max_health, fighter.health, fighter.attack,
+                                       fighter.defense, fighter.level, fighter.experience, fighter.potions,
+                                       (ALIVE if fighter.is_alive else 0) | (STUNNED if fighter.stunned else 0))
+                          for fighter in fighters])
+
+        if engine.endless:
+            waves = engine.waves
+            data += WAVES.pack(waves.number, len(waves.upcoming))
+            pack_random(data, waves.rng)
+            for name, kind, health, attack, defense in waves.upcoming:
+                pack_text(data, name)
+                pack_text(data, kind)
+                data += STATS.pack(health, attack, defense)
+        return cls(bytes(data))
+
+    # Put the snapshot's battle into engine, or into a new engine. The
+    # engine keeps its event sink and fighter pool.
+    def restore(self, engine=None):
+        reader = Reader(self.data)
+        reader.offset = HEADER.size
+        state, player_turn, turns, current_index = reader.unpack(ENGINE)
+        rng = random.Random()
+        reader.random(rng)
+
+        potions, stun_chance, crushing_multiplier, level_up_factor, enemy_attack_chance, kinds = \
+            reader.unpack(RULES)
+        stats = {}
+        for _ in range(kinds):
+            kind = reader.text()
+            stats[kind] = reader.unpack(STATS)
+        rules = Rules(stats, potions, stun_chance, crushing_multiplier, level_up_factor, enemy_attack_chance)
+
+        (count,) = reader.unpack(COUNT)
+        player, *enemies = reader.fighters(count + 1, list(stats))
+
+        if engine is None:
+            engine = BattleEngine(self.current_seed, rules)
+        engine.seed = self.seed if self.flags & HAS_SEED else None
+        engine.current_seed = self.current_seed
+        engine.rng = rng
+        engine.rules = rules
+        engine.endless = self.endless
+
+        # The engine's own fighters are reused when there are as many, as when
+        # quick-loading the same battle; otherwise the pool makes up the numbers
+        restore_fighter(engine.player, *player)
+        if len(engine.enemies) != count:
+            engine.field_enemies(enemy[:5] for enemy in enemies)
+        for fighter, enemy in zip(engine.enemies, enemies):
+            restore_fighter(fighter, *enemy)
+        engine.enemy_indices.clear()
+        engine.enemy_indices.update((fighter.name, index) for index, fighter in enumerate(engine.enemies))
+        engine.alive.clear()
+        engine.alive.update(index for index, fighter in enumerate(engine.enemies) if fighter.is_alive)
+        engine.current_index = current_index
+        engine.first_alive = 0
+
+        if self.endless:
+            number, upcoming = reader.unpack(WAVES)
+            engine.waves = waves = WaveGenerator(self.current_seed, rules)
+            reader.random(waves.rng)
+            waves.number = number
+            waves.upcoming = [(reader.text(), reader.text()) + reader.unpack(STATS) for _ in range(upcoming)]
+            engine.roster = arena_roster(self.arena) if self.arena else ENEMY_ROSTER
+        else:
+            engine.waves = None
+            engine.roster = [(fighter.name, fighter.kind) for fighter in engine.enemies]
+
+        engine.state = ENGINE_STATES[state]
+        engine.player_turn = bool(player_turn)
+        engine.turns = turns
+        return engine
+
+    def save(self, path):
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(self.data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as snapshot_file:
+            return cls(snapshot_file.read())
+
+
+# An independent copy of a running battle, e.g. to try out moves on
+def fork(engine):
+    return Snapshot.capture(engine).restore()
+
+
+# Play a battle with the default policy from its current position
+def play_out(engine, max_turns=1000):
+    while engine.state == "battle" and engine.turns < max_turns:
+        if engine.player_turn:
+            engine.player_action(default_policy(engine))
+        else:
+            engine.enemy_turn()
+    return engine.state, engine.turns, engine.player.health
+
+
+# Encode and decode times for battles of different sizes, and a check that
+# every fork plays on exactly like its original
+def benchmark(repeats):
+    battles = [
+        ("regular", BattleEngine(1)),
+        ("arena of 300", BattleEngine(1, roster=arena_roster(300))),
+        ("endless", BattleEngine(1, endless=True)),
+    ]
+    for label, engine in battles:
+        for _ in range(7):
+            engine.player_action(default_policy(engine))
+            engine.enemy_turn()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            snapshot = Snapshot.capture(engine)
+        encode = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            restored = snapshot.restore()
+        decode = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            snapshot.restore(restored)
+        decode_in_place = (time.perf_counter() - start) / repeats
+
+        same = play_out(fork(engine)) == play_out(engine)
+        print(f"{label:<13} {len(snapshot.data):6d} bytes, encode {encode * 1e6:6.1f} us, "
+              f"decode {decode * 1e6:6.1f} us ({decode_in_place * 1e6:6.1f} us in place), "
+              f"fork plays on {'identically' if same else 'DIFFERENTLY'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect battle snapshots or time snapshotting")
+    parser.add_argument("snapshot", nargs="?", help="snapshot file to describe")
+    parser.add_argument("-r", "--repeats", type=int, default=1000, help="repeats for the timings")
+    args = parser.parse_args(argv)
+
+    if args.snapshot is None:
+        benchmark(args.repeats)
+        return 0
+
+    snapshot = Snapshot.load(args.snapshot)
+    engine = snapshot.restore()
+    player = engine.player
+    mode = f", arena of {snapshot.arena}" if snapshot.arena else ""
+    if snapshot.endless:
+        mode += f", endless wave {engine.wave}"
+    print(f"{args.snapshot}: {snapshot.game_state}, seed {engine.current_seed}{mode}, {len(snapshot.data)} bytes")
+    print(f"  turn {engine.turns}, {'player' if engine.player_turn else 'enemy'} to move, "
+          f"{len(engine.alive)} of {len(engine.enemies)} enemies left, facing {engine.current_enemy.name}")
+    print(f"  {player.name}: level {player.level}, health {player.health}/{player.max_health}, "
+          f"{player.potions} potions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import sys
+import time
+import argparse
+from fractions import Fraction
+
+from combat import BASE_STATS, ENEMY_ROSTER, STARTING_POTIONS
+
+# Exact outcome probabilities for a battle, computed by dynamic programming
+# over the Markov chain of battle states instead of by sampling. Every random
+# choice in combat.py is small and discrete (damage jitter, the 70/30 enemy
+# action split, 2-4 frenzy hits, the 30% stun), so each transition can be
+# enumerated with its probability. Results are memoized per state, and the
+# recursion always terminates because every round either removes a potion,
+# kills an enemy or lowers the player's health.
+#
+# A state is the position at the start of the player's turn:
+#   (health, defense, level, experience, potions, current enemy,
+#    enemy health tuple, enemy stunned tuple)
+# The player's attack and max health follow from the level.
+
+ACTIONS = ("attack", "special", "potion")
+
+ENEMY_KINDS = [kind for _, kind in ENEMY_ROSTER]
+ENEMY_HEALTH = tuple(BASE_STATS[kind][0] for kind in ENEMY_KINDS)
+ENEMY_ATTACK = tuple(BASE_STATS[kind][1] for kind in ENEMY_KINDS)
+ENEMY_DEFENSE = tuple(BASE_STATS[kind][2] for kind in ENEMY_KINDS)
+
+
+def player_max_health(level):
+    return BASE_STATS["player"][0] + 5 * (level - 1)
+
+
+def player_attack(level):
+    return BASE_STATS["player"][1] + 2 * (level - 1)
+
+
+def initial_state():
+    health, _, defense = BASE_STATS["player"]
+    return (health, defense, 1, 0, STARTING_POTIONS, 0,
+            ENEMY_HEALTH, (False,) * len(ENEMY_KINDS))
+
+
+# Solver state for a running combat.BattleEngine, e.g. for a "best move" hint
+def state_from_engine(engine):
+    player = engine.player
+    return (player.health, player.defense, player.level, player.experience, player.potions,
+            engine.current_index,
+            tuple(enemy.health for enemy in engine.enemies),
+            tuple(enemy.stunned for enemy in engine.enemies))
+
+
+def replace(values, index, value):
+    return values[:index] + (value,) + values[index + 1:]
+
+
+class Solver:
+    # policy is None for optimal play, or a function from state to action to
+    # evaluate a fixed strategy exactly. exact=True works in Fractions.
+    def __init__(self, policy=None, exact=False):
+        self.policy = policy
+        self.values = {}
+        self.best = {}
+        if exact:
+            self.one = Fraction(1)
+            self.p_jitter = Fraction(1, 5)
+            self.p_attack = Fraction(7, 10)
+            self.p_stun = Fraction(3, 10)
+            self.p_hits = Fraction(1, 3)
+        else:
+            self.one = 1.0
+            self.p_jitter = 0.2
+            self.p_attack = 0.7
+            self.p_stun = 0.3
+            self.p_hits = 1 / 3
+
+    def legal_actions(self, state):
+        if state[4] > 0:
+            return ACTIONS
+        return ACTIONS[:2]
+
+    # Probability of winning from a state at the start of the player's turn
+    def value(self, state):
+        value = self.values.get(state)
+        if value is not None:
+            return value
+
+        if self.policy is not None:
+            best_action = self.policy(state)
+            value = self.action_value(state, best_action)
+        else:
+            best_action = None
+            value = -1
+            for action in self.legal_actions(state):
+                action_value = self.action_value(state, action)
+                if action_value > value:
+                    best_action, value = action, action_value
+
+        self.values[state] = value
+        self.best[state] = best_action
+        return value
+
+    def action_values(self, state):
+        return {action: self.action_value(state, action) for action in self.legal_actions(state)}
+
+    def best_action(self, state):
+        self.value(state)
+        return self.best[state]
+
+    def action_value(self, state, action):
+        health, defense, level, experience, potions, current, enemy_health, stunned = state
+        attack = player_attack(level)
+        enemy_defense = ENEMY_DEFENSE[current]
+
+        if action == "potion":
+            max_health = player_max_health(level)
+            health = min(max_health, health + max_health // 2)
+            return self.enemy_value((health, defense, level, experience, potions - 1,
+                                     current, enemy_health, stunned))
+
+        if action == "attack":
+            base = max(1, attack - enemy_defense // 2)
+            total = 0
+            for jitter in range(-2, 3):
+                damage = max(1, base + jitter)
+                total += self.p_jitter * self.hit_value(state, damage, False)
+            return total
+
+        damage = max(1, attack * 2 - enemy_defense // 3)
+        return (self.p_stun * self.hit_value(state, damage, True)
+                + (self.one - self.p_stun) * self.hit_value(state, damage, False))
+
+    def hit_value(self, state, damage, stun):
+        health, defense, level, experience, potions, current, enemy_health, stunned = state
+        if stun:
+            stunned = replace(stunned, current, True)
+
+        remaining = enemy_health[current] - damage
+        if remaining > 0:
+            enemy_health = replace(enemy_health, current, remaining)
+            return self.enemy_value((health, defense, level, experience, potions,
+                                     current, enemy_health, stunned))
+
+        # Kill: gain experience and possibly a level, then face the next enemy
+        enemy_health = replace(enemy_health, current, 0)
+        if not any(enemy_health):
+            return self.one
+
+        experience += 10
+        if experience >= level * 20:
+            level += 1
+            health = player_max_health(level)
+            defense += 1
+        current = next(i for i, hp in enumerate(enemy_health) if hp > 0)
+        return self.enemy_value((health, defense, level, experience, potions,
+                                 current, enemy_health, stunned))
+
+    # Expected value of the enemy's response, ending at the player's next turn
+    def enemy_value(self, state):
+        health, defense, level, experience, potions, current, enemy_health, stunned = state
+        if stunned[current]:
+            return self.value((health, defense, level, experience, potions,
+                               current, enemy_health, replace(stunned, current, False)))
+
+        attack = ENEMY_ATTACK[current]
+        kind = ENEMY_KINDS[current]
+        total = 0
+
+        base = max(1, attack - defense // 2)
+        for jitter in range(-2, 3):
+            damage = max(1, base + jitter)
+            total += self.p_attack * self.p_jitter * self.after_enemy(state, damage, defense, enemy_health)
+
+        p_special = self.one - self.p_attack
+        if kind == "goblin":
+            for hits in range(2, 5):
+                damage = hits * max(1, attack // 2 - defense // 4)
+                total += p_special * self.p_hits * self.after_enemy(state, damage, defense, enemy_health)
+        elif kind == "orc":
+            damage = max(1, int(attack * 1.5 - defense // 4))
+            total += p_special * self.after_enemy(state, damage, max(0, defense - 2), enemy_health)
+        elif kind == "elf":
+            damage = max(1, attack - defense // 3)
+            healed = min(ENEMY_HEALTH[current], enemy_health[current] + damage // 2)
+            total += p_special * self.after_enemy(state, damage, defense,
+                                                  replace(enemy_health, current, healed))
+        return total
+
+    def after_enemy(self, state, damage, defense, enemy_health):
+        health, _, level, experience, potions, current, _, stunned = state
+        health -= damage
+        if health <= 0:
+            return 0
+        return self.value((health, defense, level, experience, potions, current, enemy_health, stunned))
+
+
+# combat.default_policy expressed on solver states
+def default_policy(state):
+    health, _, level, _, potions = state[:5]
+    if potions > 0 and health <= player_max_health(level) // 3:
+        return "potion"
+    return "attack"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exact win probabilities for a battle")
+    parser.add_argument("--exact", action="store_true", help="compute with Fractions instead of floats")
+    args = parser.parse_args(argv)
+
+    state = initial_state()
+    for label, policy in (("Optimal play", None), ("Default policy", default_policy)):
+        start = time.perf_counter()
+        solver = Solver(policy, exact=args.exact)
+        value = solver.value(state)
+        elapsed = time.perf_counter() - start
+        print(f"{label}: win probability {float(value) * 100:.4f}% "
+              f"({len(solver.values)} states, {elapsed:.2f}s)")
+        if policy is None:
+            for action, action_value in solver.action_values(state).items():
+                print(f"  opening {action:<8} {float(action_value) * 100:.4f}%")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import os
+import sys
+import csv
+import time
+import random
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from combat import BASE_STATS, Rules, default_policy, simulate
+
+# Parameter sweeps over the combat rules on every CPU core. Each grid point
+# becomes a Rules variant that is played out headlessly with combat.simulate.
+# The player follows combat.default_policy but uses the special instead of an
+# attack at the given rate, so the stun rules come into play. Battle i draws
+# its seed and the player's choices from a stream seeded by the base seed and
+# i alone, so every grid point plays the same battles (common random
+# numbers) and rows differ only by their parameters. Grid points are handed
+# to worker processes in chunks, and rows are written to the CSV file as
+# soon as their chunk completes.
+#
+# Parameters are given as name=v1,v2,... where name is a Rules attribute
+# (potions, stun_chance, crushing_multiplier, level_up_factor,
+# enemy_attack_chance) or a stat as kind.health, kind.attack or kind.defense.
+
+STAT_FIELDS = ("health", "attack", "defense")
+RULE_PARAMETERS = ("potions", "stun_chance", "crushing_multiplier", "level_up_factor", "enemy_attack_chance")
+
+
+def parse_value(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_parameter(text):
+    name, _, values = text.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"expected name=v1,v2,... but got {text!r}")
+
+    kind, _, field = name.partition(".")
+    if field:
+        if kind not in BASE_STATS or field not in STAT_FIELDS:
+            raise argparse.ArgumentTypeError(f"unknown stat {name!r}")
+    elif name not in RULE_PARAMETERS:
+        raise argparse.ArgumentTypeError(f"unknown parameter {name!r}")
+    return name, [parse_value(value) for value in values.split(",")]
+
+
+def build_rules(config):
+    stats = {kind: list(values) for kind, values in BASE_STATS.items()}
+    options = {}
+    for name, value in config.items():
+        kind, _, field = name.partition(".")
+        if field:
+            stats[kind][STAT_FIELDS.index(field)] = value
+        else:
+            options[name] = value
+    return Rules(stats={kind: tuple(values) for kind, values in stats.items()}, **options)
+
+
+# combat.default_policy, with the special in place of an attack at
+# special_rate
+def mixed_policy(special_rate, rng):
+    def policy(engine):
+        action = default_policy(engine)
+        if action == "attack" and rng.random() < special_rate:
+            return "special"
+        return action
+    return policy
+
+
+def run_config(config_index, config, battles, base_seed, special_rate):
+    rules = build_rules(config)
+    wins = 0
+    turns = []
+    health_left = 0
+    for battle in range(battles):
+        stream = random.Random(f"{base_seed}-{battle}")
+        engine = simulate(stream.getrandbits(64), policy=mixed_policy(special_rate, stream), rules=rules)
+        if engine.state == "victory":
+            wins += 1
+            health_left += engine.player.health
+        turns.append(engine.turns)
+
+    turns.sort()
+    return {
+        "config": config_index,
+        **config,
+        "battles": battles,
+        "win_rate": wins / battles,
+        "mean_turns": sum(turns) / battles,
+        "p95_turns": turns[min(battles - 1, int(battles * 0.95))],
+        "mean_health_on_win": health_left / wins if wins else 0.0,
+    }
+
+
+# Unit of work for one worker process
+def run_chunk(chunk, battles, base_seed, special_rate):
+    return [run_config(config_index, config, battles, base_seed, special_rate) for config_index, config in chunk]
+
+
+def grid(parameters):
+    names = [name for name, _ in parameters]
+    for values in itertools.product(*(values for _, values in parameters)):
+        yield dict(zip(names, values))
+
+
+def chunked(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="lab.py sweep",
+                                     description="Sweep combat parameters across all CPU cores")
+    parser.add_argument("--param", dest="parameters", type=parse_parameter, action="append", default=[],
+                        help="parameter grid as name=v1,v2,... (repeatable)")
+    parser.add_argument("-n", "--battles", type=int, default=1000, help="battles per configuration")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--special-rate", type=float, default=0.3,
+                        help="chance the player uses the special instead of an attack")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=4, help="configurations per task")
+    parser.add_argument("-o", "--output", default="sweep_results.csv")
+    args = parser.parse_args(argv)
+    if args.battles < 1:
+        parser.error("--battles must be at least 1")
+
+    names = [name for name, _ in args.parameters]
+    configs = list(enumerate(grid(args.parameters)))
+    fields = ["config", *names, "battles", "win_rate", "mean_turns", "p95_turns", "mean_health_on_win"]
+    print(f"Sweeping {len(configs)} configurations x {args.battles} battles on {args.workers} workers")
+
+    start = time.perf_counter()
+    done = 0
+    with open(args.output, "w", newline="") as output, ProcessPoolExecutor(args.workers) as executor:
+        writer = csv.DictWriter(output, fieldnames=fields)
+        writer.writeheader()
+        futures = [executor.submit(run_chunk, chunk, args.battles, args.seed, args.special_rate)
+                   for chunk in chunked(configs, args.chunk_size)]
+        for future in as_completed(futures):
+            rows = future.result()
+            writer.writerows(rows)
+            output.flush()
+            done += len(rows)
+            print(f"\r{done}/{len(configs)} configurations", end="", flush=True)
+
+    elapsed = time.perf_counter() - start
+    total_battles = len(configs) * args.battles
+    print(f"\nWrote {args.output} in {elapsed:.1f}s ({total_battles / elapsed:,.0f} battles/s)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
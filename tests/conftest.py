@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The game draws into a hidden window and never plays sound under test
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# lab.py loads its images relative to the game folder and needs a display
+# to convert them
+@pytest.fixture(scope="session")
+def lab():
+    os.chdir(ROOT)
+    import lab
+    lab.init_display()
+    return lab
@@ -0,0 +1,95 @@
+import tracemalloc
+
+import pytest
+
+from combat import BASE_STATS, BattleEngine, Rules
+
+# A player that cannot lose, so a battle goes on for as many waves as needed
+UNKILLABLE = Rules(stats={**BASE_STATS, "player": (10 ** 9, 10 ** 100, 10 ** 100)})
+WARMUP_WAVES = 50
+WAVES = 300
+# A one-off allowance plus a few bytes per wave, far below one object per wave
+GROWTH_LIMIT = 16 * 1024 + 8 * WAVES
+
+
+@pytest.fixture
+def engine():
+    return BattleEngine(0, UNKILLABLE, endless=True)
+
+
+# Enemy characters on the game's side, recycled the way Battle does on a wave
+class Characters:
+    def __init__(self, lab, engine):
+        self.lab = lab
+        self.engine = engine
+        self.pool = lab.CharacterPool()
+        self.player = self.pool.acquire(engine.player, 250, 300)
+        self.enemies = []
+        self.create_enemies()
+
+    def create_enemies(self):
+        self.pool.release(reversed(self.enemies))
+        positions = self.lab.ENEMY_POSITIONS
+        self.enemies = [self.pool.acquire(fighter, *positions[index % len(positions)])
+                        for index, fighter in enumerate(self.engine.enemies)]
+
+
+def play_waves(engine, count, characters=None):
+    last = engine.wave + count
+    while engine.wave < last:
+        if not engine.player_turn:
+            engine.enemy_turn()
+            continue
+        events = engine.player_action("attack")
+        if characters is not None and any(event.kind == "wave" for event in events):
+            characters.create_enemies()
+    assert engine.state == "battle"
+
+
+def test_waves_come_from_the_pools(lab, engine):
+    characters = Characters(lab, engine)
+    play_waves(engine, WARMUP_WAVES, characters)
+    fighters = engine.pool.created
+    created = characters.pool.created
+
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        play_waves(engine, WAVES, characters)
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert engine.pool.created == fighters
+    assert characters.pool.created == created
+    assert end - start < GROWTH_LIMIT
+
+
+def test_enemies_match_their_fighters(lab, engine):
+    characters = Characters(lab, engine)
+    play_waves(engine, 20, characters)
+    assert [character.fighter for character in characters.enemies] == engine.enemies
+    assert [character.name for character in characters.enemies] == [fighter.name for fighter in engine.enemies]
+
+
+# A new wave replaces the enemies' characters but leaves the player's, so the
+# attack that cleared the last wave keeps playing
+def test_new_wave_keeps_the_player_animating(lab):
+    game = lab.Battle(seed=0, endless=True)
+    game.engine.rules = UNKILLABLE
+    game.engine.reset()
+    game.create_characters()
+    game.game_state = "battle"
+    player = game.player
+
+    while game.engine.wave < 5:
+        if game.player_turn and not game.player.animating and not game.current_enemy.animating:
+            wave = game.engine.wave
+            game.player_action("attack")
+            if game.engine.wave != wave:
+                progress = game.player.animation_time
+                game.advance(lab.SIM_STEP)
+                assert game.player is player
+                assert game.player.animating and game.player.animation_type == "attack"
+                assert game.player.animation_time > progress
+        game.advance(lab.SIM_STEP)
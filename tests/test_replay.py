@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from ai import SearchAI
+from combat import BattleEngine, arena_roster
+from replay import MAGIC, MAX_DELTA, VERSION, HEADER, Replay, ReplayRecorder, engine_result, resimulate
+
+PLAYER_ACTIONS = ("attack", "attack", "special", "potion", "next_enemy")
+MODES = {
+    "regular": {},
+    "arena": {"arena": 12},
+    "endless": {"endless": True},
+    "ai": {"enemy_ai": True},
+}
+
+
+# Play a battle with random moves taken at random steps, recording it the
+# way the game does: the player's actions always, the enemy's moves when an
+# enemy AI picked them
+def record(seed, arena=0, endless=False, enemy_ai=False, max_turns=40):
+    engine = BattleEngine(seed, roster=arena_roster(arena) if arena else None, endless=endless)
+    ai = SearchAI(budget=None, max_depth=2, seed=seed) if enemy_ai else None
+    recorder = ReplayRecorder(seed, 0, arena, endless)
+    rng = random.Random(seed)
+    step = 0
+    while engine.state == "battle" and engine.turns < max_turns:
+        step += rng.randrange(1, 90)
+        if engine.player_turn:
+            action = rng.choice(PLAYER_ACTIONS)
+            recorder.record(step, action)
+            engine.player_action(action)
+        else:
+            choice = ai.choose(engine) if ai is not None else None
+            if choice is not None:
+                recorder.record(step, "enemy_" + choice)
+            engine.enemy_turn(choice)
+    return engine, recorder.finish(engine)
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_round_trip(mode, seed):
+    _, replay = record(seed, **MODES[mode])
+    loaded = Replay.from_bytes(replay.to_bytes())
+    assert (loaded.seed, loaded.arena, loaded.endless) == (replay.seed, replay.arena, replay.endless)
+    assert loaded.inputs == replay.inputs
+    assert loaded.result == replay.result
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_resimulate_matches_the_battle(mode, seed):
+    engine, replay = record(seed, **MODES[mode])
+    loaded = Replay.from_bytes(replay.to_bytes())
+    assert engine_result(resimulate(loaded)) == engine_result(engine) == loaded.result
+
+
+def test_long_gaps_are_split():
+    replay = Replay(7, [(5, "attack"), (5 + 3 * MAX_DELTA + 10, "potion")], ("battle", 1, 20))
+    data = replay.to_bytes()
+    assert Replay.from_bytes(data).inputs == replay.inputs
+    assert len(data) > len(Replay(7, [(5, "attack"), (15, "potion")], ("battle", 1, 20)).to_bytes())
+
+
+def test_save_and_load(tmp_path):
+    _, replay = record(4)
+    path = tmp_path / "battle.fbr"
+    replay.save(path)
+    assert Replay.load(path).to_bytes() == replay.to_bytes()
+
+
+@pytest.mark.parametrize("data", [
+    b"FBRP",
+    HEADER.pack(b"XXXX", VERSION, 1, 0, 0),
+    HEADER.pack(MAGIC, VERSION + 1, 1, 0, 0),
+], ids=["short", "magic", "version"])
+def test_rejects_other_files(data):
+    with pytest.raises(ValueError):
+        Replay.from_bytes(data)
+
+
+# The game plays a replay back in real time to the same result
+@pytest.mark.parametrize("mode", MODES)
+def test_playback_in_the_window(lab, mode):
+    _, replay = record(5, max_turns=20, **MODES[mode])
+    game = lab.Battle(replay=replay, arena=replay.arena, endless=replay.endless)
+    for _ in range(20000):
+        game.frame(frame_time=lab.SIM_STEP, wait=False)
+        engine = game.engine
+        if engine.state != "battle":
+            break
+        if game.replay_player.finished and engine.turns >= replay.result[1] and engine.player_turn:
+            break
+    assert engine_result(game.engine) == replay.result
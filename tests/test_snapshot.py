@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from combat import BattleEngine, arena_roster, default_policy
+from snapshot import HEADER, MAGIC, VERSION, Snapshot, fork, play_out
+
+MODES = {
+    "regular": {},
+    "arena": {"roster": arena_roster(40)},
+    "endless": {"endless": True},
+}
+
+
+# A battle some random turns in, at the player's or the enemy's turn
+def battle(seed, mode, turns):
+    engine = BattleEngine(seed, **MODES[mode])
+    rng = random.Random(seed)
+    while engine.state == "battle" and engine.turns < turns:
+        if engine.player_turn:
+            engine.player_action(rng.choice(["attack", "special", "potion", default_policy(engine)]))
+        else:
+            engine.enemy_turn()
+    return engine
+
+
+@pytest.fixture(params=[(seed, mode, turns) for seed in (1, 2) for mode in MODES for turns in (0, 5, 12)],
+                ids=lambda param: "-".join(map(str, param)))
+def engine(request):
+    return battle(*request.param)
+
+
+def test_capture_restore_round_trip(engine):
+    snapshot = Snapshot.capture(engine)
+    assert Snapshot.capture(snapshot.restore()).data == snapshot.data
+
+
+def test_restore_into_another_engine(engine):
+    snapshot = Snapshot.capture(engine)
+    other = battle(9, "arena", 3)
+    assert snapshot.restore(other) is other
+    assert Snapshot.capture(other).data == snapshot.data
+    assert play_out(other) == play_out(engine)
+
+
+def test_fork_plays_on_identically(engine):
+    copy = fork(engine)
+    assert copy is not engine
+    assert play_out(copy) == play_out(engine)
+
+
+def test_header(engine):
+    snapshot = Snapshot(Snapshot.capture(engine, "battle").data)
+    assert snapshot.game_state == "battle"
+    assert snapshot.current_seed == engine.current_seed
+    assert snapshot.endless == engine.endless
+
+
+def test_save_and_load(engine, tmp_path):
+    path = tmp_path / "quicksave.fbs"
+    snapshot = Snapshot.capture(engine)
+    snapshot.save(path)
+    assert Snapshot.load(path).data == snapshot.data
+
+
+@pytest.mark.parametrize("data", [
+    b"FBSS",
+    HEADER.pack(b"XXXX", VERSION, 0, 1, 0, 0, 0),
+    HEADER.pack(MAGIC, VERSION + 1, 0, 1, 0, 0, 0),
+], ids=["short", "magic", "version"])
+def test_rejects_other_files(data):
+    with pytest.raises(ValueError):
+        Snapshot(data)
+
+
+# Quick-save and quick-load in the game pick the battle up where it was saved
+def test_quick_load_in_the_game(lab, tmp_path):
+    game = lab.Battle(seed=3)
+    game.game_state = "battle"
+    for action in ("attack", "special", "attack"):
+        game.player_action(action)
+        game.engine.enemy_turn()
+        game.player_turn = game.engine.player_turn
+    path = tmp_path / "quicksave.fbs"
+    game.save_snapshot(path)
+    saved = Snapshot.load(path)
+
+    game.player_action("attack")
+    game.load_snapshot(path)
+    assert Snapshot.capture(game.engine, game.game_state).data == saved.data
+    assert [character.fighter for character in game.enemies] == game.engine.enemies
+
+    restored = lab.Battle(snapshot=saved)
+    assert restored.game_state == "battle"
+    assert play_out(restored.engine) == play_out(game.engine)